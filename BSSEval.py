@@ -0,0 +1,217 @@
+'''
+BSS Eval v4 (time-invariant distortion filters, as computed by museval.evaluate with mode "v4") with a persistent
+cache of the reference-side computations. The correlation matrices of the delayed reference signals and their LU
+factorizations only depend on the ground truth, so they are computed once per track and stored. Evaluating the
+estimates of another checkpoint then only computes the correlations between estimates and references, solves with
+the stored factorizations and projects the frames.
+'''
+
+import os
+import hashlib
+import numpy as np
+import scipy.linalg
+import scipy.signal
+
+import Metrics
+
+import museval
+
+FILTERS_LEN = 512
+
+def _get_n_fft(num_samples, filters_len):
+    return int(2 ** np.ceil(np.log2(num_samples + filters_len - 1.0)))
+
+def _get_spectra(signals, n_fft):
+    # Spectra of the zero-padded signals [n_signals, n_samples, n_channels] -> [n_signals, n_channels, n_fft // 2 + 1]
+    return np.fft.rfft(np.moveaxis(signals, 1, 2), n=n_fft, axis=2)
+
+def _get_correlation(spectrum_a, spectrum_b):
+    # Circular cross-correlation of two zero-padded signals, index d holds sum_t a[t + d] b[t]
+    return np.fft.irfft(spectrum_a * np.conj(spectrum_b))
+
+def _get_lags(correlation, filters_len):
+    # Correlation for the delays 0, -1, ..., -(filters_len - 1)
+    return np.concatenate([correlation[:1], correlation[-1:-filters_len:-1]])
+
+def _reshape_G(G):
+    # [n_sources, n_sources, n_channels, n_channels, filters_len, filters_len] -> square matrix, like museval
+    G = np.moveaxis(G, (1, 3), (3, 4))
+    size = G.shape[0] * G.shape[1] * G.shape[2]
+    return np.reshape(G, (size, size))
+
+def get_reference_hash(references):
+    '''
+    :return: Fingerprint of reference signals, to detect stale cached statistics
+    '''
+    references = np.ascontiguousarray(references, np.float64)
+    return hashlib.sha1(str(references.shape).encode("utf-8") + references.tobytes()).hexdigest()
+
+def compute_reference_statistics(references, filters_len=FILTERS_LEN):
+    '''
+    Computes the reference-side part of BSS Eval v4 for a track: LU factorizations of the regularised correlation
+    matrix of all delayed reference channels, and of the one of each source alone.
+    :param references: Reference sources [n_sources, n_samples, n_channels]
+    :param filters_len: Length of the distortion filters
+    :return: Dictionary of numpy arrays
+    '''
+    references = np.asarray(references, np.float64)
+    num_sources, num_samples, num_channels = references.shape
+    spectra = _get_spectra(references, _get_n_fft(num_samples, filters_len))
+    eps = np.finfo(np.float64).eps
+
+    G = np.zeros((num_sources, num_sources, num_channels, num_channels, filters_len, filters_len))
+    pairs = [(i, c1) for i in range(num_sources) for c1 in range(num_channels)]
+    for a, (i, c1) in enumerate(pairs):
+        for (j, c2) in pairs[a:]:
+            correlation = _get_correlation(spectra[j, c2], spectra[i, c1])
+            ss = scipy.linalg.toeplitz(_get_lags(correlation, filters_len), r=correlation[:filters_len])
+            G[j, i, c2, c1] = ss
+            G[i, j, c1, c2] = ss.T
+
+    G_all = _reshape_G(G)
+    lu, piv = scipy.linalg.lu_factor(G_all + eps * np.eye(G_all.shape[0]))
+    source_lus, source_pivs = list(), list()
+    for j in range(num_sources):
+        G_j = _reshape_G(G[j:j+1, j:j+1])
+        source_lu, source_piv = scipy.linalg.lu_factor(G_j + eps * np.eye(G_j.shape[0]))
+        source_lus.append(source_lu)
+        source_pivs.append(source_piv)
+
+    return {"lu": lu, "piv": piv,
+            "source_lu": np.stack(source_lus), "source_piv": np.stack(source_pivs),
+            "filters_len": np.array(filters_len),
+            "reference_hash": np.array(get_reference_hash(references))}
+
+def get_reference_statistics(references, cache_path=None, filters_len=FILTERS_LEN):
+    '''
+    Returns the reference statistics of a track, computing and storing them at cache_path if no valid ones are stored
+    :param references: Reference sources [n_sources, n_samples, n_channels]
+    :param cache_path: .npz file for the statistics, None to not cache them
+    :param filters_len: Length of the distortion filters
+    :return: Dictionary as returned by compute_reference_statistics
+    '''
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            statistics = dict((key, cached[key]) for key in cached.files)
+        if str(statistics["reference_hash"]) == get_reference_hash(references) and int(statistics["filters_len"]) == filters_len:
+            return statistics
+        print("WARNING: Cached reference statistics " + cache_path + " do not match the references, recomputing them")
+
+    statistics = compute_reference_statistics(references, filters_len)
+    if cache_path is not None:
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first, so that concurrent evaluations never read partial files
+        np.savez(cache_path + ".tmp.npz", **statistics)
+        os.rename(cache_path + ".tmp.npz", cache_path)
+    return statistics
+
+def _project(reference_frames, C):
+    # Filters reference frames [n_sources, n_frames, win, n_channels] with C [n_sources, n_channels, filters_len, n_channels]
+    # and sums over sources and input channels -> [n_frames, win + filters_len - 1, n_channels]
+    num_sources, num_frames, win, num_channels = reference_frames.shape
+    projection = np.zeros((num_frames, win + C.shape[2] - 1, num_channels))
+    for j in range(num_sources):
+        for cj in range(num_channels):
+            for c in range(num_channels):
+                projection[:, :, c] += scipy.signal.fftconvolve(reference_frames[j, :, :, cj], C[j, cj, np.newaxis, :, c], axes=1)
+    return projection
+
+def _db(numerator, denominator):
+    # Like museval, a vanishing distortion gives an infinite ratio
+    with np.errstate(divide="ignore"):
+        return 10.0 * np.log10(numerator / denominator)
+
+def bss_eval(references, estimates, win=44100, hop=44100, statistics=None, frames_per_chunk=32):
+    '''
+    BSS Eval v4 image metrics without permutation, matching museval.evaluate(references, estimates, win, hop, mode="v4").
+    :param references: Reference sources [n_sources, n_samples, n_channels]
+    :param estimates: Estimated sources [n_sources, n_samples', n_channels], cut or zero-padded to the references
+    :param win: Frame length in samples
+    :param hop: Hop size in samples
+    :param statistics: Reference statistics from get_reference_statistics, computed here if None
+    :param frames_per_chunk: Number of frames projected at once, limits memory
+    :return: SDR, ISR, SIR, SAR, each [n_sources, n_frames], NaN in frames with a silent reference or estimate
+    '''
+    references, estimates = Metrics.pad_or_truncate(np.asarray(references, np.float64), np.asarray(estimates, np.float64))
+    if statistics is None:
+        statistics = compute_reference_statistics(references)
+    num_sources, num_samples, num_channels = references.shape
+    filters_len = int(statistics["filters_len"])
+
+    # Distortion filters of each estimate, from its correlations with all delayed reference channels
+    n_fft = _get_n_fft(num_samples, filters_len)
+    reference_spectra, estimate_spectra = _get_spectra(references, n_fft), _get_spectra(estimates, n_fft)
+    C, Cj = list(), list()
+    for j in range(num_sources):
+        D = np.zeros((num_sources, num_channels, filters_len, num_channels))
+        for i in range(num_sources):
+            for cj in range(num_channels):
+                for c in range(num_channels):
+                    D[i, cj, :, c] = _get_lags(_get_correlation(reference_spectra[i, cj], estimate_spectra[j, c]), filters_len)
+        C.append(scipy.linalg.lu_solve((statistics["lu"], statistics["piv"]), D.reshape(-1, num_channels)).reshape(D.shape))
+        Cj.append(scipy.linalg.lu_solve((statistics["source_lu"][j], statistics["source_piv"][j]), D[j].reshape(-1, num_channels)).reshape(D[j:j+1].shape))
+
+    reference_frames, estimate_frames = Metrics.get_frames(references, win, hop), Metrics.get_frames(estimates, win, hop)
+    num_frames = reference_frames.shape[1]
+    silent = Metrics.get_silent_frames(reference_frames) | Metrics.get_silent_frames(estimate_frames)
+    results = np.full((4, num_sources, num_frames), np.nan)
+
+    for start in range(0, num_frames, frames_per_chunk):
+        chunk = np.arange(start, min(start + frames_per_chunk, num_frames))
+        chunk = chunk[~silent[chunk]]
+        if len(chunk) == 0:
+            continue
+        chunk_references = reference_frames[:, chunk]
+        padding = [(0, 0), (0, filters_len - 1), (0, 0)]
+        for j in range(num_sources):
+            s_true = np.pad(chunk_references[j], padding, mode="constant")
+            estimate = np.pad(estimate_frames[j, chunk], padding, mode="constant")
+            own_projection = _project(chunk_references[j:j+1], Cj[j])
+            projection = _project(chunk_references, C[j])
+
+            energy_s_true = np.sum(np.square(s_true), axis=(1, 2))
+            results[0, j, chunk] = _db(energy_s_true, np.sum(np.square(estimate - s_true), axis=(1, 2))) # SDR
+            results[1, j, chunk] = _db(energy_s_true, np.sum(np.square(own_projection - s_true), axis=(1, 2))) # ISR
+            results[2, j, chunk] = _db(np.sum(np.square(own_projection), axis=(1, 2)), np.sum(np.square(projection - own_projection), axis=(1, 2))) # SIR
+            results[3, j, chunk] = _db(np.sum(np.square(projection), axis=(1, 2)), np.sum(np.square(estimate - projection), axis=(1, 2))) # SAR
+
+    return results[0], results[1], results[2], results[3]
+
+def eval_mus_track(track, estimates, reference_cache_dir=None, win=1.0, hop=1.0):
+    '''
+    Evaluates the estimates of a MUSDB track like museval.eval_mus_track in v4 mode, with the same grouping of targets:
+    vocals and accompaniment are evaluated together, all other targets jointly. Reference statistics are cached per
+    track and target group in reference_cache_dir.
+    :param track: MUSDB track object
+    :param estimates: Estimates dictionary in accordance with the MUSDB evaluation API
+    :param reference_cache_dir: Folder of the cached reference statistics, None to not cache them
+    :param win: Evaluation window length in seconds
+    :param hop: Evaluation hop size in seconds
+    :return: museval EvalStore with the framewise scores
+    '''
+    targets = [name for name in track.targets.keys() if name in estimates]
+    has_acc = all(name in targets for name in ["vocals", "accompaniment"])
+    if has_acc:
+        targets.remove("accompaniment")
+    # Groups of jointly evaluated targets, with the targets whose scores are reported from that group
+    groups = list()
+    if len(targets) >= 2:
+        groups.append((targets, [name for name in targets if not (has_acc and name == "vocals")]))
+    if has_acc:
+        groups.append((["vocals", "accompaniment"], ["vocals", "accompaniment"]))
+
+    data = museval.EvalStore(win=win, hop=hop)
+    for group, reported in groups:
+        references = np.stack([track.targets[name].audio for name in group])
+        cache_path = None
+        if reference_cache_dir is not None:
+            cache_path = os.path.join(reference_cache_dir, track.subset, track.name + "_" + "_".join(group) + ".npz")
+        statistics = get_reference_statistics(references, cache_path)
+        SDR, ISR, SIR, SAR = bss_eval(references, np.stack([estimates[name] for name in group]),
+                                      int(win * track.rate), int(hop * track.rate), statistics)
+        for i, name in enumerate(group):
+            if name in reported:
+                data.add_target(target_name=name, values={"SDR": SDR[i].tolist(), "SIR": SIR[i].tolist(), "ISR": ISR[i].tolist(), "SAR": SAR[i].tolist()})
+    return data
@@ -0,0 +1,111 @@
+'''
+Measures the inference speed of separator networks with randomly initialised weights, to compare architectures and
+inference settings independent of training. The real-time factor (RTF) is the computation time divided by the duration
+of the separated audio, values below one are faster than real time.
+'''
+
+import time
+import numpy as np
+import tensorflow as tf
+
+import Models.Separators
+import Planner
+import Export
+
+def time_separator(model_config, num_frames, num_runs=10, device="/cpu:0"):
+    '''
+    Builds the separator selected by model_config["network"] in a new graph and times forward passes on random input.
+    :param model_config: Model configuration dictionary
+    :param num_frames: Desired number of output samples per forward pass
+    :param num_runs: Number of timed forward passes, after one untimed warm-up pass
+    :param device: Tensorflow device to run the separator on
+    :return: Dictionary with network name, shapes, analytic FLOPs, parameters, mean seconds per pass and RTF
+    '''
+    separator = Models.Separators.get_separator(model_config)
+    input_shape, output_shape, specs = Planner.get_layer_specs(separator, num_frames)
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.device(device):
+            mix = tf.placeholder(tf.float32, [int(d) for d in input_shape])
+            outputs = separator.get_output(mix, False, reuse=False)
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            mix_audio = np.random.uniform(-0.5, 0.5, [int(d) for d in input_shape]).astype(np.float32)
+            sess.run(outputs, feed_dict={mix: mix_audio}) # Warm-up, excludes graph optimisation and memory allocation
+            start = time.time()
+            for _ in range(num_runs):
+                sess.run(outputs, feed_dict={mix: mix_audio})
+            seconds = (time.time() - start) / num_runs
+
+    return {"network": model_config["network"],
+            "input_frames": int(input_shape[1]),
+            "output_frames": int(output_shape[1]),
+            "flops": sum(spec["flops"] for spec in specs),
+            "params": sum(spec["params"] for spec in specs),
+            "seconds": seconds,
+            "rtf": seconds / (float(output_shape[1]) / model_config["expected_sr"])}
+
+def compare_networks(model_config, networks, num_frames, num_runs=10, device="/cpu:0"):
+    '''
+    Times several network types with otherwise identical configuration, see time_separator.
+    :param networks: List of values for model_config["network"]
+    :return: List of result dictionaries, one per network
+    '''
+    rows = list()
+    for network in networks:
+        config = dict(model_config)
+        config["network"] = network
+        rows.append(time_separator(config, num_frames, num_runs, device))
+    return rows
+
+def time_inference(export_dir, num_runs=10, xla=False):
+    '''
+    Times forward passes of an exported separator (see Export.export) on random input.
+    :param export_dir: Export directory of the separator
+    :param num_runs: Number of timed forward passes, after the first pass
+    :param xla: Whether to JIT-compile the graph with XLA
+    :return: Dictionary with mode, batch size, seconds of the first pass (including XLA compilation), mean seconds
+    per pass (latency) and throughput as output samples per second
+    '''
+    inference_separator = Export.InferenceSeparator(export_dir, Export.get_session_config(xla), xla)
+    batch_size, output_frames = inference_separator.output_shape[0], inference_separator.output_shape[1]
+    mix_audio = np.random.uniform(-0.5, 0.5, inference_separator.input_shape).astype(np.float32)
+
+    start = time.time()
+    inference_separator(mix_audio)
+    first_seconds = time.time() - start
+    start = time.time()
+    for _ in range(num_runs):
+        inference_separator(mix_audio)
+    seconds = (time.time() - start) / num_runs
+    inference_separator.close()
+
+    return {"mode": "xla" if xla else "session",
+            "batch_size": batch_size,
+            "first_seconds": first_seconds,
+            "seconds": seconds,
+            "throughput": batch_size * output_frames / seconds}
+
+def compare_inference(export_dir, num_runs=10):
+    '''
+    Times an exported separator with the plain session and with XLA compilation, see time_inference.
+    :return: List of result dictionaries, session first
+    '''
+    return [time_inference(export_dir, num_runs, xla) for xla in [False, True]]
+
+def print_inference_comparison(rows):
+    baseline = rows[0]
+    print("{:<10} {:>6} {:>12} {:>12} {:>16} {:>10}".format("mode", "batch", "first ms", "ms/pass", "samples/s", "speed-up"))
+    for row in rows:
+        print("{:<10} {:>6d} {:>12.1f} {:>12.1f} {:>16.0f} {:>9.2f}x".format(
+            row["mode"], row["batch_size"], row["first_seconds"] * 1e3, row["seconds"] * 1e3, row["throughput"],
+            baseline["seconds"] / row["seconds"]))
+
+def print_comparison(rows):
+    baseline = rows[0]
+    print("{:<16} {:>10} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "network", "input", "output", "params", "GFLOPs", "ms/pass", "RTF", "speed-up"))
+    for row in rows:
+        print("{:<16} {:>10d} {:>10d} {:>12d} {:>10.2f} {:>10.1f} {:>10.4f} {:>9.2f}x".format(
+            row["network"], row["input_frames"], row["output_frames"], row["params"], row["flops"] / 1e9,
+            row["seconds"] * 1e3, row["rtf"], baseline["seconds"] / row["seconds"]))
@@ -0,0 +1,105 @@
+'''
+Consistency checks of the separator graphs with randomly initialised weights on the CPU, independent of training.
+Each check builds its graphs in a new tf.Graph, raises an AssertionError if it fails and otherwise returns the
+measured deviation.
+'''
+
+import numpy as np
+import tensorflow as tf
+
+import Models.Separators
+
+def _float32_config(model_config):
+    # Deviations are measured in float32, bfloat16 rounding would hide small errors
+    config = dict(model_config)
+    config["precision"] = "float32"
+    return config
+
+def check_multi_query_output(model_config, batch_size=2, num_queries=3, num_frames=None, tolerance=1e-5, seed=0):
+    '''
+    Compares get_multi_query_output of the conditional separator with one get_output call per query on random
+    mixtures and random conditioning queries, which differ between the examples of the batch.
+    :param model_config: Model configuration dictionary
+    :param batch_size: Number of mixtures
+    :param num_queries: Number of conditioning queries per mixture
+    :param num_frames: Desired number of output samples, None: model_config["num_frames"]
+    :param tolerance: Maximum absolute difference of the source estimates
+    :param seed: Seed of the random weights and inputs
+    :return: Maximum absolute difference of the source estimates
+    '''
+    config = _float32_config(model_config)
+    separator = Models.Separators.get_separator(config, conditional=True)
+    input_shape, _ = separator.get_padding(np.array([batch_size, num_frames or config["num_frames"], 0]))
+    input_shape = [int(d) for d in input_shape]
+
+    rng = np.random.RandomState(seed)
+    mix_audio = rng.uniform(-0.5, 0.5, input_shape).astype(np.float32)
+    queries = rng.randint(0, 2, [batch_size, num_queries, config["num_sources"]]).astype(np.float32)
+
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        mix = tf.placeholder(tf.float32, input_shape)
+        z = tf.placeholder(tf.float32, [batch_size, num_queries, config["num_sources"]])
+        multi_outputs = separator.get_multi_query_output(mix, z, reuse=False)
+        single_outputs = [separator.get_output(mix, z[:, q], False, reuse=True) for q in range(num_queries)]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            multi_preds, single_preds = sess.run([multi_outputs, single_outputs], feed_dict={mix: mix_audio, z: queries})
+
+    max_diff = 0.0
+    for q in range(num_queries):
+        for multi_pred, single_pred in zip(multi_preds, single_preds[q]):
+            max_diff = max(max_diff, float(np.max(np.abs(multi_pred[:, q] - single_pred))))
+    assert max_diff <= tolerance, "Multi-query output deviates by " + str(max_diff) + " from separate get_output calls"
+    return max_diff
+
+def check_recompute_gradients(model_config, recompute="all", num_frames=None, tolerance=1e-4, seed=0):
+    '''
+    Builds the conditional separator for training with recomputed activations on the CPU and compares its source
+    estimates and the gradients of a loss w.r.t. all separator variables with those of the same separator without
+    recomputation, sharing the variables. Fails already while building the graph if recomputation is not supported.
+    :param model_config: Model configuration dictionary
+    :param recompute: Recomputation setting to check, see UnetAudioSeparator
+    :param num_frames: Desired number of output samples, None: model_config["num_frames"]
+    :param tolerance: Maximum absolute difference of estimates and gradients, relative to the largest gradient
+    :param seed: Seed of the random weights and inputs
+    :return: Maximum relative difference of the gradients
+    '''
+    config = _float32_config(model_config)
+    config["recompute"] = recompute
+    recompute_separator = Models.Separators.get_separator(config, conditional=True)
+    config["recompute"] = "none"
+    plain_separator = Models.Separators.get_separator(config, conditional=True)
+    batch_size = config["batch_size"]
+    input_shape, output_shape = plain_separator.get_padding(np.array([batch_size, num_frames or config["num_frames"], 0]))
+    input_shape, output_shape = [int(d) for d in input_shape], [int(d) for d in output_shape]
+
+    rng = np.random.RandomState(seed)
+    feed_values = [rng.uniform(-0.5, 0.5, input_shape).astype(np.float32),
+                   rng.randint(0, 2, [batch_size, config["num_sources"]]).astype(np.float32),
+                   rng.uniform(-0.5, 0.5, [config["num_sources"]] + output_shape).astype(np.float32)]
+
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        mix = tf.placeholder(tf.float32, input_shape)
+        z = tf.placeholder(tf.float32, [batch_size, config["num_sources"]])
+        targets = tf.placeholder(tf.float32, [config["num_sources"]] + output_shape)
+
+        # The recomputing separator creates the variables, as resource variables
+        losses = list()
+        for separator, reuse in [(recompute_separator, False), (plain_separator, True)]:
+            outputs = separator.get_output(mix, z, True, reuse=reuse)
+            losses.append(tf.add_n([tf.reduce_mean(tf.square(tf.cast(out, tf.float32) - targets[i])) for i, out in enumerate(outputs)]))
+        variables = tf.trainable_variables("separator")
+        gradients = [tf.gradients(loss, variables) for loss in losses]
+        assert all(grad is not None for grad in gradients[0]), "Recomputation with " + recompute + " yields no gradients for some variables"
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            loss_values, grad_values = sess.run([losses, gradients], feed_dict=dict(zip([mix, z, targets], feed_values)))
+
+    scale = max(float(np.max(np.abs(grad))) for grad in grad_values[1])
+    max_diff = max(float(np.max(np.abs(recomputed - plain))) for recomputed, plain in zip(*grad_values)) / scale
+    assert abs(loss_values[0] - loss_values[1]) <= tolerance * max(abs(loss_values[1]), 1.0), "Recomputation changes the loss"
+    assert max_diff <= tolerance, "Gradients with recompute=" + recompute + " deviate by " + str(max_diff) + " relative to the largest gradient"
+    return max_diff
@@ -0,0 +1,121 @@
+'''
+Writes predicted segments directly into one audio file per track and source, or into one multichannel stem file per
+track, while the prediction generator keeps running. Segments of a track can arrive out of order (the test records
+are shuffled and interleaved), so each track has a bounded reorder buffer: segments are appended as soon as all
+earlier segments of the track were written, and a gap that holds up more than max_buffered segments is filled with
+silence so that memory stays bounded.
+'''
+
+import os
+import numpy as np
+import soundfile
+
+import Pipeline
+
+class EstimateWriter:
+    '''
+    Consumes predictions with the keys "sources" [n_sources, n_samples, n_channels], "filename" and "sample_id" (index
+    of the segment within its track). Files and buffers are only touched by a background thread.
+    '''
+
+    def __init__(self, estimates_path, sample_rate, stem=False, max_buffered=64, max_pending=8, subtype="FLOAT"):
+        '''
+        :param estimates_path: Output folder, sources are written to <filename>/source_<i>.wav, stems to <filename>.wav
+        :param sample_rate: Sampling rate of the predictions
+        :param stem: Whether to write all sources of a track into one file, with the channels of source i at
+        i * n_channels, ..., (i + 1) * n_channels - 1
+        :param max_buffered: Maximum number of out-of-order segments held per track
+        :param max_pending: Maximum number of predictions queued for the writing thread
+        :param subtype: soundfile subtype of the written WAV files
+        '''
+        self.estimates_path = estimates_path
+        self.sample_rate = sample_rate
+        self.stem = stem
+        self.max_buffered = max_buffered
+        self.subtype = subtype
+        self.tracks = dict() # Filename -> {"files", "next_id", "buffer", "segment_shape"}
+        self.num_filled = 0 # Number of segments replaced by silence
+        self.num_dropped = 0 # Number of segments arriving after their position was already written
+        self.worker = Pipeline.BackgroundWorker(self._add, max_pending)
+
+    def write(self, prediction):
+        '''
+        Queues a prediction for writing, blocks while max_pending predictions are queued
+        :param prediction: Prediction dictionary of the estimator
+        '''
+        filename = prediction["filename"]
+        if isinstance(filename, bytes):
+            filename = filename.decode("utf-8")
+        self.worker.put(str(filename), int(prediction["sample_id"]), np.float32(prediction["sources"]))
+
+    def _open(self, filename, sources):
+        num_sources, _, num_channels = sources.shape
+        if self.stem:
+            path = os.path.join(self.estimates_path, filename + ".wav")
+            paths, channels = [path], num_sources * num_channels
+        else:
+            path = os.path.join(self.estimates_path, filename)
+            paths = [os.path.join(path, "source_" + str(i) + ".wav") for i in range(num_sources)]
+            channels = num_channels
+        if not os.path.exists(os.path.dirname(paths[0])):
+            os.makedirs(os.path.dirname(paths[0]))
+        files = [soundfile.SoundFile(p, "w", samplerate=self.sample_rate, channels=channels, format="WAV", subtype=self.subtype) for p in paths]
+        return {"files": files, "next_id": 0, "buffer": dict(), "segment_shape": sources.shape}
+
+    def _append(self, track, sources):
+        if self.stem:
+            # [n_sources, n_samples, n_channels] -> [n_samples, n_sources * n_channels]
+            track["files"][0].write(np.concatenate(list(sources), axis=1))
+        else:
+            for f, source in zip(track["files"], sources):
+                f.write(source)
+        track["next_id"] += 1
+
+    def _drain(self, track):
+        # Appends all buffered segments that directly follow the written ones
+        while track["next_id"] in track["buffer"]:
+            self._append(track, track["buffer"].pop(track["next_id"]))
+
+    def _add(self, filename, sample_id, sources):
+        if filename not in self.tracks:
+            self.tracks[filename] = self._open(filename, sources)
+        track = self.tracks[filename]
+        if sample_id < track["next_id"] or sample_id in track["buffer"]:
+            print("WARNING: Segment " + str(sample_id) + " of " + filename + " arrived after its position was written, dropping it")
+            self.num_dropped += 1
+            return
+        track["buffer"][sample_id] = sources
+        self._drain(track)
+        if len(track["buffer"]) > self.max_buffered:
+            # Give up waiting for the missing segments before the earliest buffered one
+            first = min(track["buffer"])
+            print("WARNING: Segments " + str(track["next_id"]) + " to " + str(first - 1) + " of " + filename +
+                  " are missing while " + str(len(track["buffer"])) + " later segments are buffered, writing silence instead")
+            self._fill(track, first)
+            self._drain(track)
+
+    def _fill(self, track, end):
+        # Writes silent segments up to segment end (exclusive)
+        silence = np.zeros(track["segment_shape"], np.float32)
+        self.num_filled += end - track["next_id"]
+        while track["next_id"] < end:
+            self._append(track, silence)
+
+    def close(self):
+        '''
+        Writes all remaining segments, filling gaps with silence, and closes the files
+        :return: List of the written file paths
+        '''
+        self.worker.close()
+        paths = list()
+        for filename, track in sorted(self.tracks.items()):
+            if len(track["buffer"]) > 0:
+                print("WARNING: Segments missing in " + filename + ", writing silence instead")
+            while len(track["buffer"]) > 0:
+                self._fill(track, min(track["buffer"]))
+                self._drain(track)
+            for f in track["files"]:
+                paths.append(f.name)
+                f.close()
+        self.tracks = dict()
+        return paths
@@ -1,7 +1,6 @@
 import pickle
 import numpy as np
 import tensorflow as tf
-import librosa
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -9,9 +8,23 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 import os
 import json
 import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from numpy.lib.stride_tricks import as_strided
 
 from Input import Input
-import Models.UnetAudioSeparator
+import Models.Separators
+import Models.StreamingUnetAudioSeparator
+import Planner
+import Quantize
+import Export
+import Pipeline
+import Resample
+import BSSEval
+import MetricsStore
 
 import musdb
 import museval
@@ -44,36 +57,66 @@ def predict(track):
     with open("prediction_params.pkl", "r") as file:
         [model_config, load_model] = pickle.load(file)
 
-    # Determine input and output shapes, if we use U-net as separator
-    disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]  # Shape of discriminator input
-    if model_config["network"] == "unet":
-        separator_class = Models.UnetAudioSeparator.UnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
-                                                                   output_type=model_config["output_type"],
-                                                                   context=model_config["context"],
-                                                                   mono=model_config["mono_downmix"],
-                                                                   upsampling=model_config["upsampling"],
-                                                                   num_sources=model_config["num_sources"],
-                                                                   filter_size=model_config["filter_size"],
-                                                                   merge_filter_size=model_config["merge_filter_size"])
-
+    # Determine input and output shapes. The model is fully convolutional, so the inference window can be larger than in training
+    separator_class = Models.Separators.get_separator(model_config)
+    num_frames = Planner.get_inference_frames(model_config, separator_class)
+    disc_input_shape = [model_config["batch_size"], num_frames, 0]  # Shape of discriminator input
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
-    separator_func = separator_class.get_output
+    # Number of windows separated together
+    sep_input_shape[0] = Planner.get_inference_batch_size(model_config, separator_class, num_frames)
+    sep_output_shape[0] = sep_input_shape[0]
+
+    print("Testing...")
 
-    # Batch size of 1
-    sep_input_shape[0] = 1
-    sep_output_shape[0] = 1
+    mix_audio, orig_sr, mix_channels = track.audio, track.rate, track.audio.shape[1] # Audio has (n_samples, n_channels) shape
+    if model_config.get("export_dir") is not None:
+        # Frozen separator written by Export.export, loaded only for the first track of this process
+        inference_separator = Export.load(model_config["export_dir"], model_config.get("xla", False))
+        run_fn = get_silence_skipping_run_fn(model_config, inference_separator, inference_separator.output_shape[1])
+        separator_preds = predict_track_fn(model_config, run_fn, mix_audio, orig_sr, inference_separator.input_shape[1], inference_separator.output_shape[1], inference_separator.input_shape[0])
+        if isinstance(run_fn, SilenceSkipper):
+            print(run_fn.summary())
+    elif model_config.get("tflite_model") is not None:
+        # Quantized separator written by Quantize.quantize, runs without Tensorflow session
+        tflite_separator = Quantize.TFLiteSeparator(model_config["tflite_model"])
+        run_fn = get_silence_skipping_run_fn(model_config, tflite_separator, tflite_separator.output_shape[1])
+        separator_preds = predict_track_fn(model_config, run_fn, mix_audio, orig_sr, tflite_separator.input_shape[1], tflite_separator.output_shape[1])
+        if isinstance(run_fn, SilenceSkipper):
+            print(run_fn.summary())
+    else:
+        separator_preds = predict_track_session(model_config, load_model, separator_class, sep_input_shape, sep_output_shape, mix_audio, orig_sr)
 
-    mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+    estimates = make_estimates(model_config, separator_preds, orig_sr, mix_channels)
 
-    print("Testing...")
+    # Evaluate using museval
+    scores = museval.eval_mus_track(
+        track, estimates, output_dir="/mnt/daten/Datasets/MUSDB18/eval", # SiSec should use longer win and hop parameters here to make evaluation more stable!
+    )
+
+    # print nicely formatted mean scores
+    print(scores)
+
+    return estimates
 
+def predict_track_session(model_config, load_model, separator_class, sep_input_shape, sep_output_shape, mix_audio, mix_sr):
+    '''
+    Builds the separator graph, restores the checkpoint load_model and predicts the source estimates of one mixture
+    with predict_track, or predict_track_streaming if model_config["streaming_hop"] is set.
+    :return: List of source estimates [n_frames, n_channels] at the model sampling rate
+    '''
     # BUILD MODELS
     # Separator
-    separator_sources = separator_func(mix_context, False, reuse=False)
+    if model_config.get("streaming_hop") is not None:
+        streamer = Models.StreamingUnetAudioSeparator.StreamingUnetAudioSeparator(separator_class, [1] + list(sep_input_shape[1:]), model_config["streaming_hop"]).build()
+        print("Streaming latency: " + str(float(streamer.get_latency()) / model_config["expected_sr"]) + " seconds plus computation time per step")
+    else:
+        mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+        separator_sources = separator_class.get_output(mix_context, False, reuse=False)
 
     # Start session and queue input threads
     sess = tf.Session()
     sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
 
     # Load model
     # Load pretrained model to continue training, if we are supposed to
@@ -82,11 +125,23 @@ def predict(track):
     restorer.restore(sess, load_model)
     print('Pre-trained model restored for song prediction')
 
-    mix_audio, orig_sr, mix_channels = track.audio, track.rate, track.audio.shape[1] # Audio has (n_samples, n_channels) shape
-    separator_preds = predict_track(model_config, sess, mix_audio, orig_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context)
+    if model_config.get("streaming_hop") is not None:
+        separator_preds = predict_track_streaming(model_config, sess, mix_audio, mix_sr, streamer)
+    else:
+        separator_preds = predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context)
+
+    # Close session, clear computational graph
+    sess.close()
+    tf.reset_default_graph()
+    return separator_preds
 
-    # Upsample predicted source audio and convert to stereo
-    pred_audio = [librosa.resample(pred.T, model_config["expected_sr"], orig_sr).T for pred in separator_preds]
+def make_estimates(model_config, separator_preds, orig_sr, mix_channels):
+    '''
+    Converts source estimates at the model sampling rate back to the sampling rate and channels of the mixture
+    :return: Estimates dictionary in accordance with the MUSDB evaluation API
+    '''
+    # Upsample predicted source audio of all sources at once and convert to stereo
+    pred_audio = list(Resample.resample(np.stack(separator_preds), model_config["expected_sr"], orig_sr, axis=1))
 
     if model_config["mono_downmix"] and mix_channels > 1: # Convert to multichannel if mixture input was multichannel by duplicating mono estimate
         pred_audio = [np.tile(pred, [1, mix_channels]) for pred in pred_audio]
@@ -104,25 +159,26 @@ def predict(track):
             'other' : pred_audio[2],
             'vocals' : pred_audio[3]
         }
-
-    # Evaluate using museval
-    scores = museval.eval_mus_track(
-        track, estimates, output_dir="/mnt/daten/Datasets/MUSDB18/eval", # SiSec should use longer win and hop parameters here to make evaluation more stable!
-    )
-
-    # print nicely formatted mean scores
-    print(scores)
-
-    # Close session, clear computational graph
-    sess.close()
-    tf.reset_default_graph()
-
     return estimates
 
+def prepare_mix(model_config, mix_audio, mix_sr):
+    '''
+    Converts a mixture signal [n_frames, n_channels] to the number of channels and sampling rate expected by the model.
+    '''
+    # Load mixture, convert to mono and downsample then
+    assert(len(mix_audio.shape) == 2)
+    if model_config["mono_downmix"]:
+        mix_audio = np.mean(mix_audio, axis=1, keepdims=True)
+    else:
+        if mix_audio.shape[1] == 1:# Duplicate channels if input is mono but model is stereo
+            mix_audio = np.tile(mix_audio, [1, 2])
+    mix_audio = Resample.resample(mix_audio, mix_sr, model_config["expected_sr"], "kaiser_fast")
+    return mix_audio
+
 def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context):
     '''
     Outputs source estimates for a given input mixture signal mix_audio [n_frames, n_channels] and a given Tensorflow session and placeholders belonging to the prediction network.
-    It iterates through the track, collecting segment-wise predictions to form the output.
+    It iterates through the track in batches of sep_input_shape[0] windows, collecting segment-wise predictions to form the output.
     :param model_config: Model configuration dictionary
     :param sess: Tensorflow session used to run the network inference
     :param mix_audio: [n_frames, n_channels] audio signal (numpy array). Can have higher sampling rate or channels than the model supports, will be downsampled correspondingly.
@@ -133,78 +189,681 @@ def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_ou
     :param mix_context: Input tensor of the network
     :return: 
     '''
-    # Load mixture, convert to mono and downsample then
-    assert(len(mix_audio.shape) == 2)
-    if model_config["mono_downmix"]:
-        mix_audio = np.mean(mix_audio, axis=1, keepdims=True)
-    else:
-        if mix_audio.shape[1] == 1:# Duplicate channels if input is mono but model is stereo
-            mix_audio = np.tile(mix_audio, [1, 2])
-    mix_audio = librosa.resample(mix_audio.T, mix_sr, model_config["expected_sr"], res_type="kaiser_fast").T
+    run_fn = get_silence_skipping_run_fn(model_config, get_session_run_fn(sess, separator_sources, mix_context), sep_output_shape[1])
+    separator_preds = predict_track_fn(model_config, run_fn, mix_audio, mix_sr, sep_input_shape[1], sep_output_shape[1], sep_input_shape[0])
+    if isinstance(run_fn, SilenceSkipper):
+        print(run_fn.summary())
+    return separator_preds
+
+def get_session_run_fn(sess, separator_sources, mix_context):
+    '''
+    Wraps a separator graph into a run_fn for predict_track_fn. The placeholder has a fixed batch size, so the last
+    batch of a track is padded with silent windows.
+    '''
+    batch_size = int(mix_context.shape[0])
+    def run_fn(mix_parts):
+        num_windows = mix_parts.shape[0]
+        if num_windows < batch_size:
+            mix_parts = np.pad(mix_parts, [(0, batch_size - num_windows), (0, 0), (0, 0)], mode="constant")
+        return [source_parts[:num_windows] for source_parts in sess.run(separator_sources, feed_dict={mix_context: mix_parts})]
+    return run_fn
+
+def get_window_energy(windows):
+    '''
+    :param windows: Mixture windows [n_windows, n_frames, n_channels]
+    :return: Mean power of each window in dB relative to full scale [n_windows]
+    '''
+    power = np.mean(np.square(windows, dtype=np.float64), axis=(1, 2))
+    return 10.0 * np.log10(np.maximum(power, 1e-20))
+
+class SilenceSkipper:
+    '''
+    Wraps a run_fn so that windows whose mixture input is quieter than a threshold are not separated, their source
+    estimates are zero. The input window of a separator with valid convolutions is exactly the receptive field of its
+    output window, so a skipped window cannot have audible estimates apart from what the network adds to silence.
+    Separators with a static batch size pad smaller batches, so calling the skipper with a batch only saves compute if
+    the whole batch is silent. predict_track_fn therefore selects the active windows of a track first (see select) and
+    runs them in full batches.
+    '''
 
-    # Preallocate source predictions (same shape as input mixture)
-    source_time_frames = mix_audio.shape[0]
-    source_preds = [np.zeros(mix_audio.shape, np.float32) for _ in range(model_config["num_sources"])]
+    def __init__(self, run_fn, threshold, num_sources, output_time_frames):
+        '''
+        :param run_fn: Function as passed to predict_track_fn
+        :param threshold: Windows with a mean power below threshold dB relative to full scale are skipped
+        :param num_sources: Number of sources returned by run_fn
+        :param output_time_frames: Output length of the separator
+        '''
+        self.run_fn = run_fn
+        self.threshold = threshold
+        self.num_sources = num_sources
+        self.output_time_frames = output_time_frames
+        self.num_windows = 0
+        self.num_skipped = 0
+        self.num_batches = 0 # Batches needed to separate all windows
+        self.num_run_batches = 0 # Batches passed to run_fn
+
+    def __call__(self, mix_parts):
+        active = get_window_energy(mix_parts) >= self.threshold
+        self.num_windows += mix_parts.shape[0]
+        self.num_skipped += int(np.sum(~active))
+        self.num_batches += 1
+        if np.all(active):
+            self.num_run_batches += 1
+            return self.run_fn(mix_parts)
+        source_parts = [np.zeros((mix_parts.shape[0], self.output_time_frames, mix_parts.shape[2]), np.float32) for _ in range(self.num_sources)]
+        if np.any(active):
+            self.num_run_batches += 1
+            for parts, active_parts in zip(source_parts, self.run_fn(mix_parts[active])):
+                parts[active] = active_parts
+        return source_parts
+
+    def select(self, windows, start, end, batch_size):
+        '''
+        Selects the windows to separate from a range of windows, so that they can be passed to run_fn in full batches.
+        :param windows: Mixture windows [n_windows, input_time_frames, n_channels], e.g. from get_windows
+        :param start: First window of the range
+        :param end: End of the range (exclusive)
+        :param batch_size: Number of windows the caller passes to run_fn at once
+        :return: Indices of the windows at or above the threshold
+        '''
+        # Energies are computed batch by batch, so that overlapping windows are not all copied at once
+        active = np.concatenate([get_window_energy(windows[pos:min(pos + batch_size, end)]) >= self.threshold
+                                 for pos in range(start, end, batch_size)])
+        indices = start + np.flatnonzero(active)
+        self.num_windows += end - start
+        self.num_skipped += end - start - len(indices)
+        self.num_batches += (end - start + batch_size - 1) // batch_size
+        self.num_run_batches += (len(indices) + batch_size - 1) // batch_size
+        return indices
+
+    def summary(self):
+        return "Skipped " + str(self.num_skipped) + " of " + str(self.num_windows) + " windows below " + str(self.threshold) + \
+               " dB, separated " + str(self.num_run_batches) + " of " + str(self.num_batches) + " batches"
+
+def get_silence_skipping_run_fn(model_config, run_fn, output_time_frames):
+    '''
+    :return: run_fn wrapped into a SilenceSkipper if model_config["inference_silence_threshold"] is set, otherwise run_fn
+    '''
+    if model_config.get("inference_silence_threshold") is None:
+        return run_fn
+    return SilenceSkipper(run_fn, model_config["inference_silence_threshold"], model_config["num_sources"], output_time_frames)
 
-    input_time_frames = sep_input_shape[1]
-    output_time_frames = sep_output_shape[1]
+def get_windows(mix_audio_padded, input_time_frames, output_time_frames):
+    '''
+    Returns all inference windows of a padded mixture as read-only strided view, without copying the audio.
+    :param mix_audio_padded: C-contiguous mixture [n_frames, n_channels], padded by the separator context on both sides
+    :return: Windows [n_windows, input_time_frames, n_channels], window i starts at sample i * output_time_frames
+    '''
+    num_windows = (mix_audio_padded.shape[0] - input_time_frames) // output_time_frames + 1
+    frame_stride, channel_stride = mix_audio_padded.strides
+    return as_strided(mix_audio_padded, shape=(num_windows, input_time_frames, mix_audio_padded.shape[1]),
+                      strides=(output_time_frames * frame_stride, frame_stride, channel_stride), writeable=False)
+
+def predict_track_fn(model_config, run_fn, mix_audio, mix_sr, input_time_frames, output_time_frames, batch_size=1):
+    '''
+    Outputs source estimates for a given input mixture signal like predict_track, for any implementation of the separator.
+    :param model_config: Model configuration dictionary
+    :param run_fn: Function mapping mixture windows [n_windows, input_time_frames, n_channels] with n_windows <= batch_size to the list of source estimates [n_windows, output_time_frames, n_channels].
+    If it is a SilenceSkipper, only the windows it selects are separated, in full batches
+    :param mix_audio: [n_frames, n_channels] audio signal (numpy array)
+    :param mix_sr: Sampling rate of mix_audio
+    :param input_time_frames: Input length of the separator
+    :param output_time_frames: Output length of the separator
+    :param batch_size: Maximum number of windows passed to run_fn at once
+    :return: List of source estimates [n_frames, n_channels] at the model sampling rate
+    '''
+    mix_audio = prepare_mix(model_config, mix_audio, mix_sr).astype(np.float32)
+
+    # Preallocate source predictions (same shape as input mixture, rounded up to whole output windows)
+    track_time_frames = mix_audio.shape[0]
+    num_windows = max(1, (track_time_frames + output_time_frames - 1) // output_time_frames)
+    source_time_frames = num_windows * output_time_frames
+    source_preds = [np.zeros((source_time_frames, mix_audio.shape[1]), np.float32) for _ in range(model_config["num_sources"])]
 
     # Pad mixture across time at beginning and end so that neural network can make prediction at the beginning and end of signal
-    pad_time_frames = (input_time_frames - output_time_frames) / 2
-    mix_audio_padded = np.pad(mix_audio, [(pad_time_frames, pad_time_frames), (0,0)], mode="constant", constant_values=0.0)
+    # The end is padded further up to the last output window
+    pad_time_frames = (input_time_frames - output_time_frames) // 2
+    mix_audio_padded = np.pad(mix_audio, [(pad_time_frames, pad_time_frames + source_time_frames - track_time_frames), (0,0)], mode="constant", constant_values=0.0)
+    windows = get_windows(mix_audio_padded, input_time_frames, output_time_frames)
+    separate_windows(run_fn, windows, 0, num_windows, batch_size, source_preds)
+    return [source_pred[:track_time_frames] for source_pred in source_preds]
+
+def separate_windows(run_fn, windows, start, end, batch_size, source_preds):
+    '''
+    Separates a range of windows in batches and writes the estimates into the source buffers, window i to frames
+    i * output_time_frames to (i + 1) * output_time_frames. Windows skipped by a SilenceSkipper keep their buffer content.
+    :param run_fn: Function as passed to predict_track_fn
+    :param windows: Mixture windows [n_windows, input_time_frames, n_channels]
+    :param start: First window to separate
+    :param end: End of the window range (exclusive)
+    :param batch_size: Maximum number of windows passed to run_fn at once
+    :param source_preds: Source buffers [n_frames, n_channels] per source, or one array [n_sources, n_frames, n_channels]
+    '''
+    if isinstance(run_fn, SilenceSkipper):
+        # Active windows of the whole range are gathered into full batches
+        indices = run_fn.select(windows, start, end, batch_size)
+        run_fn = run_fn.run_fn
+        batches = [indices[pos:pos + batch_size] for pos in range(0, len(indices), batch_size)]
+    else:
+        batches = [np.arange(pos, min(pos + batch_size, end)) for pos in range(start, end, batch_size)]
+
+    for batch in batches:
+        # Consecutive windows are passed as view and their output windows are adjacent in the source buffers
+        contiguous = batch[-1] - batch[0] + 1 == len(batch)
+        source_parts = run_fn(windows[batch[0]:batch[-1] + 1] if contiguous else windows[batch])
+        for i, parts in enumerate(source_parts):
+            output_time_frames = parts.shape[1]
+            if contiguous:
+                source_preds[i][batch[0] * output_time_frames:(batch[-1] + 1) * output_time_frames] = parts.reshape([-1, parts.shape[2]])
+            else:
+                for window, part in zip(batch, parts):
+                    source_preds[i][window * output_time_frames:(window + 1) * output_time_frames] = part
+
+def predict_track_streaming(model_config, sess, mix_audio, mix_sr, streamer):
+    '''
+    Outputs source estimates like predict_track, but moves the inference window by the hop size of a streaming separator
+    and only computes the new part of the window in each step.
+    :param model_config: Model configuration dictionary
+    :param sess: Tensorflow session used to run the network inference
+    :param mix_audio: [n_frames, n_channels] audio signal (numpy array)
+    :param mix_sr: Sampling rate of mix_audio
+    :param streamer: Built StreamingUnetAudioSeparator
+    :return: List of source estimates [n_frames, n_channels] at the model sampling rate
+    '''
+    mix_audio = prepare_mix(model_config, mix_audio, mix_sr)
 
-    # Iterate over mixture magnitudes, fetch network rpediction
-    for source_pos in range(0, source_time_frames, output_time_frames):
-        # If this output patch would reach over the end of the source spectrogram, set it so we predict the very end of the output, then stop
-        if source_pos + output_time_frames > source_time_frames:
-            source_pos = source_time_frames - output_time_frames
+    input_time_frames = streamer.input_shape[1]
+    output_time_frames = streamer.output_length
+    hop = streamer.hop
 
-        # Prepare mixture excerpt by selecting time interval
-        mix_part = mix_audio_padded[source_pos:source_pos + input_time_frames,:]
-        mix_part = np.expand_dims(mix_part, axis=0)
+    # The first window yields output_time_frames estimates, every following step hop more
+    track_time_frames = mix_audio.shape[0]
+    num_steps = max(0, int(np.ceil(float(track_time_frames - output_time_frames) / hop)))
+    source_time_frames = output_time_frames + num_steps * hop
+    source_preds = [np.zeros((source_time_frames, mix_audio.shape[1]), np.float32) for _ in range(model_config["num_sources"])]
 
-        source_parts = sess.run(separator_sources, feed_dict={mix_context: mix_part})
+    pad_time_frames = (input_time_frames - output_time_frames) // 2
+    mix_audio_padded = np.pad(mix_audio, [(pad_time_frames, pad_time_frames + source_time_frames - track_time_frames), (0,0)], mode="constant", constant_values=0.0)
 
-        # Save predictions
-        # source_shape = [1, freq_bins, acc_mag_part.shape[2], num_chan]
+    source_parts = sess.run([streamer.init_op] + streamer.init_outputs, feed_dict={streamer.init_input: mix_audio_padded[np.newaxis, :input_time_frames]})[1:]
+    for i in range(model_config["num_sources"]):
+        source_preds[i][:output_time_frames] = source_parts[i][0, :, :]
+
+    for step in range(1, num_steps + 1):
+        input_end = input_time_frames + step * hop
+        source_parts = sess.run(streamer.step_outputs, feed_dict={streamer.step_input: mix_audio_padded[np.newaxis, input_end - hop:input_end]})
+        source_end = output_time_frames + step * hop
         for i in range(model_config["num_sources"]):
-            source_preds[i][source_pos:source_pos + output_time_frames] = source_parts[i][0, :, :]
+            source_preds[i][source_end - hop:source_end] = source_parts[i][0, :, :]
 
-    return source_preds
+    return [source_pred[:track_time_frames] for source_pred in source_preds]
 
 
-def compute_mean_metrics(json_folder, compute_averages=True):
-    files = glob.glob(os.path.join(json_folder, "*.json"))
-    sdr_inst_list = None
-    for path in files:
-        #print(path)
-        with open(path, "r") as f:
-            js = json.load(f)
-
-        if sdr_inst_list is None:
-            sdr_inst_list = [list() for _ in range(len(js["targets"]))]
+def evaluate_tracks(model_config, load_model, tracks, output_dir, num_workers=2, max_pending=2):
+    '''
+    Separates and evaluates MUSDB tracks like predict, but builds the separator only once and overlaps the work of
+    consecutive tracks: worker threads decode and resample upcoming mixtures while the current one is separated, and
+    a background thread upsamples the estimates, evaluates them with museval and writes the scores to output_dir.
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path, not used if model_config["export_dir"] or model_config["tflite_model"] is set
+    :param tracks: List of MUSDB track objects
+    :param output_dir: Folder for the museval scores
+    :param num_workers: Number of decoding threads
+    :param max_pending: Maximum number of decoded tracks and of unevaluated estimates held in memory each
+    :return: List of museval scores, one per track
+    '''
+    if model_config.get("inference_processes") is not None:
+        # Windows of each track are separated by several processes
+        predictor = ParallelPredictor(model_config, load_model, model_config["inference_processes"])
+        predict_fn, close_fn = predictor, predictor.close
+    else:
+        run_fn, sep_input_shape, sep_output_shape, close_fn = load_separator(model_config, load_model)
+        predict_fn = lambda mix_audio, mix_sr: predict_track_fn(model_config, run_fn, mix_audio, mix_sr, sep_input_shape[1], sep_output_shape[1], sep_input_shape[0])
+
+    def load(track):
+        return prepare_mix(model_config, track.audio, track.rate), track.rate, track.audio.shape[1]
+
+    def evaluate(track, separator_preds, orig_sr, mix_channels):
+        estimates = make_estimates(model_config, separator_preds, orig_sr, mix_channels)
+        scores = museval.eval_mus_track(track, estimates, output_dir=output_dir)
+        print(scores)
+        return scores
+
+    evaluator = Pipeline.BackgroundWorker(evaluate, max_pending)
+    try:
+        for track, (mix_audio, orig_sr, mix_channels) in Pipeline.prefetch(tracks, load, num_workers, max_pending):
+            separator_preds = predict_fn(mix_audio, model_config["expected_sr"])
+            evaluator.put(track, separator_preds, orig_sr, mix_channels)
+        if model_config.get("inference_silence_threshold") is not None:
+            print(predict_fn.summary() if isinstance(predict_fn, ParallelPredictor) else run_fn.summary())
+    finally:
+        results = evaluator.close()
+        close_fn()
+    return results
+
+def get_separator_shapes(model_config):
+    '''
+    Input and output shape of the separator used for prediction, without loading it: the shapes of the exported or
+    quantized separator if model_config["export_dir"] or model_config["tflite_model"] is set, otherwise the planned
+    inference window and batch size.
+    :return: Input shape, output shape
+    '''
+    if model_config.get("export_dir") is not None:
+        with tf.gfile.GFile(os.path.join(model_config["export_dir"], Export.CONFIG_FILE), "r") as f:
+            description = json.load(f)
+        return description["input_shape"], description["output_shape"]
+    if model_config.get("tflite_model") is not None:
+        with open(model_config["tflite_model"] + ".json", "r") as f:
+            description = json.load(f)
+        return description["input_shape"], description["output_shape"]
+    separator_class = Models.Separators.get_separator(model_config)
+    num_frames = Planner.get_inference_frames(model_config, separator_class)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array([1, num_frames, 0]))
+    sep_input_shape[0] = sep_output_shape[0] = Planner.get_inference_batch_size(model_config, separator_class, num_frames)
+    return sep_input_shape, sep_output_shape
+
+def load_separator(model_config, load_model, num_threads=None):
+    '''
+    Loads the separator used for prediction once: the exported separator if model_config["export_dir"] is set, the
+    quantized separator if model_config["tflite_model"] is set, otherwise the separator graph restored from the
+    checkpoint in a new graph and session.
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path, not used if model_config["export_dir"] or model_config["tflite_model"] is set
+    :param num_threads: Number of threads Tensorflow uses for the separator, None for all cores
+    :return: run_fn for predict_track_fn, input shape, output shape and a function releasing the separator
+    '''
+    if model_config.get("export_dir") is not None:
+        if num_threads is None:
+            inference_separator = Export.load(model_config["export_dir"], model_config.get("xla", False))
+            run_fn = get_silence_skipping_run_fn(model_config, inference_separator, inference_separator.output_shape[1])
+            return run_fn, inference_separator.input_shape, inference_separator.output_shape, lambda: None
+        session_config = Export.get_session_config(model_config.get("xla", False))
+        session_config.intra_op_parallelism_threads = session_config.inter_op_parallelism_threads = num_threads
+        inference_separator = Export.InferenceSeparator(model_config["export_dir"], session_config, model_config.get("xla", False))
+        run_fn = get_silence_skipping_run_fn(model_config, inference_separator, inference_separator.output_shape[1])
+        return run_fn, inference_separator.input_shape, inference_separator.output_shape, inference_separator.close
+
+    if model_config.get("tflite_model") is not None:
+        tflite_separator = Quantize.TFLiteSeparator(model_config["tflite_model"], num_threads)
+        run_fn = get_silence_skipping_run_fn(model_config, tflite_separator, tflite_separator.output_shape[1])
+        return run_fn, tflite_separator.input_shape, tflite_separator.output_shape, lambda: None
+
+    separator_class = Models.Separators.get_separator(model_config)
+    sep_input_shape, sep_output_shape = get_separator_shapes(model_config)
+    session_config = None
+    if num_threads is not None:
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=num_threads)
+    graph = tf.Graph()
+    with graph.as_default():
+        mix_context = tf.placeholder(tf.float32, [int(d) for d in sep_input_shape])
+        separator_sources = separator_class.get_output(mix_context, False, reuse=False)
+        sess = tf.Session(graph=graph, config=session_config)
+        tf.train.Saver(tf.global_variables()).restore(sess, load_model)
+    run_fn = get_silence_skipping_run_fn(model_config, get_session_run_fn(sess, separator_sources, mix_context), sep_output_shape[1])
+    return run_fn, sep_input_shape, sep_output_shape, sess.close
+
+# Separator of a window worker process of ParallelPredictor, loaded once by _init_window_worker
+_window_worker = dict()
+
+def _init_window_worker(model_config, load_model, num_threads):
+    _window_worker["separator"] = load_separator(model_config, load_model, num_threads)
+
+def _predict_worker_windows(mix_path, mix_shape, sources_path, sources_shape, window_start, window_end):
+    # Separates the windows window_start to window_end (exclusive) of the shared mixture into the shared source buffer
+    run_fn, sep_input_shape, sep_output_shape, _ = _window_worker["separator"]
+    input_time_frames, output_time_frames, batch_size = sep_input_shape[1], sep_output_shape[1], sep_input_shape[0]
+    mix_audio_padded = np.memmap(mix_path, np.float32, "r", shape=mix_shape)
+    source_preds = np.memmap(sources_path, np.float32, "r+", shape=sources_shape)
+    windows = get_windows(mix_audio_padded, input_time_frames, output_time_frames)
+    counts = _get_skip_counts(run_fn)
+    separate_windows(run_fn, windows, window_start, window_end, batch_size, source_preds)
+    source_preds.flush()
+    # Skipped windows, needed batches and separated batches of this call
+    return [after - before for before, after in zip(counts, _get_skip_counts(run_fn))]
+
+def _get_skip_counts(run_fn):
+    # Number of skipped windows, batches needed and batches run so far by a SilenceSkipper
+    if isinstance(run_fn, SilenceSkipper):
+        return [run_fn.num_skipped, run_fn.num_batches, run_fn.num_run_batches]
+    return [0, 0, 0]
+
+class ParallelPredictor:
+    '''
+    Separates single tracks with a pool of processes that each load the separator once. The windows of a track are
+    split into contiguous ranges that the processes separate independently. The mixture and the source estimates are
+    shared through memory-mapped files, so no audio is pickled between processes. Calling it with a mixture returns
+    the same estimates as predict_track_fn.
+    '''
 
-        for i in range(len(js["targets"])):
-            sdr_inst_list[i].extend([np.float(f['metrics']["SDR"]) for f in js["targets"][i]["frames"]])
+    def __init__(self, model_config, load_model, num_processes=4, tmp_dir=None, ranges_per_process=4):
+        '''
+        :param model_config: Model configuration dictionary
+        :param load_model: Checkpoint path, not used if model_config["export_dir"] or model_config["tflite_model"] is set
+        :param num_processes: Number of worker processes
+        :param tmp_dir: Folder for the shared buffers, None for the system default. A RAM-backed folder like /dev/shm avoids disk writes
+        :param ranges_per_process: Number of window ranges per process and track, more ranges balance the load better
+        '''
+        self.model_config = model_config
+        self.num_processes = num_processes
+        self.tmp_dir = tmp_dir
+        self.ranges_per_process = ranges_per_process
+        self.sep_input_shape, self.sep_output_shape = get_separator_shapes(model_config)
+        self.num_windows = 0
+        self.num_skipped = 0 # Windows skipped by the SilenceSkipper of the workers, if inference_silence_threshold is set
+        self.num_batches = 0 # Batches needed to separate all windows
+        self.num_run_batches = 0 # Batches the workers actually separated
+        # Each process uses its share of the cores. Worker processes build their own Tensorflow graph, so no session may exist in this process before forking
+        num_threads = max(1, multiprocessing.cpu_count() // num_processes)
+        self.pool = multiprocessing.Pool(num_processes, _init_window_worker, (model_config, load_model, num_threads))
+
+    def __call__(self, mix_audio, mix_sr):
+        '''
+        :param mix_audio: [n_frames, n_channels] audio signal (numpy array)
+        :param mix_sr: Sampling rate of mix_audio
+        :return: List of source estimates [n_frames, n_channels] at the model sampling rate
+        '''
+        input_time_frames, output_time_frames, batch_size = self.sep_input_shape[1], self.sep_output_shape[1], self.sep_input_shape[0]
+        mix_audio = prepare_mix(self.model_config, mix_audio, mix_sr).astype(np.float32)
+        track_time_frames = mix_audio.shape[0]
+        num_windows = max(1, (track_time_frames + output_time_frames - 1) // output_time_frames)
+        source_time_frames = num_windows * output_time_frames
+        pad_time_frames = (input_time_frames - output_time_frames) // 2
+
+        buffer_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            # Padded mixture as in predict_track_fn, written once to the shared buffer
+            mix_path = os.path.join(buffer_dir, "mix.dat")
+            mix_shape = (pad_time_frames + source_time_frames + pad_time_frames, mix_audio.shape[1])
+            mix_audio_padded = np.memmap(mix_path, np.float32, "w+", shape=mix_shape)
+            mix_audio_padded[pad_time_frames:pad_time_frames + track_time_frames] = mix_audio
+            mix_audio_padded.flush()
+            del mix_audio_padded
+            sources_path = os.path.join(buffer_dir, "sources.dat")
+            sources_shape = (self.model_config["num_sources"], source_time_frames, mix_audio.shape[1])
+            np.memmap(sources_path, np.float32, "w+", shape=sources_shape).flush()
+
+            # Contiguous window ranges of whole batches
+            num_batches = (num_windows + batch_size - 1) // batch_size
+            num_ranges = min(num_batches, self.num_processes * self.ranges_per_process)
+            bounds = [min(num_windows, (num_batches * r // num_ranges) * batch_size) for r in range(num_ranges + 1)]
+            tasks = [(mix_path, mix_shape, sources_path, sources_shape, bounds[r], bounds[r + 1]) for r in range(num_ranges)]
+            for result in [self.pool.apply_async(_predict_worker_windows, task) for task in tasks]:
+                num_skipped, num_batches, num_run_batches = result.get()
+                self.num_skipped += num_skipped
+                self.num_batches += num_batches
+                self.num_run_batches += num_run_batches
+            self.num_windows += num_windows
+
+            source_preds = np.memmap(sources_path, np.float32, "r", shape=sources_shape)
+            separator_preds = [np.array(source_preds[i, :track_time_frames]) for i in range(sources_shape[0])]
+            del source_preds
+        finally:
+            shutil.rmtree(buffer_dir)
+        return separator_preds
+
+    def summary(self):
+        return "Skipped " + str(self.num_skipped) + " of " + str(self.num_windows) + " windows below " + str(self.model_config.get("inference_silence_threshold")) + \
+               " dB, separated " + str(self.num_run_batches) + " of " + str(self.num_batches) + " batches"
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# Sub-folder of a folder of museval JSON files holding their metrics store
+METRICS_STORE_DIR = ".metrics"
+
+# Settings of the model configuration that change the estimates, and thereby the cached evaluation results. The
+# separator files themselves (checkpoint, export or quantized model) are identified by get_model_hash
+PREDICTION_KEYS = ["task", "num_sources", "mono_downmix", "expected_sr", "num_frames", "inference_num_frames", "inference_memory_budget",
+                   "inference_batch_size", "inference_silence_threshold", "streaming_hop", "network", "num_layers", "num_initial_filters", "num_filters", "filter_size", "merge_filter_size", "bottleneck_dilations",
+                   "bottleneck_filter_size", "input_context", "upsampling", "output_type", "precision"]
+
+def get_model_hash(model_config, load_model):
+    '''
+    Hashes the contents of the separator files used for prediction (see load_separator): the export directory if
+    model_config["export_dir"] is set, the quantized model if model_config["tflite_model"] is set, otherwise all files
+    of the checkpoint load_model. Renamed or copied checkpoints keep their hash.
+    :return: Hex digest
+    '''
+    if model_config.get("export_dir") is not None:
+        paths = [os.path.join(model_config["export_dir"], name) for name in [Export.GRAPH_FILE, Export.CONFIG_FILE]]
+    elif model_config.get("tflite_model") is not None:
+        paths = [model_config["tflite_model"], model_config["tflite_model"] + ".json"]
+    else:
+        paths = sorted(tf.gfile.Glob(load_model + ".index") + tf.gfile.Glob(load_model + ".data-*"))
+    assert len(paths) > 0
+    digest = hashlib.sha1()
+    for path in paths:
+        with tf.gfile.GFile(path, "rb") as f:
+            while True:
+                chunk = f.read(1 << 24)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def get_cache_dir(cache_dir, model_config, load_model, win, hop):
+    '''
+    Folder of the cached evaluation results of a separator for the given evaluation parameters. It contains one museval
+    JSON file per track in a sub-folder per subset, which can be read by compute_mean_metrics, and params.json.
+    '''
+    params = {"win": win, "hop": hop, "mode": "v4"}
+    params.update((key, model_config.get(key)) for key in PREDICTION_KEYS)
+    params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, get_model_hash(model_config, load_model), params_hash)
+    if not os.path.exists(path):
+        os.makedirs(path)
+        with open(os.path.join(path, "params.json"), "w") as f:
+            json.dump(params, f, indent=2, sort_keys=True)
+    return path
+
+# Separator and tracks of an evaluation worker process, loaded once by _init_worker
+_worker = dict()
+
+def _init_worker(model_config, load_model, musdb_path, subset, win, hop, reference_cache_dir, num_threads):
+    tracks = musdb.DB(root_dir=musdb_path).load_mus_tracks(subsets=[subset])
+    _worker["tracks"] = dict((track.name, track) for track in tracks)
+    _worker["separator"] = load_separator(model_config, load_model, num_threads)
+    _worker["config"] = (model_config, win, hop, reference_cache_dir)
+
+def _evaluate_worker_track(name):
+    model_config, win, hop, reference_cache_dir = _worker["config"]
+    run_fn, sep_input_shape, sep_output_shape, _ = _worker["separator"]
+    track = _worker["tracks"][name]
+    separator_preds = predict_track_fn(model_config, run_fn, track.audio, track.rate, sep_input_shape[1], sep_output_shape[1], sep_input_shape[0])
+    estimates = make_estimates(model_config, separator_preds, track.rate, track.audio.shape[1])
+    if reference_cache_dir is not None:
+        return name, BSSEval.eval_mus_track(track, estimates, reference_cache_dir, win, hop).json
+    return name, museval.eval_mus_track(track, estimates, win=win, hop=hop).json
+
+def evaluate_parallel(model_config, load_model, musdb_path, subset, cache_dir, num_processes=4, win=1.0, hop=1.0, tracknames=None, reference_cache_dir=None):
+    '''
+    Evaluates MUSDB tracks with a pool of processes that each load the separator once. Scores are cached per
+    separator, evaluation parameters and track (see get_cache_dir), so that only tracks without cached results are
+    separated when an evaluation is repeated or extended to more tracks.
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path, not used if model_config["export_dir"] or model_config["tflite_model"] is set
+    :param musdb_path: MUSDB root folder
+    :param subset: MUSDB subset, "train" or "test"
+    :param cache_dir: Root folder of the result cache
+    :param num_processes: Number of worker processes
+    :param win: Evaluation window length in seconds
+    :param hop: Evaluation hop size in seconds
+    :param tracknames: Names of the tracks to evaluate, None for all tracks of subset
+    :param reference_cache_dir: Folder for the reference statistics of BSSEval, which is then used instead of museval
+    :return: Folder with one museval JSON file per evaluated track
+    '''
+    json_folder = os.path.join(get_cache_dir(cache_dir, model_config, load_model, win, hop), subset)
+    if not os.path.exists(json_folder):
+        os.makedirs(json_folder)
+    if tracknames is None:
+        tracknames = [track.name for track in musdb.DB(root_dir=musdb_path).load_mus_tracks(subsets=[subset])]
+    missing = [name for name in tracknames if not os.path.exists(os.path.join(json_folder, name + ".json"))]
+    print("Evaluating " + str(len(missing)) + " of " + str(len(tracknames)) + " tracks, the others are cached in " + json_folder)
+
+    store = get_metrics_store(json_folder)
+    if len(missing) > 0:
+        # Each process uses its share of the cores. Worker processes build their own Tensorflow graph, so no session may exist in this process before forking
+        num_workers = min(num_processes, len(missing))
+        num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+        pool = multiprocessing.Pool(num_workers, _init_worker, (model_config, load_model, musdb_path, subset, win, hop, reference_cache_dir, num_threads))
+        try:
+            for name, scores_json in pool.imap_unordered(_evaluate_worker_track, missing):
+                # Write to a temporary file first, so interrupted evaluations never leave partial cache entries
+                path = os.path.join(json_folder, name + ".json")
+                with open(path + ".tmp", "w") as f:
+                    f.write(scores_json)
+                os.rename(path + ".tmp", path)
+                store.ingest_file(path, os.path.abspath(json_folder))
+                print("Evaluated " + name)
+        finally:
+            pool.close()
+            pool.join()
+    return json_folder
+
+def quantization_report(model_config, load_model, tflite_path, tracks):
+    '''
+    Compares the float32 separator of a checkpoint with its int8 version written by Quantize.quantize on MUSDB tracks
+    regarding separation time and median SDR over all sources and evaluation frames.
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path
+    :param tflite_path: Path of the quantized separator
+    :param tracks: List of MUSDB track objects
+    :return: List of dictionaries, one per track
+    '''
+    config = dict(model_config)
+    config["precision"] = "float32"
+    separator_class = Models.Separators.get_separator(config)
+    tflite_separator = Quantize.TFLiteSeparator(tflite_path)
+    input_time_frames, output_time_frames = tflite_separator.input_shape[1], tflite_separator.output_shape[1]
+
+    rows = list()
+    with tf.Graph().as_default():
+        mix_context = tf.placeholder(tf.float32, tflite_separator.input_shape)
+        separator_sources = separator_class.get_output(mix_context, False, reuse=False)
+        with tf.Session() as sess:
+            tf.train.Saver(tf.global_variables()).restore(sess, load_model)
+            run_fn = lambda mix_part: sess.run(separator_sources, feed_dict={mix_context: mix_part})
+
+            for track in tracks:
+                row = {"track": track.name}
+                for name, separator_fn in [("float32", run_fn), ("int8", tflite_separator)]:
+                    start = time.time()
+                    separator_preds = predict_track_fn(config, separator_fn, track.audio, track.rate, input_time_frames, output_time_frames)
+                    row[name + "_seconds"] = time.time() - start
+
+                    estimates = make_estimates(config, separator_preds, track.rate, track.audio.shape[1])
+                    names = sorted(estimates.keys())
+                    sdr = museval.evaluate(np.stack([track.targets[n].audio for n in names]), np.stack([estimates[n] for n in names]))[0]
+                    row[name + "_sdr"] = float(np.nanmedian(sdr))
+                rows.append(row)
+    return rows
+
+def print_quantization_report(rows):
+    print("{:<40} {:>12} {:>12} {:>10} {:>10}".format("track", "SDR float32", "SDR int8", "SDR drop", "speed-up"))
+    for row in rows:
+        print("{:<40} {:>12.2f} {:>12.2f} {:>10.2f} {:>9.2f}x".format(
+            row["track"][:40], row["float32_sdr"], row["int8_sdr"], row["float32_sdr"] - row["int8_sdr"], row["float32_seconds"] / row["int8_seconds"]))
+    print("{:<40} {:>12.2f} {:>12.2f} {:>10.2f} {:>9.2f}x".format("mean",
+        np.mean([r["float32_sdr"] for r in rows]), np.mean([r["int8_sdr"] for r in rows]),
+        np.mean([r["float32_sdr"] - r["int8_sdr"] for r in rows]),
+        np.sum([r["float32_seconds"] for r in rows]) / np.sum([r["int8_seconds"] for r in rows])))
+
+def silence_report(model_config, load_model, tracks, thresholds):
+    '''
+    Measures the effect of skipping quiet windows (see SilenceSkipper) on MUSDB tracks: for each threshold the fraction
+    of skipped windows, the separation time and the median SDR over all sources and evaluation frames, next to the
+    separation of all windows. The reference statistics of BSS Eval are computed once per track for all thresholds.
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path, not used if model_config["export_dir"] or model_config["tflite_model"] is set
+    :param tracks: List of MUSDB track objects
+    :param thresholds: List of thresholds in dB relative to full scale
+    :return: List of dictionaries, one per track and threshold, with threshold None for separating all windows
+    '''
+    config = dict(model_config)
+    config["inference_silence_threshold"] = None
+    run_fn, sep_input_shape, sep_output_shape, close_fn = load_separator(config, load_model)
+    input_time_frames, output_time_frames, batch_size = sep_input_shape[1], sep_output_shape[1], sep_input_shape[0]
+
+    rows = list()
+    try:
+        for track in tracks:
+            statistics = None
+            for threshold in [None] + list(thresholds):
+                separator_fn = run_fn if threshold is None else SilenceSkipper(run_fn, threshold, config["num_sources"], output_time_frames)
+                start = time.time()
+                separator_preds = predict_track_fn(config, separator_fn, track.audio, track.rate, input_time_frames, output_time_frames, batch_size)
+                seconds = time.time() - start
+
+                estimates = make_estimates(config, separator_preds, track.rate, track.audio.shape[1])
+                names = sorted(estimates.keys())
+                references = np.stack([track.targets[n].audio for n in names])
+                if statistics is None:
+                    statistics = BSSEval.get_reference_statistics(references)
+                sdr = BSSEval.bss_eval(references, np.stack([estimates[n] for n in names]), statistics=statistics)[0]
+                rows.append({"track": track.name,
+                             "threshold": threshold,
+                             "seconds": seconds,
+                             "sdr": float(np.nanmedian(sdr)),
+                             "skipped": 0.0 if threshold is None else float(separator_fn.num_skipped) / max(separator_fn.num_windows, 1)})
+    finally:
+        close_fn()
+    return rows
+
+def get_silence_threshold(rows, tolerance):
+    '''
+    :param rows: Result of silence_report
+    :param tolerance: Largest accepted change of the median SDR of any track, in dB
+    :return: Highest threshold of the report that changes no track by more than tolerance, None if there is none
+    '''
+    baseline = dict((row["track"], row["sdr"]) for row in rows if row["threshold"] is None)
+    accepted = None
+    for threshold in sorted(set(row["threshold"] for row in rows if row["threshold"] is not None)):
+        if all(abs(row["sdr"] - baseline[row["track"]]) <= tolerance for row in rows if row["threshold"] == threshold):
+            accepted = threshold
+    return accepted
+
+def print_silence_report(rows, tolerance):
+    baseline = dict((row["track"], row) for row in rows if row["threshold"] is None)
+    print("{:>10} {:>10} {:>14} {:>14} {:>10}".format("threshold", "skipped", "mean SDR diff", "max SDR diff", "speed-up"))
+    thresholds = [None] + sorted(set(row["threshold"] for row in rows if row["threshold"] is not None))
+    for threshold in thresholds:
+        selected = [row for row in rows if row["threshold"] == threshold]
+        diffs = [row["sdr"] - baseline[row["track"]]["sdr"] for row in selected]
+        print("{:>10} {:>9.1f}% {:>14.4f} {:>14.4f} {:>9.2f}x".format("none" if threshold is None else str(threshold),
+            100.0 * np.mean([row["skipped"] for row in selected]), np.mean(diffs), np.max(np.abs(diffs)),
+            np.sum([baseline[row["track"]]["seconds"] for row in selected]) / np.sum([row["seconds"] for row in selected])))
+    threshold = get_silence_threshold(rows, tolerance)
+    if threshold is None:
+        print("No threshold keeps the SDR of all tracks within " + str(tolerance) + " dB")
+    else:
+        print("Highest threshold keeping the SDR of all tracks within " + str(tolerance) + " dB: " + str(threshold) + " dB")
 
-    #return np.array(sdr_acc), np.array(sdr_voc)
-    sdr_inst_list = [np.array(sdr) for sdr in sdr_inst_list]
+def get_metrics_store(json_folder):
+    '''
+    Returns the metrics store of a folder of museval JSON files, after ingesting files that are new or changed since
+    the last call. The evaluated checkpoint is named by the absolute folder path.
+    '''
+    store = MetricsStore.MetricsStore(os.path.join(json_folder, METRICS_STORE_DIR))
+    store.ingest_folder(json_folder, os.path.abspath(json_folder))
+    return store
 
+def compute_mean_metrics(json_folder, compute_averages=True):
+    store = get_metrics_store(json_folder)
+    checkpoint = os.path.abspath(json_folder)
     if compute_averages:
-        return [(np.nanmedian(sdr), np.nanmedian(np.abs(sdr - np.nanmedian(sdr))), np.nanmean(sdr), np.nanstd(sdr)) for sdr in sdr_inst_list]
+        return [(median, mad, mean, std) for _, median, mad, mean, std in store.summary("SDR", checkpoint)]
     else:
-        return sdr_inst_list
+        return [sdr for _, sdr in store.select("SDR", checkpoint)]
 
 def draw_violin_sdr(json_folder):
-    acc, voc = compute_mean_metrics(json_folder, compute_averages=False)
-    acc = acc[~np.isnan(acc)]
-    voc = voc[~np.isnan(voc)]
+    acc, voc = [sdr for _, sdr in get_metrics_store(json_folder).violin_data("SDR", os.path.abspath(json_folder))]
     data = [acc, voc]
     inds = [1,2]
 
     fig, ax = plt.subplots()
     ax.violinplot(data, showmeans=True, showmedians=False, showextrema=False, vert=False)
-    ax.scatter(np.percentile(data, 50, axis=1),inds, marker="o", color="black")
+    ax.scatter([np.percentile(d, 50) for d in data],inds, marker="o", color="black")
     ax.set_title("Segment-wise SDR distribution")
     ax.vlines([np.min(acc), np.min(voc), np.max(acc), np.max(voc)], [0.8, 1.8, 0.8, 1.8], [1.2, 2.2, 1.2, 2.2], color="blue")
     ax.hlines(inds, [np.min(acc), np.min(voc)], [np.max(acc), np.max(voc)], color='black', linestyle='--', lw=1, alpha=0.5)
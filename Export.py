@@ -0,0 +1,149 @@
+'''
+Self-contained inference artifacts of the separator. An export directory holds the frozen float32 graph for a fixed
+window shape (separator.pb) and a description of its inputs, outputs and model configuration (config.json), so that
+prediction does not need to rebuild the network or restore a checkpoint. Artifacts are loaded once per process.
+Since window and batch shape are fixed, the graph can be compiled with XLA, which fuses the many small slicing, crop,
+concatenation and interpolation ops of the separator. All ops of the loaded graph are then explicitly marked for
+compilation (see mark_for_xla), which unlike the session's global JIT level also compiles on CPU without setting
+TF_XLA_FLAGS=--tf_xla_cpu_global_jit, but needs a Tensorflow build with XLA. Compiled executables are cached by the
+session of the loaded artifact, so compilation happens on the first call of each process.
+'''
+
+import os
+import json
+import numpy as np
+import tensorflow as tf
+
+import Models.Separators
+import Planner
+
+GRAPH_FILE = "separator.pb"
+CONFIG_FILE = "config.json"
+
+def _to_json(value):
+    # Sacred configurations can contain numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Not JSON serializable: " + repr(value))
+
+def get_session_config(xla=False):
+    '''
+    Session configuration for running exported separators
+    :param xla: Whether to JIT-compile the whole graph with XLA. On CPU, the global JIT level only compiles if the
+    process runs with TF_XLA_FLAGS=--tf_xla_cpu_global_jit, so InferenceSeparator additionally marks the ops of the graph
+    :return: ConfigProto
+    '''
+    config = tf.ConfigProto()
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+def mark_for_xla(graph_def):
+    '''
+    Marks all ops of a graph except its inputs for XLA compilation into one cluster, like building them inside
+    tf.contrib.compiler.jit.experimental_jit_scope. Explicitly marked ops are compiled on CPU and GPU.
+    :param graph_def: GraphDef, modified in place
+    :return: graph_def
+    '''
+    for node in graph_def.node:
+        if node.op != "Placeholder":
+            node.attr["_XlaCompile"].b = True
+            node.attr["_XlaScope"].s = b"jit_scope_separator"
+    return graph_def
+
+def export(model_config, checkpoint, export_dir, batch_size=1):
+    '''
+    Freezes the (unconditional) separator of a checkpoint for the configured inference window and writes it together
+    with its description to export_dir. The graph always computes in float32, for CPU inference.
+    :param model_config: Model configuration dictionary
+    :param checkpoint: Checkpoint path
+    :param export_dir: Folder to write the artifact to
+    :param batch_size: Number of windows per forward pass
+    :return: Description of the artifact as written to config.json
+    '''
+    config = dict(model_config)
+    config["precision"] = "float32"
+    separator = Models.Separators.get_separator(config)
+    num_frames = Planner.get_inference_frames(config, separator, batch_size)
+    input_shape, output_shape = separator.get_padding(np.array([batch_size, num_frames, 0]))
+    input_shape, output_shape = [int(d) for d in input_shape], [int(d) for d in output_shape]
+
+    with tf.Graph().as_default() as graph:
+        mix = tf.placeholder(tf.float32, input_shape, name="mix")
+        separator_sources = separator.get_output(mix, False, reuse=False)
+        outputs = [tf.identity(source, name="source_" + str(i)) for i, source in enumerate(separator_sources)]
+        with tf.Session() as sess:
+            tf.train.Saver(tf.global_variables()).restore(sess, checkpoint)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [output.op.name for output in outputs])
+
+    reader = tf.train.load_checkpoint(checkpoint)
+    step = int(reader.get_tensor("global_step")) if reader.has_tensor("global_step") else 0
+
+    if not tf.gfile.Exists(export_dir):
+        tf.gfile.MakeDirs(export_dir)
+    with tf.gfile.GFile(os.path.join(export_dir, GRAPH_FILE), "wb") as f:
+        f.write(graph_def.SerializeToString())
+    description = {"input_name": mix.name,
+                   "output_names": [output.name for output in outputs],
+                   "input_shape": input_shape,
+                   "output_shape": output_shape,
+                   "checkpoint": checkpoint,
+                   "global_step": step,
+                   "model_config": config}
+    with tf.gfile.GFile(os.path.join(export_dir, CONFIG_FILE), "w") as f:
+        json.dump(description, f, indent=2, default=_to_json)
+    return description
+
+class InferenceSeparator:
+    '''
+    Separator loaded from an export directory, with its own graph and session. Calling it with mixture windows
+    [n_windows, input_samples, num_channels] returns the list of source estimates [n_windows, output_samples, num_channels],
+    so it can be used as run_fn of Evaluate.predict_track_fn. Fewer windows than the exported batch size are padded with zeros.
+    '''
+
+    def __init__(self, export_dir, session_config=None, xla=False):
+        '''
+        :param export_dir: Folder written by export
+        :param session_config: ConfigProto of the session, see get_session_config
+        :param xla: Whether to compile the graph with XLA, see mark_for_xla
+        '''
+        with tf.gfile.GFile(os.path.join(export_dir, CONFIG_FILE), "r") as f:
+            description = json.load(f)
+        self.input_shape = description["input_shape"]
+        self.output_shape = description["output_shape"]
+        self.global_step = description["global_step"]
+        self.model_config = description["model_config"]
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, GRAPH_FILE), "rb") as f:
+            graph_def.ParseFromString(f.read())
+        if xla:
+            mark_for_xla(graph_def)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.input = self.graph.get_tensor_by_name(description["input_name"])
+        self.outputs = [self.graph.get_tensor_by_name(name) for name in description["output_names"]]
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+
+    def __call__(self, mix_part):
+        num_windows = mix_part.shape[0]
+        assert num_windows <= self.input_shape[0]
+        if num_windows < self.input_shape[0]:
+            mix_part = np.pad(mix_part, [(0, self.input_shape[0] - num_windows), (0, 0), (0, 0)], mode="constant")
+        return [output[:num_windows] for output in self.sess.run(self.outputs, feed_dict={self.input: mix_part})]
+
+    def close(self):
+        self.sess.close()
+
+# Artifacts loaded in this process, by export directory and XLA setting
+_loaded = dict()
+
+def load(export_dir, xla=False):
+    '''
+    Returns the InferenceSeparator of an export directory, loading it only on the first call in this process
+    :param xla: Whether to JIT-compile the graph with XLA, see get_session_config
+    '''
+    if (export_dir, xla) not in _loaded:
+        _loaded[(export_dir, xla)] = InferenceSeparator(export_dir, get_session_config(xla), xla)
+    return _loaded[(export_dir, xla)]
@@ -8,6 +8,8 @@ import skimage.io as io
 import tensorflow as tf
 from soundfile import SoundFile
 
+import Resample
+
 def createSynthAudioBatch(batch_size, num_frames):
     '''
     Create three batches of audio examples [batch_size, freq_bins, time_frames, 1] and return them as a list
@@ -148,7 +150,7 @@ def readWave(audio_path, start_frame, end_frame, mono=True, sample_rate=None, cl
     if sample_rate is not None and sample_rate != audio_sr:
         res_length = int(np.ceil(float(audio.shape[0]) * float(sample_rate) / float(audio_sr)))
         audio = np.pad(audio, [(1, 1), (0,0)], mode="reflect")  # Pad audio first
-        audio = librosa.resample(audio.T, audio_sr, sample_rate, res_type="kaiser_fast").T
+        audio = Resample.resample(audio, audio_sr, sample_rate, "kaiser_fast")
         skip = (audio.shape[0] - res_length) // 2
         audio = audio[skip:skip+res_length,:]
 
@@ -196,7 +198,10 @@ def readAudio(audio_path, offset=0.0, duration=None, mono=True, sample_rate=None
             max_start_pos = audio_duration+2*padding_duration-duration
             if (max_start_pos <= 0.0):  # If audio file is longer than duration of desired section, take all of it, will be padded later
                 print("WARNING: Audio file " + audio_path + " has length " + str(audio_duration) + " but is expected to be at least " + str(duration))
-                return librosa.load(audio_path, sample_rate, mono, res_type='kaiser_fast')  # Return whole audio file
+                audio, audio_sr = librosa.load(audio_path, None, mono)  # Return whole audio file
+                if sample_rate is None:
+                    return audio, audio_sr
+                return Resample.resample(audio, audio_sr, sample_rate, "kaiser_fast", axis=-1), sample_rate
             start_pos = np.random.uniform(0.0,max_start_pos) # Otherwise randomly determine audio section, taking padding on both sides into account
             offset = max(start_pos - padding_duration, 0.0) # Read from this position in audio file
             pad_front_duration = max(padding_duration - start_pos, 0.0)
@@ -291,7 +296,7 @@ def readAudio(audio_path, offset=0.0, duration=None, mono=True, sample_rate=None
 
     # Resample if needed
     if sample_rate is not None and sample_rate != audio_sr:
-        audio = librosa.resample(audio.T, audio_sr, sample_rate, res_type="kaiser_fast").T
+        audio = Resample.resample(audio, audio_sr, sample_rate, "kaiser_fast")
 
     # Clip to [-1,1] if desired
     if clip:
@@ -393,10 +398,11 @@ def getRemainingSpectrum(mix_audio, instrument_audio_list, expected_sr, fftWindo
         except Exception as e:
             print("Could not load " + mix_audio)
 
-    audio, sampleRate = librosa.load(mix_audio, sr=expected_sr)
+    audio, sampleRate = librosa.load(mix_audio, sr=None)
+    audio = Resample.resample(audio, sampleRate, expected_sr)
     for instrument in instrument_audio_list:
-        instrument_audio, _ = librosa.load(instrument, sr=expected_sr)
-        audio -= instrument_audio
+        instrument_audio, instrument_sr = librosa.load(instrument, sr=None)
+        audio -= Resample.resample(instrument_audio, instrument_sr, expected_sr)
     audio = np.maximum(np.minimum(audio, 1.0), -1.0)
     mag, ph = audioFileToSpectrogram(audio, fftWindowSize=fftWindowSize, hopSize=hopSize, buffer=False)
     if buffer:
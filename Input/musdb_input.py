@@ -10,6 +10,8 @@ import os
 import tensorflow as tf
 import functools
 
+import Utils
+
 
 CHANNEL_NAMES = ['.stem_mix.wav', '.stem_vocals.wav', '.stem_bass.wav', '.stem_drums.wav', '.stem_other.wav']
 SAMPLE_RATE = 22050     # Set a fixed sample rate
@@ -44,13 +46,13 @@ class MusDBInput(object):
     Args:
     is_training: `bool` for whether the input is for training
     data_dir: `str` for the directory of the training and validation data
-    use_bfloat16: If True, use bfloat16 precision; else use float32.
+    precision: `str` compute precision of the model ("float32", "bfloat16" or "float16"), audio is cast to it.
     transpose_input: 'bool' for whether to use the double transpose trick # what is that??
     """
 
-    def __init__(self, is_training, data_dir, use_bfloat16=False, transpose_input=False):
+    def __init__(self, is_training, data_dir, precision="float32", transpose_input=False):
         self.is_training = is_training
-        self.use_bfloat16 = use_bfloat16
+        self.dtype = Utils.get_compute_dtype(precision)
         self.data_dir = data_dir
         if self.data_dir == 'null' or self.data_dir == '':
             self.data_dir = None
@@ -96,8 +98,8 @@ class MusDBInput(object):
         audio_data = tf.reshape(audio_data, audio_shape)
         mix, sources = tf.reshape(audio_data[:MIX_WITH_PADDING], tf.stack([MIX_WITH_PADDING, CHANNELS])), \
                        tf.reshape(audio_data[MIX_WITH_PADDING:], tf.stack([NUM_SOURCES, NUM_SAMPLES, CHANNELS]))
-        mix = tf.cast(mix, tf.bfloat16)
-        sources = tf.cast(sources, tf.bfloat16)
+        mix = tf.cast(mix, self.dtype)
+        sources = tf.cast(sources, self.dtype)
         if self.is_training:
             features = {'mix': mix}
         else:
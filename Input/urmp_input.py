@@ -15,6 +15,8 @@ import matplotlib.pyplot as plt
 
 from sklearn.impute import SimpleImputer
 
+import Utils
+
 #bn, cl, db, fl, hn, ob, sax, tba, tbn, tbt, va, vc, vn
 CHANNEL_NAMES = ['.stem_mix.wav', '.stem_bn.wav', '.stem_cl.wav', '.stem_db.wav', '.stem_fl.wav', '.stem_hn.wav', '.stem_ob.wav',
                  '.stem_sax.wav', '.stem_tba.wav', '.stem_tbn.wav', '.stem_tbt.wav', '.stem_va.wav', '.stem_vc.wav', '.stem_vn.wav']
@@ -66,13 +68,13 @@ class URMPInput(object):
     Args:
     is_training: `bool` for whether the input is for training
     data_dir: `str` for the directory of the training and validation data
-    use_bfloat16: If True, use bfloat16 precision; else use float32.
+    precision: `str` compute precision of the model ("float32", "bfloat16" or "float16"), audio and labels are cast to it.
     transpose_input: 'bool' for whether to use the double transpose trick # what is that??
     """
 
-    def __init__(self, mode, data_dir, use_bfloat16=False, transpose_input=False):
+    def __init__(self, mode, data_dir, precision="float32", transpose_input=False):
         self.mode = mode
-        self.use_bfloat16 = use_bfloat16
+        self.dtype = Utils.get_compute_dtype(precision)
         self.data_dir = data_dir
         if self.data_dir == 'null' or self.data_dir == '':
             self.data_dir = None
@@ -127,10 +129,9 @@ class URMPInput(object):
         labels = tf.sparse_tensor_to_dense(parsed['audio/labels'])
         labels = tf.reshape(labels, tf.stack([NUM_SOURCES]))
 
-        if self.use_bfloat16:
-            mix = tf.cast(mix, tf.bfloat16)
-            labels = tf.cast(labels, tf.bfloat16)
-            sources = tf.cast(sources, tf.bfloat16)
+        mix = tf.cast(mix, self.dtype)
+        labels = tf.cast(labels, self.dtype)
+        sources = tf.cast(sources, self.dtype)
         if self.mode == 'train':
             features = {'mix': mix,
                         'labels': labels}
@@ -1,5 +1,6 @@
 import math
 import os
+import sys
 import random
 import multiprocessing
 from multiprocessing import Pool
@@ -12,6 +13,10 @@ import tensorflow as tf
 import librosa
 # from google.cloud import storage
 
+# Resample is in the repository root, which is not on the module path when this script is run as Input/<script>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Resample
+
 
 # flags.DEFINE_string(
 #     'project', os.environ["PROJECT_NAME"], 'Google cloud project id for uploading the dataset.')
@@ -176,7 +181,8 @@ def _process_audio_files_batch(chunk_data):
         # load all wave files into memory and create a buffer
         file_data_cache = list()
         for source in track:
-            data, sr = librosa.core.load(source, sr=SAMPLE_RATE, mono=True)
+            data, sr = librosa.core.load(source, sr=None, mono=True)
+            data, sr = Resample.resample(data, sr, SAMPLE_RATE), SAMPLE_RATE
             file_data_cache.append([track, len(data), data])
 
             # Option 1: use only tf to read and resample audio
@@ -0,0 +1,93 @@
+'''
+Framewise separation metrics computed for all sources and frames of a track at once, as a cheap alternative to
+BSS Eval during validation. Frames follow the framing of museval, and frames in which any reference or estimated
+source is silent are NaN for all sources, like museval reports them.
+'''
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+METRICS = ["SI-SDR", "SNR", "alpha-SNR"]
+
+def pad_or_truncate(references, estimates):
+    '''
+    Brings estimates to the length of the references like museval: longer estimates are cut, shorter ones zero-padded.
+    :param references: Sources [n_sources, n_samples, n_channels]
+    :param estimates: Sources [n_sources, n_samples', n_channels]
+    :return: References and estimates of the same shape
+    '''
+    if estimates.shape[1] > references.shape[1]:
+        estimates = estimates[:, :references.shape[1]]
+    elif estimates.shape[1] < references.shape[1]:
+        estimates = np.pad(estimates, [(0, 0), (0, references.shape[1] - estimates.shape[1]), (0, 0)], mode="constant")
+    return references, estimates
+
+def get_num_frames(num_samples, win, hop):
+    # Number of evaluation frames of museval. A signal shorter than one window is a single, shorter frame
+    if win < num_samples:
+        return int(np.floor(float(num_samples - win + hop) / hop))
+    return 1
+
+def get_frames(signals, win, hop):
+    '''
+    Cuts signals into evaluation frames as a strided view, without copying.
+    :param signals: Sources [n_sources, n_samples, n_channels]
+    :param win: Frame length in samples
+    :param hop: Hop size in samples
+    :return: Frames [n_sources, n_frames, frame_length, n_channels]
+    '''
+    signals = np.ascontiguousarray(signals)
+    if win >= signals.shape[1]:
+        return signals[:, np.newaxis]
+    source_stride, sample_stride, channel_stride = signals.strides
+    return as_strided(signals, shape=(signals.shape[0], get_num_frames(signals.shape[1], win, hop), win, signals.shape[2]),
+                      strides=(source_stride, hop * sample_stride, sample_stride, channel_stride), writeable=False)
+
+def get_silent_frames(frames):
+    '''
+    :param frames: Frames [n_sources, n_frames, frame_length, n_channels]
+    :return: Boolean array [n_frames], True where any source is silent, i.e. its channel sum is zero throughout the frame
+    '''
+    return np.any(np.all(np.sum(frames, axis=3) == 0, axis=2), axis=0)
+
+def _db(numerator, denominator):
+    # Infinite and undefined ratios are NaN, like the quantization of museval scores does it
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = 10.0 * np.log10(numerator / denominator)
+    ratio[~np.isfinite(ratio)] = np.nan
+    return ratio
+
+def framewise_metrics(references, estimates, win=44100, hop=44100):
+    '''
+    Computes framewise SI-SDR, SNR and alpha-SNR of all sources of a track.
+    SI-SDR scales the reference optimally: 10 log10(||a s||^2 / ||a s - e||^2) with a = <e, s> / ||s||^2
+    SNR compares directly: 10 log10(||s||^2 / ||s - e||^2)
+    alpha-SNR scales the estimate optimally like Evaluate.alpha_snr: 10 log10(||s||^2 / ||s - a e||^2) with a = <e, s> / ||e||^2
+    :param references: Reference sources [n_sources, n_samples, n_channels]
+    :param estimates: Estimated sources [n_sources, n_samples', n_channels]
+    :param win: Frame length in samples
+    :param hop: Hop size in samples
+    :return: Dictionary from metric name to array [n_sources, n_frames], NaN in silent frames
+    '''
+    references, estimates = pad_or_truncate(np.asarray(references, np.float64), np.asarray(estimates, np.float64))
+    reference_frames, estimate_frames = get_frames(references, win, hop), get_frames(estimates, win, hop)
+
+    # Energies and correlations of all sources and frames, summed over samples and channels
+    reference_power = np.einsum("sftc,sftc->sf", reference_frames, reference_frames)
+    estimate_power = np.einsum("sftc,sftc->sf", estimate_frames, estimate_frames)
+    inner_prod = np.einsum("sftc,sftc->sf", reference_frames, estimate_frames)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # ||s - e||^2 and the squared norms of the optimally scaled errors, from the inner products
+        error_power = np.maximum(reference_power - 2 * inner_prod + estimate_power, 0.0)
+        reference_scale = inner_prod / reference_power
+        si_error_power = np.maximum(estimate_power - inner_prod * reference_scale, 0.0)
+        alpha_error_power = np.maximum(reference_power - inner_prod * inner_prod / estimate_power, 0.0)
+        metrics = {"SI-SDR": _db(reference_scale * reference_scale * reference_power, si_error_power),
+                   "SNR": _db(reference_power, error_power),
+                   "alpha-SNR": _db(reference_power, alpha_error_power)}
+
+    silent = get_silent_frames(reference_frames) | get_silent_frames(estimate_frames)
+    for values in metrics.values():
+        values[:, silent] = np.nan
+    return metrics
@@ -0,0 +1,185 @@
+'''
+Columnar on-disk store of framewise evaluation metrics. Every row is one frame of one target of one track evaluated
+with one checkpoint, with the museval metrics as float columns. Evaluation results are ingested once, new ones are
+appended as small segments, and queries like medians or violin plot data run vectorised over the columns instead of
+re-reading all museval JSON files.
+'''
+
+import os
+import json
+import glob
+import numpy as np
+
+METRICS = ["SDR", "SIR", "ISR", "SAR"]
+KEY_COLUMNS = ["checkpoint", "track", "target", "frame"]
+MANIFEST_FILE = "manifest.json"
+BASE_DIR = "base"
+# Appended segments are merged into the base columns once there are this many
+MAX_SEGMENTS = 32
+
+class MetricsStore:
+    '''
+    Metrics store in a folder. Checkpoint, track and target names are stored as integer codes, see the manifest.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"checkpoints": [], "tracks": [], "targets": [], "segments": [], "ingested": {}, "next_segment": 0}
+        self._columns = None
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.rename(manifest_path + ".tmp", manifest_path)
+
+    def _code(self, kind, name):
+        names = self.manifest[kind]
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def _rows(self, checkpoint, track, scores):
+        # Columns of the frames of a museval scores dictionary
+        checkpoint_code, track_code = self._code("checkpoints", checkpoint), self._code("tracks", track)
+        keys, values = list(), list()
+        for target in scores["targets"]:
+            target_code = self._code("targets", target["name"])
+            for frame, frame_data in enumerate(target["frames"]):
+                keys.append((checkpoint_code, track_code, target_code, frame))
+                values.append([np.nan if frame_data["metrics"][metric] is None else float(frame_data["metrics"][metric]) for metric in METRICS])
+        columns = dict((name, np.array([key[i] for key in keys], np.int32)) for i, name in enumerate(KEY_COLUMNS))
+        columns["values"] = np.array(values, np.float32).reshape([-1, len(METRICS)])
+        return columns
+
+    def columns(self):
+        '''
+        :return: Dictionary of all rows: integer key columns and "values" [n_rows, len(METRICS)]
+        '''
+        if self._columns is None:
+            parts = list()
+            base_dir = os.path.join(self.path, BASE_DIR)
+            if os.path.exists(base_dir):
+                parts.append(dict((name, np.load(os.path.join(base_dir, name + ".npy"), mmap_mode="r")) for name in KEY_COLUMNS + ["values"]))
+            for segment in self.manifest["segments"]:
+                with np.load(os.path.join(self.path, segment)) as data:
+                    parts.append(dict((name, data[name]) for name in data.files))
+            if len(parts) == 0:
+                parts.append(dict((name, np.zeros([0], np.int32)) for name in KEY_COLUMNS))
+                parts[0]["values"] = np.zeros([0, len(METRICS)], np.float32)
+            self._columns = dict((name, np.concatenate([part[name] for part in parts])) for name in KEY_COLUMNS + ["values"])
+        return self._columns
+
+    def _append(self, columns, replace=None):
+        # Adds rows as new segment. Rows of the (checkpoint, track) pairs in replace are removed first by rewriting the base.
+        if replace:
+            current = self.columns()
+            keep = np.ones(len(current["checkpoint"]), np.bool_)
+            for checkpoint_code, track_code in replace:
+                keep &= ~((current["checkpoint"] == checkpoint_code) & (current["track"] == track_code))
+            self._write_base(dict((name, current[name][keep]) for name in current))
+        segment = "segment_" + str(self.manifest["next_segment"]) + ".npz"
+        np.savez(os.path.join(self.path, segment), **columns)
+        self.manifest["next_segment"] += 1
+        self.manifest["segments"].append(segment)
+        self._columns = None
+        if len(self.manifest["segments"]) > MAX_SEGMENTS:
+            self.compact()
+
+    def _write_base(self, columns):
+        # Replaces the base columns and all segments by the given rows
+        base_dir = os.path.join(self.path, BASE_DIR)
+        columns = dict((name, np.array(values)) for name, values in columns.items()) # Release memory maps of the old base
+        self._columns = None
+        if not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+        for name, values in columns.items():
+            np.save(os.path.join(base_dir, name + ".tmp.npy"), values)
+            os.rename(os.path.join(base_dir, name + ".tmp.npy"), os.path.join(base_dir, name + ".npy"))
+        for segment in self.manifest["segments"]:
+            os.remove(os.path.join(self.path, segment))
+        self.manifest["segments"] = list()
+        self._save_manifest()
+
+    def compact(self):
+        '''
+        Merges all appended segments into the base columns
+        '''
+        self._write_base(self.columns())
+
+    def ingest_scores(self, checkpoint, track, scores):
+        '''
+        Adds the museval scores of one track, replacing earlier scores of the same checkpoint and track.
+        :param checkpoint: Name of the evaluated checkpoint or separator
+        :param track: Track name
+        :param scores: museval scores dictionary (JSON content of an evaluation result)
+        '''
+        key = (checkpoint in self.manifest["checkpoints"] and track in self.manifest["tracks"] and
+               (self.manifest["checkpoints"].index(checkpoint), self.manifest["tracks"].index(track)))
+        self._append(self._rows(checkpoint, track, scores), replace=[key] if key else None)
+        self._save_manifest()
+
+    def ingest_file(self, path, checkpoint):
+        '''
+        Adds a museval JSON file unless it was ingested before and has not changed since.
+        :param path: museval JSON file, named after the track
+        :param checkpoint: Name of the evaluated checkpoint or separator
+        :return: Whether the file was ingested
+        '''
+        key = checkpoint + "|" + os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        if self.manifest["ingested"].get(key) == mtime:
+            return False
+        with open(path, "r") as f:
+            scores = json.load(f)
+        self.manifest["ingested"][key] = mtime
+        self.ingest_scores(checkpoint, os.path.splitext(os.path.basename(path))[0], scores)
+        return True
+
+    def ingest_folder(self, json_folder, checkpoint):
+        '''
+        Adds all museval JSON files of a folder that are new or changed since they were last ingested.
+        :param json_folder: Folder with one museval JSON file per track
+        :param checkpoint: Name of the evaluated checkpoint or separator
+        :return: Number of ingested files
+        '''
+        return sum(self.ingest_file(path, checkpoint) for path in sorted(glob.glob(os.path.join(json_folder, "*.json"))))
+
+    def select(self, metric="SDR", checkpoint=None):
+        '''
+        :param metric: Name in METRICS
+        :param checkpoint: Restrict to this checkpoint, None for all
+        :return: List of (target name, values of all its frames) in the order targets were first ingested
+        '''
+        columns = self.columns()
+        values = columns["values"][:, METRICS.index(metric)]
+        mask = np.ones(len(values), np.bool_)
+        if checkpoint is not None:
+            if checkpoint not in self.manifest["checkpoints"]:
+                return [(target, np.zeros([0], np.float32)) for target in self.manifest["targets"]]
+            mask = columns["checkpoint"] == self.manifest["checkpoints"].index(checkpoint)
+        targets = columns["target"]
+        return [(target, values[mask & (targets == code)]) for code, target in enumerate(self.manifest["targets"])]
+
+    def summary(self, metric="SDR", checkpoint=None):
+        '''
+        :return: List of (target name, median, median absolute deviation, mean, standard deviation), ignoring NaN frames
+        '''
+        rows = list()
+        for target, values in self.select(metric, checkpoint):
+            median = np.nanmedian(values)
+            rows.append((target, median, np.nanmedian(np.abs(values - median)), np.nanmean(values), np.nanstd(values)))
+        return rows
+
+    def violin_data(self, metric="SDR", checkpoint=None):
+        '''
+        :return: List of (target name, values without NaN frames)
+        '''
+        return [(target, values[~np.isnan(values)]) for target, values in self.select(metric, checkpoint)]
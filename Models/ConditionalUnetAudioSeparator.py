@@ -1,133 +1,69 @@
 import tensorflow as tf
 
 import Utils
-from Utils import LeakyReLU
-import numpy as np
-from Models import OutputLayer
+import Models.UnetAudioSeparator
 
-class UnetAudioSeparator:
+class UnetAudioSeparator(Models.UnetAudioSeparator.UnetAudioSeparator):
     '''
-    U-Net separator network for singing voice separation.
-    Uses valid convolutions, so it predicts for the centre part of the input - only certain input and output shapes are therefore possible (see getpadding function)
+    U-Net separator conditioned on the instrument labels of the mixture: the bottleneck feature map is multiplied with
+    the conditioning vector z. Shares encoder, up-sampling path and output layer with the unconditional U-Net.
     '''
 
-    def __init__(self, num_layers, num_initial_filters, upsampling, output_type, context, num_sources, mono, filter_size, merge_filter_size):
-        '''
-        Initialize U-net
-        :param num_layers: Number of down- and upscaling layers in the network
-        '''
-        self.num_layers = num_layers
-        self.num_initial_filters = num_initial_filters
-        self.filter_size = filter_size
-        self.merge_filter_size = merge_filter_size
-        self.upsampling = upsampling
-        self.output_type = output_type
-        self.context = context
-        self.padding = "valid" if context else "same"
-        self.num_sources = num_sources
-        self.num_channels = 1 if mono else 2
-
-    def get_padding(self, shape):
-        '''
-        Calculates the required amounts of padding along each axis of the input and output, so that the Unet works and has the given shape as output shape
-        :param shape: Desired output shape
-        :return: Input_shape, output_shape, where each is a list [batch_size, time_steps, channels]
-        '''
-
-        if self.context:
-            # Check if desired shape is possible as output shape - go from output shape towards lowest-res feature map
-            rem = float(shape[1]) # Cut off batch size number and channel
-            #rem = rem +  self.filter_size - 1
-            for i in range(self.num_layers):
-                rem = rem + self.merge_filter_size - 1
-                rem = (rem + 1.) / 2.# out = in + in - 1 <=> in = (out+1)/
-
-            # Round resulting feature map dimensions up to nearest integer
-            x = np.asarray(np.ceil(rem),dtype=np.int64)
-            assert(x >= 2)
-
-            # Compute input and output shapes based on lowest-res feature map
-            output_shape = x
-            input_shape = x
-
-            # Extra conv
-            input_shape = input_shape + self.filter_size - 1
-
-            # Go from centre feature map through up- and downsampling blocks
-            for i in range(self.num_layers):
-                output_shape = 2*output_shape - 1 #Upsampling
-                output_shape = output_shape - self.merge_filter_size + 1 # Conv
-
-                input_shape = 2*input_shape - 1 # Decimation
-                input_shape = input_shape + self.filter_size - 1 # Conv
-
-
-            input_shape = np.concatenate([[shape[0]], [input_shape], [self.num_channels]])
-            output_shape = np.concatenate([[shape[0]], [output_shape], [self.num_channels]])
-
-            return input_shape, output_shape
-        else:
-            return [shape[0], shape[1], self.num_channels], [shape[0], shape[1], self.num_channels]
-
     def get_output(self, input, z, training=None, return_spectrogram=False, reuse=True):
         '''
         Creates symbolic computation graph of the U-Net for a given input batch
         :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param z: Conditioning batch, 2D tensor [batch_size, num_sources]
         :param reuse: Whether to create new parameter variables or reuse existing ones
         :return: U-Net output: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
         '''
-        with tf.variable_scope("separator", reuse=reuse):
-            enc_outputs = list()
-            current_layer = input
-
-            # Down-convolution: Repeat strided conv
-            for i in range(self.num_layers):
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * i), self.filter_size, strides=1, activation=LeakyReLU, padding=self.padding) # out = in - filter + 1
-                enc_outputs.append(current_layer)
-                current_layer = current_layer[:,::2,:] # Decimate by factor of 2 # out = (in-1)/2 + 1
-
+        with self._variable_scope(reuse):
+            input = tf.cast(input, self.dtype)
+            enc_outputs, current_layer = self._encode(input)
+            return self._decode(input, enc_outputs, current_layer, z)
 
-            current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * self.num_layers),self.filter_size,activation=LeakyReLU,padding=self.padding) # One more conv here since we need to compute features after last decimation
-            # Feature map here shall be X along one dimension
-
-            # Make conditioning on the bottleneck
-            # z --> [batch_size, num_sources] -> [batch_size, timestamps, n_filters, num_sources]
-            z = tf.tile(z, [current_layer.shape[1], current_layer.shape[2]])
-            z = tf.reshape(z, (current_layer.shape.as_list() + [self.num_sources]))
-
-            # Apply multiplicative conditioning
-            current_layer = tf.expand_dims(current_layer, axis=-1)
-            current_layer = tf.multiply(z, current_layer)
-            current_layer = tf.reshape(current_layer, (current_layer.shape[0], current_layer.shape[1], -1))
+    def get_multi_query_output(self, input, z, reuse=True):
+        '''
+        Creates the computation graph for separating each mixture with several conditioning queries at once.
+        The conditioning is only applied at the bottleneck, so the encoder is run once per mixture and its outputs are
+        shared by all queries, which are then batched through the decoder.
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param z: Conditioning queries, 3D tensor [batch_size, num_queries, num_sources]
+        :param reuse: Whether to create new parameter variables or reuse existing ones
+        :return: List of source estimates. Each item is a 4D tensor [batch_size, num_queries, num_out_samples, num_channels]
+        '''
+        batch_size, num_queries = z.get_shape().as_list()[:2]
+        with self._variable_scope(reuse):
+            input = tf.cast(input, self.dtype)
+            enc_outputs, current_layer = self._encode(input)
 
-            # Upconvolution
-            for i in range(self.num_layers):
-                #UPSAMPLING
-                current_layer = tf.expand_dims(current_layer, axis=1)
-                if self.upsampling == 'learned':
-                    # Learned interpolation between two neighbouring time positions by using a convolution filter of width 2, and inserting the responses in the middle of the two respective inputs
-                    current_layer = Utils.learned_interpolation_layer(current_layer, self.padding, i)
-                else:
-                    if self.context:
-                        current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2] * 2 - 1], align_corners=True)
-                        current_layer = tf.cast(current_layer, tf.bfloat16)
-                    else:
-                        current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2]*2]) # out = in + in - 1
-                #current_layer = tf.layers.conv2d_transpose(current_layer, self.num_initial_filters + (16 * (self.num_layers-i-1)), [1, 15], strides=[1, 2], activation=LeakyReLU, padding='same') # output = input * stride + filter - stride
-                current_layer = tf.squeeze(current_layer, axis=1)
+            # Repeat the cached encoder features once per query: [batch_size * num_queries, ...]
+            enc_outputs = [Utils.repeat_batch(enc_output, num_queries) for enc_output in enc_outputs]
+            current_layer = Utils.repeat_batch(current_layer, num_queries)
+            query_input = Utils.repeat_batch(input, num_queries)
+            z = tf.reshape(z, [batch_size * num_queries, self.num_sources])
 
-                assert(enc_outputs[-i-1].get_shape().as_list()[1] == current_layer.get_shape().as_list()[1] or self.context) #No cropping should be necessary unless we are using context
-                current_layer = Utils.crop_and_concat(enc_outputs[-i-1], current_layer, match_feature_dim=False)
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * (self.num_layers - i - 1)), self.merge_filter_size,
-                                                 activation=LeakyReLU,
-                                                 padding=self.padding)  # out = in - filter + 1
+            outputs = self._decode(query_input, enc_outputs, current_layer, z)
+        return [tf.reshape(out, [batch_size, num_queries] + out.get_shape().as_list()[1:]) for out in outputs]
 
-            current_layer = Utils.crop_and_concat(input, current_layer, match_feature_dim=False)
-            # Output layer
-            if self.output_type == "direct":
-                return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels)
-            elif self.output_type == "difference":
-                cropped_input = Utils.crop(input,current_layer.get_shape().as_list(), match_feature_dim=False)
-                return OutputLayer.difference_output(cropped_input, current_layer, self.num_sources, self.num_channels)
-            else:
-                raise NotImplementedError
+    def _decode(self, input, enc_outputs, current_layer, z):
+        '''
+        Conditioning at the bottleneck followed by the up-sampling path and the output layer of the U-Net.
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param enc_outputs: Encoder feature maps as returned by _encode
+        :param current_layer: Bottleneck feature map as returned by _encode
+        :param z: Conditioning batch, 2D tensor [batch_size, num_sources]
+        :return: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
+        '''
+        # Make conditioning on the bottleneck
+        # z --> [batch_size, num_sources] -> [batch_size, 1, 1, num_sources], broadcast over timestamps and n_filters
+        z = tf.cast(z, self.dtype)
+        z = z[:, tf.newaxis, tf.newaxis, :]
+
+        # Apply multiplicative conditioning: [batch_size, timestamps, n_filters * num_sources], each example with its own z
+        current_layer = tf.expand_dims(current_layer, axis=-1)
+        current_layer = tf.multiply(z, current_layer)
+        current_layer = tf.reshape(current_layer, (current_layer.shape[0], current_layer.shape[1], -1))
+
+        current_layer = self._upsampling_path(enc_outputs, current_layer)
+        return self._output_layer(input, current_layer)
@@ -4,7 +4,7 @@ def independent_outputs(featuremap, num_sources, num_channels):
     outputs = list()
     for _ in range(num_sources):
         outputs.append(tf.layers.conv1d(featuremap, num_channels, 1, activation=tf.tanh, padding='valid'))
-    return outputs
+    return [tf.cast(out, tf.float32) for out in outputs] # Source estimates are always returned in float32
 
 def difference_output(input_mix, featuremap, num_sources, num_channels):
     outputs = list()
@@ -14,4 +14,4 @@ def difference_output(input_mix, featuremap, num_sources, num_channels):
         outputs.append(out)
         last_source = last_source - out
     outputs.append(last_source)
-    return outputs
\ No newline at end of file
+    return [tf.cast(out, tf.float32) for out in outputs] # Source estimates are always returned in float32
\ No newline at end of file
@@ -0,0 +1,37 @@
+import tensorflow as tf
+
+import Utils
+from Utils import LeakyReLU
+import Models.UnetAudioSeparator
+import Models.ConditionalUnetAudioSeparator
+
+def separable_conv_layer(separator, current_layer, num_filters, filter_size, index):
+    '''
+    Depthwise-separable replacement for the convolutions of the U-Net: one filter per input channel over time, followed
+    by a 1x1 convolution mixing the channels. Costs filter_size * C_in + C_in * C_out instead of filter_size * C_in * C_out
+    multiply-accumulates per time step, and keeps the output length of the full convolution, so get_padding is unchanged.
+    The first convolution only sees the one or two mixture channels and stays a full convolution.
+    '''
+    if index == 0:
+        return tf.layers.conv1d(current_layer, num_filters, filter_size, strides=1, activation=LeakyReLU, padding=separator.padding,
+                                name=Utils.conv_layer_name(index), reuse=tf.AUTO_REUSE)
+    return tf.layers.separable_conv1d(current_layer, num_filters, filter_size, strides=1, activation=LeakyReLU, padding=separator.padding,
+                                      name=Utils.conv_layer_name(index), reuse=tf.AUTO_REUSE)
+
+class SeparableUnetAudioSeparator(Models.UnetAudioSeparator.UnetAudioSeparator):
+    '''
+    U-Net separator with depthwise-separable convolutions in the down- and up-sampling levels, for fast CPU inference.
+    '''
+    separable = True
+
+    def _conv_layer(self, current_layer, num_filters, filter_size, index):
+        return separable_conv_layer(self, current_layer, num_filters, filter_size, index)
+
+class ConditionalSeparableUnetAudioSeparator(Models.ConditionalUnetAudioSeparator.UnetAudioSeparator):
+    '''
+    Conditional U-Net separator with depthwise-separable convolutions in the down- and up-sampling levels.
+    '''
+    separable = True
+
+    def _conv_layer(self, current_layer, num_filters, filter_size, index):
+        return separable_conv_layer(self, current_layer, num_filters, filter_size, index)
@@ -0,0 +1,36 @@
+import Models.UnetAudioSeparator
+import Models.ConditionalUnetAudioSeparator
+import Models.SeparableUnetAudioSeparator
+
+# Separator classes per network type: (unconditional, conditioned on instrument labels)
+NETWORKS = {"unet": (Models.UnetAudioSeparator.UnetAudioSeparator, Models.ConditionalUnetAudioSeparator.UnetAudioSeparator),
+            "unet_separable": (Models.SeparableUnetAudioSeparator.SeparableUnetAudioSeparator, Models.SeparableUnetAudioSeparator.ConditionalSeparableUnetAudioSeparator)}
+
+def get_separator(model_config, conditional=False):
+    '''
+    Creates the separator network selected by model_config["network"]
+    :param model_config: Model configuration dictionary
+    :param conditional: Whether to create the variant conditioned on instrument labels at the bottleneck
+    :return: Separator object providing get_padding and get_output
+    '''
+    # Training configurations call the padding option "input_context", pickled prediction configurations "context"
+    context = model_config["context"] if "context" in model_config else model_config["input_context"]
+
+    if model_config["network"] not in NETWORKS:
+        raise NotImplementedError("Unknown network " + str(model_config["network"]))
+    separator_class = NETWORKS[model_config["network"]][1 if conditional else 0]
+
+    return separator_class(model_config["num_layers"], model_config["num_initial_filters"],
+                           output_type=model_config["output_type"],
+                           context=context,
+                           mono=model_config["mono_downmix"],
+                           upsampling=model_config["upsampling"],
+                           num_sources=model_config["num_sources"],
+                           filter_size=model_config["filter_size"],
+                           merge_filter_size=model_config["merge_filter_size"],
+                           precision=model_config.get("precision", "float32"),
+                           recompute=model_config.get("recompute", "none"),
+                           recompute_levels=model_config.get("recompute_levels", 1),
+                           bottleneck_dilations=model_config.get("bottleneck_dilations"),
+                           bottleneck_filter_size=model_config.get("bottleneck_filter_size", 3),
+                           num_filters=model_config.get("num_filters"))
@@ -0,0 +1,174 @@
+import tensorflow as tf
+
+import Utils
+from Models import OutputLayer
+
+class StreamingUnetAudioSeparator:
+    '''
+    Stateful streaming inference for a UnetAudioSeparator with valid convolutions.
+    When the input window moves by a hop that is a multiple of 2^num_layers, every feature map of the network moves by a
+    whole number of columns (hop / 2^level). Instead of recomputing the whole window, each level keeps the feature maps
+    of the previous window in buffers and only computes its new columns from them. The first window of a stream is
+    computed in full to fill the buffers.
+    Uses the variables of the separator, so a checkpoint of the separator can be restored as usual.
+    '''
+
+    def __init__(self, separator, input_shape, hop):
+        '''
+        :param separator: UnetAudioSeparator to run in streaming mode. Needs input context and no bottleneck dilations
+        :param input_shape: Input shape of the full window [batch_size, num_samples, num_channels], see get_padding
+        :param hop: Number of new input (and output) samples per step, must be a multiple of 2^num_layers
+        '''
+        if not separator.context:
+            raise NotImplementedError("Streaming requires valid convolutions (input context)")
+        if separator.bottleneck_dilations:
+            raise NotImplementedError("Streaming does not support dilated bottleneck convolutions")
+        if hop % (2 ** separator.num_layers) != 0:
+            raise ValueError("Hop size " + str(hop) + " must be a multiple of 2^num_layers = " + str(2 ** separator.num_layers))
+        self.separator = separator
+        self.input_shape = [int(d) for d in input_shape]
+        self.hop = hop
+
+    def build(self):
+        '''
+        Creates placeholders and graph for the first window (init_input, init_op, init_outputs) and for the following
+        steps (step_input, step_outputs). Running init_op fills the buffers and returns init_outputs for the whole
+        first window, every run of step_outputs consumes hop new input samples and returns hop new output samples.
+        :return: self
+        '''
+        batch_size, _, num_channels = self.input_shape
+        self.init_input = tf.placeholder(tf.float32, self.input_shape, name="stream_init_input")
+        self.step_input = tf.placeholder(tf.float32, [batch_size, self.hop, num_channels], name="stream_step_input")
+        self.init_op, self.init_outputs = self._get_init_output(self.init_input)
+        self.step_outputs = self._get_step_output(self.step_input)
+        return self
+
+    def get_latency(self):
+        '''
+        Algorithmic latency in samples: an output sample is available once the network has seen its right input
+        context, and the oldest sample of a hop additionally waits for the rest of the hop. Excludes computation time.
+        '''
+        return (self.input_shape[1] - self.output_length) // 2 + self.hop - 1
+
+    def _conv(self, current_layer, level):
+        # Same layers (and variables) as in the separator
+        sep = self.separator
+        filter_size = sep.filter_size if level <= sep.num_layers else sep.merge_filter_size
+        return sep._conv_layer(current_layer, sep.get_num_filters(level), filter_size, level)
+
+    def _upsample(self, current_layer, level):
+        current_layer = tf.expand_dims(current_layer, axis=1)
+        if self.separator.upsampling == 'learned':
+            current_layer = Utils.learned_interpolation_layer(current_layer, "valid", level)
+        else:
+            current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2] * 2 - 1], align_corners=True)
+            current_layer = tf.cast(current_layer, self.separator.dtype)
+        return tf.squeeze(current_layer, axis=1)
+
+    def _output_layer(self, cropped_input, current_layer):
+        sep = self.separator
+        current_layer = tf.concat([cropped_input, current_layer], axis=2)
+        if sep.output_type == "direct":
+            return OutputLayer.independent_outputs(current_layer, sep.num_sources, sep.num_channels)
+        elif sep.output_type == "difference":
+            return OutputLayer.difference_output(cropped_input, current_layer, sep.num_sources, sep.num_channels)
+        else:
+            raise NotImplementedError
+
+    def _state(self, name, value):
+        # Buffers are local variables, so that savers created for the separator checkpoint ignore them
+        return tf.Variable(tf.zeros(value.get_shape().as_list(), dtype=value.dtype), trainable=False, name=name,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    def _get_init_output(self, input):
+        '''
+        Full forward pass over the first window, storing the feature maps needed by the following steps.
+        '''
+        sep = self.separator
+        L, f, m = sep.num_layers, sep.filter_size, sep.merge_filter_size
+        states = list()
+        with tf.variable_scope("separator", reuse=tf.AUTO_REUSE, custom_getter=Utils.float32_variable_getter):
+            input = tf.cast(input, sep.dtype)
+            states.append(("input", input))
+
+            enc_outputs = list()
+            current_layer = input
+            for i in range(L):
+                current_layer = self._conv(current_layer, i)
+                enc_outputs.append(current_layer)
+                states.append(("enc_" + str(i), current_layer))
+                current_layer = current_layer[:, ::2, :]
+                states.append(("enc_tail_" + str(i + 1), current_layer[:, -(f - 1):, :]))
+            current_layer = self._conv(current_layer, L)
+
+            self.upsampled_lengths = list()
+            for j in range(L):
+                states.append(("dec_last_" + str(j), current_layer[:, -1:, :]))
+                current_layer = self._upsample(current_layer, j)
+                self.upsampled_lengths.append(current_layer.get_shape().as_list()[1])
+                current_layer = Utils.crop_and_concat(enc_outputs[-j - 1], current_layer, match_feature_dim=False)
+                states.append(("dec_tail_" + str(j), current_layer[:, -(m - 1):, :]))
+                current_layer = self._conv(current_layer, L + 1 + j)
+
+            self.output_length = current_layer.get_shape().as_list()[1]
+            if self.hop > self.output_length:
+                raise ValueError("Hop size " + str(self.hop) + " must not exceed the output length " + str(self.output_length))
+            cropped_input = Utils.crop(input, current_layer.get_shape().as_list(), match_feature_dim=False)
+            outputs = self._output_layer(cropped_input, current_layer)
+
+        with tf.variable_scope("streaming_state"):
+            self.states = dict((name, self._state(name, value)) for name, value in states)
+        init_op = tf.group(*[tf.assign(self.states[name], value) for name, value in states])
+        return init_op, outputs
+
+    def _get_step_output(self, new_input):
+        '''
+        Computes the outputs for hop new input samples from the buffered feature maps and updates the buffers.
+        '''
+        sep = self.separator
+        L, f, m, H = sep.num_layers, sep.filter_size, sep.merge_filter_size, self.hop
+        new_states = dict()
+        with tf.variable_scope("separator", reuse=tf.AUTO_REUSE, custom_getter=Utils.float32_variable_getter):
+            new_input = tf.cast(new_input, sep.dtype)
+            input = tf.concat([self.states["input"][:, H:, :], new_input], axis=1)
+            new_states["input"] = input
+
+            # Down-sampling: level i moves by H / 2^i columns
+            conv_input = input[:, -(H + f - 1):, :]
+            for i in range(L):
+                new_columns = H // 2 ** i
+                new_layer = self._conv(conv_input, i)
+                enc_output = tf.concat([self.states["enc_" + str(i)][:, new_columns:, :], new_layer], axis=1)
+                new_states["enc_" + str(i)] = enc_output
+
+                # Keep the decimation phase of the full feature map
+                first_new = enc_output.get_shape().as_list()[1] - new_columns
+                new_layer = new_layer[:, first_new % 2::2, :]
+                conv_input = tf.concat([self.states["enc_tail_" + str(i + 1)], new_layer], axis=1)
+                new_states["enc_tail_" + str(i + 1)] = conv_input[:, -(f - 1):, :]
+            new_layer = self._conv(conv_input, L)
+
+            # Up-sampling: the input of level j moves by H / 2^(L-j) columns, its output by twice as many
+            for j in range(L):
+                new_columns = H // 2 ** (L - j)
+                upsample_input = tf.concat([self.states["dec_last_" + str(j)], new_layer], axis=1)
+                new_states["dec_last_" + str(j)] = new_layer[:, -1:, :]
+                new_layer = self._upsample(upsample_input, j)[:, 1:, :] # First column was already computed in the previous step
+
+                enc_output = new_states["enc_" + str(L - j - 1)]
+                upsampled_length = self.upsampled_lengths[j]
+                crop_start = (enc_output.get_shape().as_list()[1] - upsampled_length) // 2
+                skip = enc_output[:, crop_start + upsampled_length - 2 * new_columns:crop_start + upsampled_length, :]
+                conv_input = tf.concat([self.states["dec_tail_" + str(j)], tf.concat([skip, new_layer], axis=2)], axis=1)
+                new_states["dec_tail_" + str(j)] = conv_input[:, -(m - 1):, :]
+                new_layer = self._conv(conv_input, L + 1 + j)
+
+            crop_start = (self.input_shape[1] - self.output_length) // 2
+            cropped_input = input[:, crop_start + self.output_length - H:crop_start + self.output_length, :]
+            outputs = self._output_layer(cropped_input, new_layer)
+
+        # Update the buffers only after everything has been computed from their previous contents
+        with tf.control_dependencies(outputs + list(new_states.values())):
+            update_op = tf.group(*[tf.assign(self.states[name], value) for name, value in new_states.items()])
+        with tf.control_dependencies([update_op]):
+            return [tf.identity(output) for output in outputs]
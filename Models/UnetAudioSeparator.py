@@ -10,11 +10,20 @@ class UnetAudioSeparator:
     U-Net separator network for singing voice separation.
     Uses valid convolutions, so it predicts for the centre part of the input - only certain input and output shapes are therefore possible (see getpadding function)
     '''
+    separable = False # Whether the down- and up-sampling convolutions are depthwise-separable, see SeparableUnetAudioSeparator
 
-    def __init__(self, num_layers, num_initial_filters, upsampling, output_type, context, num_sources, mono, filter_size, merge_filter_size):
+    def __init__(self, num_layers, num_initial_filters, upsampling, output_type, context, num_sources, mono, filter_size, merge_filter_size, precision="float32", recompute="none", recompute_levels=1, bottleneck_dilations=None, bottleneck_filter_size=3, num_filters=None):
         '''
         Initialize U-net
         :param num_layers: Number of down- and upscaling layers in the network
+        :param precision: Compute precision of the network, one of "float32", "bfloat16" or "float16". Variables are always stored in float32
+        :param recompute: Which activations to recompute in the backward pass instead of keeping them in memory: "none", "encoder", "decoder" or "all".
+        The outputs of the encoder levels are kept anyway as skip connections, so "encoder" only saves the activations inside
+        the encoder convolutions and little memory overall. Most of the savings come from the decoder, whose wider inputs are concatenations with the skips
+        :param recompute_levels: Number of consecutive U-Net levels that are recomputed together. Larger groups keep fewer activations, but need more memory while a group is recomputed
+        :param bottleneck_dilations: Dilation of each residual convolution in a stack after the bottleneck convolution, e.g. [1, 2, 4, 8]. None or empty: no stack
+        :param bottleneck_filter_size: Filter size of the dilated bottleneck convolutions
+        :param num_filters: Number of filters of each convolution (down-sampling levels, bottleneck, up-sampling levels), e.g. of a pruned network. None: num_initial_filters more filters per level
         '''
         self.num_layers = num_layers
         self.num_initial_filters = num_initial_filters
@@ -26,6 +35,14 @@ class UnetAudioSeparator:
         self.padding = "valid" if context else "same"
         self.num_sources = num_sources
         self.num_channels = 1 if mono else 2
+        self.dtype = Utils.get_compute_dtype(precision)
+        assert(recompute in ["none", "encoder", "decoder", "all"])
+        self.recompute = recompute
+        self.recompute_levels = recompute_levels
+        self.bottleneck_dilations = list(bottleneck_dilations) if bottleneck_dilations else list()
+        self.bottleneck_filter_size = bottleneck_filter_size
+        assert(num_filters is None or len(num_filters) == 2 * num_layers + 1)
+        self.num_filters = num_filters
 
     def get_padding(self, shape):
         '''
@@ -50,8 +67,8 @@ class UnetAudioSeparator:
             output_shape = x
             input_shape = x
 
-            # Extra conv
-            input_shape = input_shape + self.filter_size - 1
+            # Extra conv and dilated bottleneck convs
+            input_shape = input_shape + self.filter_size - 1 + self.get_bottleneck_context()
 
             # Go from centre feature map through up- and downsampling blocks
             for i in range(self.num_layers):
@@ -69,6 +86,25 @@ class UnetAudioSeparator:
         else:
             return [shape[0], shape[1], self.num_channels], [shape[0], shape[1], self.num_channels]
 
+    def get_num_filters(self, index):
+        '''
+        Number of filters of a convolution of the U-Net
+        :param index: Index of the convolution, see _conv_layer
+        '''
+        if self.num_filters is not None:
+            return self.num_filters[index]
+        if index <= self.num_layers: # Down-sampling levels and bottleneck
+            return self.num_initial_filters + (self.num_initial_filters * index)
+        return self.num_initial_filters + (self.num_initial_filters * (2 * self.num_layers - index)) # Up-sampling levels
+
+    def get_bottleneck_context(self):
+        '''
+        Number of samples by which the dilated bottleneck convolutions shorten the bottleneck feature map (only with input context)
+        '''
+        if not self.context:
+            return 0
+        return sum((self.bottleneck_filter_size - 1) * dilation for dilation in self.bottleneck_dilations)
+
     def get_output(self, input, training=None, return_spectrogram=False, reuse=True):
         '''
         Creates symbolic computation graph of the U-Net for a given input batch
@@ -76,21 +112,109 @@ class UnetAudioSeparator:
         :param reuse: Whether to create new parameter variables or reuse existing ones
         :return: U-Net output: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
         '''
-        with tf.variable_scope("separator", reuse=reuse):
-            enc_outputs = list()
-            current_layer = input
+        with self._variable_scope(reuse):
+            input = tf.cast(input, self.dtype)
+            enc_outputs, current_layer = self._encode(input)
+            current_layer = self._upsampling_path(enc_outputs, current_layer)
+            return self._output_layer(input, current_layer)
 
-            # Down-convolution: Repeat strided conv
-            for i in range(self.num_layers):
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * i), self.filter_size, strides=1, activation=LeakyReLU, padding=self.padding) # out = in - filter + 1
-                enc_outputs.append(current_layer)
+    def _variable_scope(self, reuse):
+        '''
+        Variable scope of the separator variables. Recomputation with tf.contrib.layers.recompute_grad builds on
+        tf.custom_gradient, which only supports resource variables in graph mode, so they are created as such if enabled.
+        Checkpoints do not depend on the variable type.
+        '''
+        return tf.variable_scope("separator", reuse=reuse, custom_getter=Utils.float32_variable_getter,
+                                 use_resource=True if self.recompute != "none" else None)
+
+    def _encode(self, input):
+        '''
+        Down-sampling path of the U-Net. Groups of recompute_levels levels are recomputed in the backward pass if enabled.
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :return: List of encoder feature maps used as skip connections, bottleneck feature map
+        '''
+        enc_outputs = list()
+        current_layer = input
+
+        # Down-convolution: Repeat strided conv
+        for levels in Utils.get_recompute_segments(self.num_layers, self.recompute_levels):
+            encoder_block = Utils.recompute_grad(self._encoder_block(levels), self.recompute in ["encoder", "all"])
+            outputs = encoder_block(current_layer)
+            enc_outputs.extend(outputs[:-1])
+            current_layer = outputs[-1]
+
+        current_layer = self._conv_layer(current_layer, self.get_num_filters(self.num_layers), self.filter_size, self.num_layers) # One more conv here since we need to compute features after last decimation
+        current_layer = self._dilated_bottleneck(current_layer)
+        # Feature map here shall be X along one dimension
+        return enc_outputs, current_layer
+
+    def _conv_layer(self, current_layer, num_filters, filter_size, index):
+        '''
+        Convolution with LeakyReLU activation used in the down- and up-sampling levels and at the bottleneck.
+        Layers are named by their index, so that recomputation and streaming inference reuse the same variables.
+        :param index: Index of the convolution: level i of the down-sampling path, num_layers for the bottleneck, num_layers + 1 + i for level i of the up-sampling path
+        '''
+        return tf.layers.conv1d(current_layer, num_filters, filter_size, strides=1, activation=LeakyReLU, padding=self.padding,
+                                name=Utils.conv_layer_name(index), reuse=tf.AUTO_REUSE)
+
+    def _dilated_bottleneck(self, current_layer):
+        '''
+        Stack of residual dilated convolutions at the bottleneck. Its receptive field grows exponentially with the number
+        of convolutions, while each additional U-Net level roughly doubles the input context.
+        :param current_layer: Bottleneck feature map
+        :return: Bottleneck feature map, shorter by get_bottleneck_context() samples
+        '''
+        num_filters = current_layer.get_shape().as_list()[2]
+        for i, dilation in enumerate(self.bottleneck_dilations):
+            with tf.variable_scope("bottleneck_dilated_" + str(i), reuse=tf.AUTO_REUSE):
+                kernel = tf.get_variable("kernel", [self.bottleneck_filter_size, num_filters, num_filters], dtype=self.dtype)
+                bias = tf.get_variable("bias", [num_filters], dtype=self.dtype, initializer=tf.zeros_initializer())
+                if self.context:
+                    conv = Utils.causal_conv(current_layer, kernel, dilation, 'VALID') # out = in - (filter - 1) * dilation
+                else:
+                    conv = Utils.dilated_conv(current_layer, kernel, dilation)[:, :current_layer.get_shape().as_list()[1], :] # Remove padding to a multiple of the dilation
+                conv = LeakyReLU(tf.nn.bias_add(conv, bias))
+                current_layer = Utils.crop(current_layer, conv.get_shape().as_list(), match_feature_dim=False) + conv
+        return current_layer
+
+    def _encoder_block(self, levels):
+        '''
+        Creates the function computing the given consecutive down-sampling levels.
+        Layers are named explicitly so that recomputation in the backward pass reuses the same variables.
+        :param levels: List of level indices
+        :return: Function mapping the input feature map to a list of the skip connection of each level plus the decimated output
+        '''
+        def encoder_block(current_layer):
+            outputs = list()
+            for i in levels:
+                current_layer = self._conv_layer(current_layer, self.get_num_filters(i), self.filter_size, i) # out = in - filter + 1
+                outputs.append(current_layer)
                 current_layer = current_layer[:,::2,:] # Decimate by factor of 2 # out = (in-1)/2 + 1
+            return outputs + [current_layer]
+        return encoder_block
 
-            current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * self.num_layers),self.filter_size,activation=LeakyReLU,padding=self.padding) # One more conv here since we need to compute features after last decimation
-            # Feature map here shall be X along one dimension
+    def _upsampling_path(self, enc_outputs, current_layer):
+        '''
+        Up-sampling path of the U-Net. Groups of recompute_levels levels are recomputed in the backward pass if enabled.
+        :param enc_outputs: Encoder feature maps as returned by _encode
+        :param current_layer: Bottleneck feature map
+        :return: Feature map of the last up-sampling level
+        '''
+        # Upconvolution
+        for levels in Utils.get_recompute_segments(self.num_layers, self.recompute_levels):
+            decoder_block = Utils.recompute_grad(self._decoder_block(levels), self.recompute in ["decoder", "all"])
+            current_layer = decoder_block(current_layer, *[enc_outputs[-i-1] for i in levels])
+        return current_layer
 
-            # Upconvolution
-            for i in range(self.num_layers):
+    def _decoder_block(self, levels):
+        '''
+        Creates the function computing the given consecutive up-sampling levels.
+        Layers are named explicitly so that recomputation in the backward pass reuses the same variables.
+        :param levels: List of level indices
+        :return: Function mapping the input feature map and the skip connection of each level to the output feature map
+        '''
+        def decoder_block(current_layer, *skips):
+            for i, skip in zip(levels, skips):
                 #UPSAMPLING
                 current_layer = tf.expand_dims(current_layer, axis=1)
                 if self.upsampling == 'learned':
@@ -99,24 +223,31 @@ class UnetAudioSeparator:
                 else:
                     if self.context:
                         current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2] * 2 - 1], align_corners=True)
-                        current_layer = tf.cast(current_layer, tf.bfloat16)
                     else:
                         current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2]*2]) # out = in + in - 1
+                    current_layer = tf.cast(current_layer, self.dtype) # Resizing always returns float32
                 #current_layer = tf.layers.conv2d_transpose(current_layer, self.num_initial_filters + (16 * (self.num_layers-i-1)), [1, 15], strides=[1, 2], activation=LeakyReLU, padding='same') # output = input * stride + filter - stride
                 current_layer = tf.squeeze(current_layer, axis=1)
 
-                assert(enc_outputs[-i-1].get_shape().as_list()[1] == current_layer.get_shape().as_list()[1] or self.context) #No cropping should be necessary unless we are using context
-                current_layer = Utils.crop_and_concat(enc_outputs[-i-1], current_layer, match_feature_dim=False)
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * (self.num_layers - i - 1)), self.merge_filter_size,
-                                                 activation=LeakyReLU,
-                                                 padding=self.padding)  # out = in - filter + 1
-
-            current_layer = Utils.crop_and_concat(input, current_layer, match_feature_dim=False)
-            # Output layer
-            if self.output_type == "direct":
-                return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels)
-            elif self.output_type == "difference":
-                cropped_input = Utils.crop(input,current_layer.get_shape().as_list(), match_feature_dim=False)
-                return OutputLayer.difference_output(cropped_input, current_layer, self.num_sources, self.num_channels)
-            else:
-                raise NotImplementedError
+                assert(skip.get_shape().as_list()[1] == current_layer.get_shape().as_list()[1] or self.context) #No cropping should be necessary unless we are using context
+                current_layer = Utils.crop_and_concat(skip, current_layer, match_feature_dim=False)
+                current_layer = self._conv_layer(current_layer, self.get_num_filters(self.num_layers + 1 + i), self.merge_filter_size, self.num_layers + 1 + i)  # out = in - filter + 1
+            return current_layer
+        return decoder_block
+
+    def _output_layer(self, input, current_layer):
+        '''
+        Combines the last feature map with the input mixture and computes one estimate per source.
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param current_layer: Feature map of the last up-sampling level
+        :return: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
+        '''
+        current_layer = Utils.crop_and_concat(input, current_layer, match_feature_dim=False)
+        # Output layer
+        if self.output_type == "direct":
+            return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels)
+        elif self.output_type == "difference":
+            cropped_input = Utils.crop(input,current_layer.get_shape().as_list(), match_feature_dim=False)
+            return OutputLayer.difference_output(cropped_input, current_layer, self.num_sources, self.num_channels)
+        else:
+            raise NotImplementedError
@@ -0,0 +1,113 @@
+'''
+Overlaps decoding, separation and metric computation across tracks. Upcoming tracks are loaded by a pool of threads
+while the current one is separated, and results are consumed by a background thread. Bounded queues limit how many
+decoded tracks and pending results are held in memory at once. Threads suffice here, since decoding, resampling and
+session runs release the GIL for most of their time.
+'''
+
+import threading
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+class _Failure:
+    # Exception raised in a worker thread, re-raised in the consuming thread
+    def __init__(self, exception):
+        self.exception = exception
+
+def prefetch(items, load_fn, num_workers=2, max_pending=2):
+    '''
+    Applies load_fn to items in worker threads while the caller processes earlier results.
+    :param items: List of items, e.g. tracks
+    :param load_fn: Function loading one item, e.g. decoding and resampling its audio
+    :param num_workers: Number of loading threads
+    :param max_pending: Maximum number of items being loaded or waiting to be consumed
+    :return: Generator of (item, load_fn(item)) in the order of items
+    '''
+    items = list(items)
+    todo = queue.Queue()
+    for index in range(len(items)):
+        todo.put(index)
+    # One slot per loading or loaded item that is not consumed yet, so memory stays bounded
+    slots = threading.Semaphore(max_pending)
+    results = dict()
+    done = threading.Condition()
+
+    def work():
+        while True:
+            # Take the slot before the index, so that the items holding slots are always the next ones to be consumed
+            slots.acquire()
+            try:
+                index = todo.get_nowait()
+            except queue.Empty:
+                slots.release()
+                return
+            try:
+                result = load_fn(items[index])
+            except Exception as e:
+                result = _Failure(e)
+            with done:
+                results[index] = result
+                done.notify_all()
+
+    threads = [threading.Thread(target=work) for _ in range(min(num_workers, max(len(items), 1)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for index, item in enumerate(items):
+        with done:
+            while index not in results:
+                done.wait()
+            result = results.pop(index)
+        slots.release()
+        if isinstance(result, _Failure):
+            raise result.exception
+        yield item, result
+
+class BackgroundWorker:
+    '''
+    Consumes work items in a background thread, in the order they are put. put blocks while max_pending items are
+    waiting, which limits the memory held by the queue.
+    '''
+
+    def __init__(self, process_fn, max_pending=2):
+        '''
+        :param process_fn: Function called with the arguments of each put, e.g. computing metrics or writing estimates
+        :param max_pending: Maximum number of queued work items
+        '''
+        self.process_fn = process_fn
+        self.queue = queue.Queue(max_pending)
+        self.results = list()
+        self.failure = None
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            if self.failure is None: # After a failure, remaining items are only drained
+                try:
+                    self.results.append(self.process_fn(*args))
+                except Exception as e:
+                    self.failure = _Failure(e)
+
+    def put(self, *args):
+        if self.failure is not None:
+            raise self.failure.exception
+        self.queue.put(args)
+
+    def close(self):
+        '''
+        Waits until all queued items are processed
+        :return: List of process_fn results in the order of put
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.failure is not None:
+            raise self.failure.exception
+        return self.results
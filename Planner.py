@@ -0,0 +1,337 @@
+'''
+Analytic cost model of the Wave-U-Net separators. For a given output length it derives the shape of every layer
+and estimates FLOPs, parameters and activation memory, which is used to choose inference window sizes and to size
+experiments without building a graph.
+'''
+
+import numpy as np
+import tensorflow as tf
+
+import Models.ConditionalUnetAudioSeparator
+
+def _layer(specs, name, op, batch_size, length, channels, bytes_per_element, scope=None, kernel_size=0, in_channels=0, flops=0):
+    if op == "separable_conv1d": # Depthwise filters plus 1x1 convolution
+        params = kernel_size * in_channels + in_channels * channels + channels
+    elif op == "learned_upsample": # One interpolation weight per channel
+        params = channels
+    else:
+        params = kernel_size * in_channels * channels + channels if kernel_size > 0 else 0
+    specs.append({"name": name,
+                  "op": op,
+                  "scope": scope,
+                  "output_shape": [int(batch_size), int(length), int(channels)],
+                  "kernel_size": int(kernel_size),
+                  "params": int(params),
+                  "flops": int(flops),
+                  "activation_bytes": int(batch_size * length * channels * bytes_per_element)})
+    return length
+
+def _conv_scope(index):
+    return "separator/conv1d" + ("_" + str(index) if index > 0 else "")
+
+def _conv(specs, separator, name, index, batch_size, length, in_channels, channels, kernel_size, bytes_per_element):
+    # Convolution of the down- or up-sampling path, depthwise-separable except for the first one in separable networks
+    if separator.separable and index > 0:
+        op, macs = "separable_conv1d", kernel_size * in_channels + in_channels * channels
+    else:
+        op, macs = "conv1d", kernel_size * in_channels * channels
+    return _layer(specs, name, op, batch_size, length, channels, bytes_per_element, scope=_conv_scope(index),
+                  kernel_size=kernel_size, in_channels=in_channels, flops=2 * batch_size * length * macs)
+
+def get_layer_specs(separator, num_frames, batch_size=1):
+    '''
+    Lists all layers of the separator for a given output length, in the order in which the graph creates them.
+    Convolutions count 2 FLOPs per multiply-accumulate.
+    :param separator: Separator object (UnetAudioSeparator, its conditional or separable variants)
+    :param num_frames: Desired number of output samples, rounded up to a possible output size as in get_padding
+    :param batch_size: Number of examples per batch
+    :return: Input shape, output shape, list of layer dictionaries with name, op, scope, output_shape, kernel_size, params, flops and activation_bytes
+    '''
+    input_shape, output_shape = separator.get_padding(np.array([batch_size, num_frames, 0]))
+    bytes_per_element = separator.dtype.size
+    valid = separator.context
+    conv_index = 0
+    specs = list()
+
+    length, channels = input_shape[1], separator.num_channels
+    _layer(specs, "input", "input", batch_size, length, channels, bytes_per_element)
+
+    # Down-sampling path
+    skips = list()
+    for i in range(separator.num_layers):
+        out_channels = separator.get_num_filters(i)
+        out_length = length - separator.filter_size + 1 if valid else length
+        _conv(specs, separator, "enc_conv_" + str(i), conv_index, batch_size, out_length, channels, out_channels, separator.filter_size, bytes_per_element)
+        conv_index += 1
+        skips.append((out_length, out_channels))
+        length, channels = (out_length + 1) // 2, out_channels
+        _layer(specs, "decimate_" + str(i), "decimate", batch_size, length, channels, bytes_per_element)
+
+    out_channels = separator.get_num_filters(separator.num_layers)
+    out_length = length - separator.filter_size + 1 if valid else length
+    _conv(specs, separator, "bottleneck_conv", conv_index, batch_size, out_length, channels, out_channels, separator.filter_size, bytes_per_element)
+    conv_index += 1
+    length, channels = out_length, out_channels
+
+    # Residual dilated convolutions
+    for i, dilation in enumerate(separator.bottleneck_dilations):
+        length = length - (separator.bottleneck_filter_size - 1) * dilation if valid else length
+        _layer(specs, "bottleneck_dilated_" + str(i), "conv1d", batch_size, length, channels, bytes_per_element,
+               scope="separator/bottleneck_dilated_" + str(i), kernel_size=separator.bottleneck_filter_size, in_channels=channels,
+               flops=2 * batch_size * length * separator.bottleneck_filter_size * channels * channels + batch_size * length * channels)
+
+    if isinstance(separator, Models.ConditionalUnetAudioSeparator.UnetAudioSeparator):
+        channels = channels * separator.num_sources
+        _layer(specs, "conditioning", "multiply", batch_size, length, channels, bytes_per_element,
+               flops=batch_size * length * channels)
+
+    # Up-sampling path
+    for i in range(separator.num_layers):
+        in_length = length
+        length = 2 * length - 1 if valid else 2 * length
+        if separator.upsampling == "learned":
+            # The new samples are computed by a width 2 convolution with diagonal [channels, channels] kernels, which
+            # the graph executes as dense convolution. The scope is the name of the interpolation weight variable
+            _layer(specs, "upsample_" + str(i), "learned_upsample", batch_size, length, channels, bytes_per_element,
+                   scope="separator/interp_" + str(i), flops=2 * batch_size * (length - in_length) * 2 * channels * channels)
+        else:
+            _layer(specs, "upsample_" + str(i), "upsample", batch_size, length, channels, bytes_per_element,
+                   flops=3 * batch_size * length * channels)
+        skip_length, skip_channels = skips[-i - 1]
+        assert skip_length >= length
+        channels = channels + skip_channels
+        _layer(specs, "concat_" + str(i), "concat", batch_size, length, channels, bytes_per_element)
+
+        out_channels = separator.get_num_filters(separator.num_layers + 1 + i)
+        out_length = length - separator.merge_filter_size + 1 if valid else length
+        _conv(specs, separator, "dec_conv_" + str(i), conv_index, batch_size, out_length, channels, out_channels, separator.merge_filter_size, bytes_per_element)
+        conv_index += 1
+        length, channels = out_length, out_channels
+
+    # Output layer: one 1x1 convolution per estimated source, the last source of the difference output is computed by subtraction
+    channels = channels + separator.num_channels
+    _layer(specs, "concat_input", "concat", batch_size, length, channels, bytes_per_element)
+    num_heads = separator.num_sources if separator.output_type == "direct" else separator.num_sources - 1
+    for i in range(num_heads):
+        _layer(specs, "output_" + str(i), "conv1d", batch_size, length, separator.num_channels, bytes_per_element,
+               scope=_conv_scope(conv_index), kernel_size=1, in_channels=channels,
+               flops=2 * batch_size * length * channels * separator.num_channels)
+        conv_index += 1
+
+    assert length == output_shape[1]
+    return input_shape, output_shape, specs
+
+def get_peak_inference_bytes(specs):
+    '''
+    Estimates the peak activation memory of a forward pass without gradients: the input and all skip connections stay
+    alive until they are consumed, every other activation only until the next layer has been computed.
+    :param specs: Layer list as returned by get_layer_specs
+    :return: Estimated peak memory in bytes
+    '''
+    input_bytes = specs[0]["activation_bytes"]
+    skip_bytes = list()
+    peak = previous = input_bytes
+    for spec in specs[1:]:
+        live = input_bytes + sum(skip_bytes)
+        peak = max(peak, live + previous + spec["activation_bytes"])
+        if spec["name"].startswith("enc_conv_"):
+            skip_bytes.append(spec["activation_bytes"])
+        elif spec["name"].startswith("concat_") and spec["name"] != "concat_input":
+            skip_bytes.pop()
+        previous = spec["activation_bytes"]
+    return peak
+
+def _level(spec):
+    # U-Net level of an encoder or decoder layer, None for all other layers
+    for prefix in ["enc_conv_", "decimate_", "upsample_", "concat_", "dec_conv_"]:
+        if spec["name"].startswith(prefix) and spec["name"][len(prefix):].isdigit():
+            return int(spec["name"][len(prefix):])
+    return None
+
+def get_training_activation_bytes(specs, recompute="none", recompute_levels=1):
+    '''
+    Estimates the activation memory kept for back-propagation. Convolutions with LeakyReLU activation also keep their
+    pre-activation and its scaled copy, so they count three times. Recomputed groups of levels only keep their inputs
+    and outputs (including skip connections), plus the activations of the one group that is being recomputed.
+    :param specs: Layer list as returned by get_layer_specs
+    :param recompute: Recomputation setting of the separator: "none", "encoder", "decoder" or "all"
+    :param recompute_levels: Number of consecutive levels recomputed together
+    :return: Estimated memory in bytes
+    '''
+    recompute_levels = max(1, recompute_levels)
+    kept = 0
+    recomputed = dict()
+    for spec in specs:
+        full_bytes = spec["activation_bytes"] * (3 if spec["op"] in ["conv1d", "separable_conv1d"] and spec["kernel_size"] > 1 else 1)
+        level = _level(spec)
+        encoder = spec["name"].startswith("enc_conv_") or spec["name"].startswith("decimate_")
+        if level is None or recompute == "none" or (encoder and recompute == "decoder") or (not encoder and recompute == "encoder"):
+            kept += full_bytes
+            continue
+
+        segment = ("encoder" if encoder else "decoder", level // recompute_levels)
+        last_level = (level % recompute_levels == recompute_levels - 1)
+        is_output = spec["name"].startswith("enc_conv_") or (last_level and spec["name"].startswith(("decimate_", "dec_conv_")))
+        if is_output:
+            kept += spec["activation_bytes"]
+        recomputed[segment] = recomputed.get(segment, 0) + full_bytes
+    return kept + max([0] + list(recomputed.values()))
+
+def plan_windows(separator, candidates, batch_size=1):
+    '''
+    Compares candidate output lengths of the separator regarding context efficiency, compute and memory.
+    :param separator: Separator object
+    :param candidates: List of desired output lengths
+    :param batch_size: Number of windows per batch
+    :return: List of dictionaries, one per candidate
+    '''
+    rows = list()
+    for num_frames in candidates:
+        input_shape, output_shape, specs = get_layer_specs(separator, num_frames, batch_size)
+        flops = sum(spec["flops"] for spec in specs)
+        rows.append({"output_frames": int(output_shape[1]),
+                     "input_frames": int(input_shape[1]),
+                     "efficiency": float(output_shape[1]) / float(input_shape[1]),
+                     "flops": flops,
+                     "flops_per_output_sample": float(flops) / float(batch_size * output_shape[1]),
+                     "inference_bytes": get_peak_inference_bytes(specs),
+                     "training_bytes": get_training_activation_bytes(specs, separator.recompute, separator.recompute_levels)})
+    return rows
+
+def print_plan(rows):
+    print("{:>12} {:>12} {:>10} {:>14} {:>14} {:>12} {:>12}".format(
+        "output", "input", "efficiency", "GFLOPs", "kFLOPs/sample", "infer MiB", "train MiB"))
+    for row in rows:
+        print("{:>12d} {:>12d} {:>9.1f}% {:>14.2f} {:>14.1f} {:>12.1f} {:>12.1f}".format(
+            row["output_frames"], row["input_frames"], 100.0 * row["efficiency"], row["flops"] / 1e9,
+            row["flops_per_output_sample"] / 1e3, row["inference_bytes"] / 2.0**20, row["training_bytes"] / 2.0**20))
+
+def choose_inference_frames(separator, memory_budget, min_frames, batch_size=1, max_frames=2**24):
+    '''
+    Finds the largest output length whose estimated inference memory fits into the given budget.
+    Only valid convolutions (input context) produce a smaller output than input, otherwise min_frames is returned.
+    :param separator: Separator object
+    :param memory_budget: Activation memory budget in bytes
+    :param min_frames: Output length that is always possible, e.g. the training output length
+    :param batch_size: Number of windows per batch
+    :param max_frames: Largest output length to consider
+    :return: Number of output frames
+    '''
+    if not separator.context:
+        return min_frames
+
+    def fits(num_frames):
+        _, _, specs = get_layer_specs(separator, num_frames, batch_size)
+        return get_peak_inference_bytes(specs) <= memory_budget
+
+    if not fits(min_frames):
+        print("WARNING: Inference window of " + str(min_frames) + " output samples already exceeds memory budget of " + str(memory_budget) + " bytes")
+        return min_frames
+
+    # Memory grows monotonically with the output length, so binary search for the largest one within budget
+    low, high = min_frames, max_frames
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid - 1
+    _, output_shape = separator.get_padding(np.array([batch_size, low, 0])) # Possible output size, already checked to fit
+    return int(output_shape[1])
+
+def get_inference_frames(model_config, separator, batch_size=None):
+    '''
+    Determines the output length of the inference window. An explicit "inference_num_frames" entry in the model
+    configuration takes precedence, otherwise the window is grown as far as "inference_memory_budget" allows for a
+    whole batch of windows. Without either entry, the training window "num_frames" is used.
+    :param model_config: Model configuration dictionary
+    :param separator: Separator object
+    :param batch_size: Number of windows per batch, None: "inference_batch_size" of the model configuration or one window
+    :return: Number of output frames
+    '''
+    if batch_size is None:
+        batch_size = model_config.get("inference_batch_size") or 1
+    if model_config.get("inference_num_frames"):
+        return model_config["inference_num_frames"]
+    if model_config.get("inference_memory_budget"):
+        return choose_inference_frames(separator, model_config["inference_memory_budget"], model_config["num_frames"], batch_size)
+    return model_config["num_frames"]
+
+def get_inference_batch_size(model_config, separator, num_frames):
+    '''
+    Determines how many inference windows are separated in one forward pass. An explicit "inference_batch_size" entry
+    in the model configuration takes precedence, and get_inference_frames then shrinks the window so that the whole
+    batch fits into "inference_memory_budget". Otherwise as many windows as fit into the budget are batched, since
+    activation memory grows linearly with the batch size. If the window itself was grown to the budget, this is one window.
+    :param model_config: Model configuration dictionary
+    :param separator: Separator object
+    :param num_frames: Output length of the inference window
+    :return: Number of windows per batch
+    '''
+    if model_config.get("inference_batch_size"):
+        return model_config["inference_batch_size"]
+    if model_config.get("inference_memory_budget"):
+        _, _, specs = get_layer_specs(separator, num_frames)
+        return max(1, int(model_config["inference_memory_budget"] // get_peak_inference_bytes(specs)))
+    return 1
+
+def get_report(separator, num_frames, batch_size=1):
+    '''
+    Collects the per-layer table together with totals and memory estimates for one configuration.
+    :param separator: Separator object
+    :param num_frames: Desired number of output samples
+    :param batch_size: Number of examples per batch
+    :return: Report dictionary that can be serialised to JSON
+    '''
+    input_shape, output_shape, specs = get_layer_specs(separator, num_frames, batch_size)
+    return {"input_shape": [int(d) for d in input_shape],
+            "output_shape": [int(d) for d in output_shape],
+            "layers": specs,
+            "total_params": sum(spec["params"] for spec in specs),
+            "total_flops": sum(spec["flops"] for spec in specs),
+            "peak_inference_bytes": get_peak_inference_bytes(specs),
+            "training_activation_bytes": get_training_activation_bytes(specs, separator.recompute, separator.recompute_levels)}
+
+def check_graph(report, graph):
+    '''
+    Compares the analytic layer table with a separator graph that was built with the same configuration, and adds
+    the shapes and parameter counts found in the graph as well as the FLOPs counted by the Tensorflow profiler.
+    :param report: Report as returned by get_report, modified in place
+    :param graph: Tensorflow graph containing the separator
+    :return: Report
+    '''
+    # Shapes of the variables by name. The graph tensors of resource variables (used when recomputing activations) are
+    # scalar handles, so their shapes cannot be read from the graph tensors
+    variable_shapes = dict((v.op.name, v.get_shape().as_list()) for v in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+    for spec in report["layers"]:
+        if spec["scope"] is None:
+            continue
+        if spec["op"] == "learned_upsample":
+            # Interpolation weights only, the layer has no scope of its own
+            spec["graph_params"] = int(np.prod(variable_shapes[spec["scope"]]))
+            spec["graph_output_shape"] = None
+        else:
+            kernels = ["depthwise_kernel", "pointwise_kernel"] if spec["op"] == "separable_conv1d" else ["kernel"]
+            spec["graph_params"] = int(sum(np.prod(variable_shapes[spec["scope"] + "/" + name]) for name in kernels + ["bias"]))
+            try:
+                spec["graph_output_shape"] = graph.get_tensor_by_name(spec["scope"] + "/BiasAdd:0").get_shape().as_list()
+            except KeyError:
+                spec["graph_output_shape"] = None
+        if spec["graph_params"] != spec["params"] or (spec["graph_output_shape"] is not None and spec["graph_output_shape"] != spec["output_shape"]):
+            print("WARNING: Layer " + spec["name"] + " in the graph differs from the analytic model")
+
+    flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation())
+    report["profiler_flops"] = int(flops.total_float_ops)
+    return report
+
+def print_report(report):
+    print("{:<18} {:<16} {:>24} {:>12} {:>12} {:>12}".format("layer", "op", "output shape", "params", "MFLOPs", "act. MiB"))
+    for spec in report["layers"]:
+        print("{:<18} {:<16} {:>24} {:>12d} {:>12.1f} {:>12.2f}".format(
+            spec["name"], spec["op"], str(spec["output_shape"]), spec["params"], spec["flops"] / 1e6, spec["activation_bytes"] / 2.0**20))
+    print("Input shape: " + str(report["input_shape"]) + ", output shape: " + str(report["output_shape"]))
+    print("Parameters: " + str(report["total_params"]))
+    print("GFLOPs per batch: {:.2f}".format(report["total_flops"] / 1e9) +
+          (" (profiler: {:.2f})".format(report["profiler_flops"] / 1e9) if "profiler_flops" in report else ""))
+    print("Peak inference activations: {:.1f} MiB".format(report["peak_inference_bytes"] / 2.0**20))
+    print("Training activations: {:.1f} MiB".format(report["training_activation_bytes"] / 2.0**20))
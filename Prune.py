@@ -0,0 +1,224 @@
+'''
+Structured pruning of trained separators. Whole filters are removed from the convolutions of a checkpoint, and all
+weights consuming their output (next convolution, skip connection, learned interpolation, output layer) are rewritten
+consistently. The result is a checkpoint of a smaller separator, described by model_config["num_filters"], that can be
+fine-tuned by setting model_config["init_checkpoint"].
+'''
+
+import os
+import json
+import numpy as np
+import tensorflow as tf
+
+import Utils
+import Models.Separators
+import Models.ConditionalUnetAudioSeparator
+
+def _scope(index):
+    return "separator/" + Utils.conv_layer_name(index)
+
+def _leaky_relu(x, alpha=0.2):
+    return np.maximum(alpha * x, x)
+
+def load_variables(checkpoint):
+    '''
+    Reads the separator weights of a checkpoint, without optimizer slots and teacher copies
+    :return: Dictionary from variable name to numpy array
+    '''
+    reader = tf.train.load_checkpoint(checkpoint)
+    return dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map()
+                if name.startswith("separator/") and name.split("/")[-1] not in ["Adam", "Adam_1"])
+
+def save_variables(variables, checkpoint):
+    '''
+    Writes variables given as dictionary from variable name to numpy array into a new checkpoint
+    :return: Path of the checkpoint
+    '''
+    with tf.Graph().as_default():
+        tf_variables = [tf.Variable(value, name=name) for name, value in variables.items()]
+        saver = tf.train.Saver(tf_variables, write_version=tf.train.SaverDef.V2)
+        with tf.Session() as sess:
+            sess.run(tf.variables_initializer(tf_variables))
+            return saver.save(sess, checkpoint)
+
+def magnitude_scores(variables, separator):
+    '''
+    Scores each filter by the L1 norm of its weights. A removed filter is replaced by its constant output for zero input.
+    :return: List of score arrays and list of replacement value arrays, one per convolution
+    '''
+    scores, replacements = list(), list()
+    for index in range(2 * separator.num_layers + 1):
+        scope = _scope(index)
+        if scope + "/pointwise_kernel" in variables:
+            scores.append(np.sum(np.abs(variables[scope + "/pointwise_kernel"]), axis=(0, 1)))
+        else:
+            scores.append(np.sum(np.abs(variables[scope + "/kernel"]), axis=(0, 1)))
+        replacements.append(_leaky_relu(variables[scope + "/bias"]))
+    return scores, replacements
+
+def activation_scores(separator, checkpoint, mixtures, num_frames):
+    '''
+    Scores each filter by its mean absolute activation on the given mixtures. A removed filter is replaced by its mean activation.
+    :param separator: Separator with float32 precision, conditional separators are queried for all sources
+    :param checkpoint: Checkpoint to restore the separator from
+    :param mixtures: List of mixture signals [n_frames, n_channels] at the sampling rate of the model
+    :param num_frames: Output length of the windows the mixtures are split into
+    :return: List of score arrays and list of replacement value arrays, one per convolution
+    '''
+    num_convs = 2 * separator.num_layers + 1
+    with tf.Graph().as_default() as graph:
+        input_shape, output_shape = separator.get_padding(np.array([1, num_frames, 0]))
+        mix = tf.placeholder(tf.float32, [int(d) for d in input_shape])
+        if isinstance(separator, Models.ConditionalUnetAudioSeparator.UnetAudioSeparator):
+            separator.get_output(mix, tf.ones([1, separator.num_sources]), False, reuse=False)
+        else:
+            separator.get_output(mix, False, reuse=False)
+        activations = [Utils.LeakyReLU(graph.get_tensor_by_name(_scope(index) + "/BiasAdd:0")) for index in range(num_convs)]
+        statistics = [[tf.reduce_mean(tf.abs(act), axis=[0, 1]), tf.reduce_mean(act, axis=[0, 1])] for act in activations]
+
+        sums = [[0.0, 0.0] for _ in range(num_convs)]
+        num_windows = 0
+        with tf.Session() as sess:
+            tf.train.Saver(tf.global_variables()).restore(sess, checkpoint)
+            pad_time_frames = (input_shape[1] - output_shape[1]) // 2
+            for mixture in mixtures:
+                padded = np.pad(mixture, [(pad_time_frames, pad_time_frames + output_shape[1]), (0, 0)], mode="constant")
+                for source_pos in range(0, mixture.shape[0], output_shape[1]):
+                    window = padded[np.newaxis, source_pos:source_pos + input_shape[1]]
+                    for index, (abs_mean, mean) in enumerate(sess.run(statistics, feed_dict={mix: window})):
+                        sums[index][0] += abs_mean
+                        sums[index][1] += mean
+                    num_windows += 1
+    assert num_windows > 0
+    return [s[0] / num_windows for s in sums], [s[1] / num_windows for s in sums]
+
+def select_filters(scores, num_filters):
+    '''
+    Selects the highest scoring filters of each convolution
+    :return: List of sorted index arrays of the filters to keep, one per convolution
+    '''
+    return [np.sort(np.argsort(-score, kind="mergesort")[:n]) for score, n in zip(scores, num_filters)]
+
+def prune_variables(variables, separator, keep, replacements):
+    '''
+    Removes all filters not listed in keep from the separator weights. Where the output of a removed filter reaches the
+    next convolution unchanged (up to interpolation and decimation), its replacement value is folded into the bias of
+    that convolution.
+    :param variables: Dictionary from variable name to numpy array, as returned by load_variables
+    :param separator: Separator object of the unpruned network
+    :param keep: Filters to keep per convolution, as returned by select_filters
+    :param replacements: Constant value per filter that approximates its output, see magnitude_scores and activation_scores
+    :return: Dictionary with the pruned variables
+    '''
+    L = separator.num_layers
+    conditional = isinstance(separator, Models.ConditionalUnetAudioSeparator.UnetAudioSeparator)
+    num_heads = separator.num_sources if separator.output_type == "direct" else separator.num_sources - 1
+    widths = [separator.get_num_filters(index) for index in range(2 * L + 1)]
+
+    def layout(source, filters):
+        # Channels of the decoder input derived from the given filters of a convolution. The conditional separator
+        # multiplies each bottleneck filter with every source weight, giving channel f * num_sources + s
+        if conditional and source == L:
+            return [f * separator.num_sources + s for f in filters for s in range(separator.num_sources)]
+        return list(filters)
+
+    def upsampled_source(level):
+        # Convolution whose output is up-sampled in the given decoder level
+        return L if level == 0 else L + level
+
+    # Input of each consumer as list of parts (producing convolution or None for the mixture, number of channels)
+    consumers = dict()
+    for index in range(1, L + 1):
+        consumers[_scope(index)] = [(index - 1, widths[index - 1])]
+    for level in range(L):
+        source = upsampled_source(level)
+        consumers[_scope(L + 1 + level)] = [(L - 1 - level, widths[L - 1 - level]), (source, len(layout(source, range(widths[source]))))]
+    for head in range(num_heads):
+        consumers[_scope(2 * L + 1 + head)] = [(None, separator.num_channels), (2 * L, widths[2 * L])]
+
+    pruned = dict(variables)
+
+    # Fold constant replacements of removed filters into the biases of their consumers
+    for scope, parts in consumers.items():
+        offset = 0
+        for source, width in parts:
+            foldable = source is not None and not (source == L and (conditional or separator.bottleneck_dilations))
+            if foldable:
+                for f in sorted(set(range(widths[source])) - set(keep[source])):
+                    channel = offset + f
+                    if scope + "/pointwise_kernel" in variables:
+                        taps = np.sum(variables[scope + "/depthwise_kernel"][:, channel, 0])
+                        contribution = taps * variables[scope + "/pointwise_kernel"][0, channel, :]
+                    else:
+                        contribution = np.sum(variables[scope + "/kernel"][:, channel, :], axis=0)
+                    pruned[scope + "/bias"] = pruned[scope + "/bias"] + replacements[source][f] * contribution
+            offset += width
+
+    # Remove output filters of every convolution
+    for index in range(2 * L + 1):
+        scope = _scope(index)
+        for name in ["/kernel", "/pointwise_kernel", "/bias"]:
+            if scope + name in pruned:
+                pruned[scope + name] = pruned[scope + name][..., keep[index]]
+
+    # Remove the corresponding input channels of their consumers
+    for scope, parts in consumers.items():
+        channels, offset = list(), 0
+        for source, width in parts:
+            filters = range(width) if source is None else layout(source, keep[source])
+            channels.extend([offset + c for c in filters])
+            offset += width
+        for name in ["/kernel", "/depthwise_kernel", "/pointwise_kernel"]:
+            if scope + name in pruned:
+                pruned[scope + name] = pruned[scope + name][:, channels, :]
+
+    # Learned interpolation weights and dilated bottleneck convolutions
+    for level in range(L):
+        name = "separator/interp_" + str(level)
+        if name in pruned:
+            source = upsampled_source(level)
+            pruned[name] = pruned[name][layout(source, keep[source])]
+    for i in range(len(separator.bottleneck_dilations)):
+        scope = "separator/bottleneck_dilated_" + str(i)
+        pruned[scope + "/kernel"] = pruned[scope + "/kernel"][:, keep[L], :][:, :, keep[L]]
+        pruned[scope + "/bias"] = pruned[scope + "/bias"][keep[L]]
+
+    return pruned
+
+def prune(model_config, checkpoint, output_dir, method="magnitude", ratio=0.5, num_filters=None, mixtures=None, conditional=True):
+    '''
+    Prunes the separator of a checkpoint and writes the pruned checkpoint and the configuration entries describing it.
+    :param model_config: Model configuration dictionary of the checkpoint
+    :param checkpoint: Checkpoint path
+    :param output_dir: Folder for the pruned checkpoint and pruned_config.json
+    :param method: Filter scoring method, "magnitude" or "activation"
+    :param ratio: Fraction of the filters to remove from each convolution
+    :param num_filters: Number of filters to keep per convolution, overrides ratio
+    :param mixtures: Mixture signals used by activation scoring, see activation_scores
+    :param conditional: Whether the checkpoint contains the conditional separator
+    :return: Configuration entries of the pruned separator, to be merged into model_config
+    '''
+    config = dict(model_config)
+    config["precision"] = "float32"
+    separator = Models.Separators.get_separator(config, conditional)
+    variables = load_variables(checkpoint)
+
+    if method == "magnitude":
+        scores, replacements = magnitude_scores(variables, separator)
+    elif method == "activation":
+        scores, replacements = activation_scores(separator, checkpoint, mixtures, model_config["num_frames"])
+    else:
+        raise ValueError("Unknown pruning method " + str(method))
+
+    if num_filters is None:
+        num_filters = [max(1, int(round(len(score) * (1.0 - ratio)))) for score in scores]
+    keep = select_filters(scores, num_filters)
+    pruned = prune_variables(variables, separator, keep, replacements)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pruned_config = {"num_filters": [int(n) for n in num_filters],
+                     "init_checkpoint": save_variables(pruned, os.path.join(output_dir, "pruned.ckpt"))}
+    with open(os.path.join(output_dir, "pruned_config.json"), "w") as f:
+        json.dump({"model_config": pruned_config}, f, indent=2)
+    return pruned_config
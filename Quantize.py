@@ -0,0 +1,102 @@
+'''
+Post-training int8 quantization of the separator for CPU inference. The float32 separator of a checkpoint is converted
+to a TensorFlow Lite model whose weights and activations are quantized to int8, with activation ranges calibrated on
+windows of real mixtures. Operations without int8 kernel fall back to float.
+'''
+
+import json
+import numpy as np
+import tensorflow as tf
+
+import Models.Separators
+import Planner
+
+def get_calibration_windows(mixtures, input_shape, output_shape, max_windows=100):
+    '''
+    Cuts mixtures into network input windows like the prediction does, for calibrating activation ranges.
+    :param mixtures: List of mixture signals [n_frames, n_channels] at the sampling rate and channels of the model
+    :param input_shape: Input shape of the separator [1, num_samples, num_channels]
+    :param output_shape: Output shape of the separator [1, num_samples, num_channels]
+    :param max_windows: Maximum number of windows, taken evenly from all mixtures
+    :return: List of windows [1, input_samples, num_channels]
+    '''
+    pad_time_frames = (input_shape[1] - output_shape[1]) // 2
+    windows = list()
+    for mixture in mixtures:
+        padded = np.pad(mixture, [(pad_time_frames, pad_time_frames + output_shape[1]), (0, 0)], mode="constant")
+        windows.extend([padded[np.newaxis, pos:pos + input_shape[1]].astype(np.float32) for pos in range(0, mixture.shape[0], output_shape[1])])
+    if len(windows) > max_windows:
+        windows = [windows[i] for i in np.linspace(0, len(windows) - 1, max_windows).astype(np.int64)]
+    return windows
+
+def quantize(model_config, checkpoint, mixtures, tflite_path, max_windows=100):
+    '''
+    Converts the separator of a checkpoint into an int8 TensorFlow Lite model for the configured inference window.
+    The input and output shapes and the order of the source outputs are written to tflite_path + ".json".
+    :param model_config: Model configuration dictionary
+    :param checkpoint: Checkpoint path of the (unconditional) separator
+    :param mixtures: Calibration mixtures [n_frames, n_channels] at the sampling rate and channels of the model
+    :param tflite_path: Path of the TensorFlow Lite model to write
+    :param max_windows: Number of calibration windows
+    :return: tflite_path
+    '''
+    config = dict(model_config)
+    config["precision"] = "float32"
+    separator = Models.Separators.get_separator(config)
+    num_frames = Planner.get_inference_frames(config, separator, 1)
+    input_shape, output_shape = separator.get_padding(np.array([1, num_frames, 0]))
+    input_shape, output_shape = [int(d) for d in input_shape], [int(d) for d in output_shape]
+
+    with tf.Graph().as_default():
+        mix = tf.placeholder(tf.float32, input_shape, name="mix")
+        separator_sources = separator.get_output(mix, False, reuse=False)
+        with tf.Session() as sess:
+            tf.train.Saver(tf.global_variables()).restore(sess, checkpoint)
+
+            windows = get_calibration_windows(mixtures, input_shape, output_shape, max_windows)
+            def representative_dataset():
+                for window in windows:
+                    yield [window]
+
+            converter = tf.lite.TFLiteConverter.from_session(sess, [mix], separator_sources)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+            tflite_model = converter.convert()
+
+    with open(tflite_path, "wb") as f:
+        f.write(tflite_model)
+    with open(tflite_path + ".json", "w") as f:
+        json.dump({"input_shape": input_shape,
+                   "output_shape": output_shape,
+                   "output_names": [source.name.split(":")[0] for source in separator_sources]}, f, indent=2)
+    return tflite_path
+
+class TFLiteSeparator:
+    '''
+    Runs a separator converted by quantize. Calling it with a mixture window [1, input_samples, num_channels] returns
+    the list of source estimates [1, output_samples, num_channels], so it can be used as run_fn of Evaluate.predict_track_fn.
+    '''
+
+    def __init__(self, tflite_path, num_threads=None):
+        '''
+        :param tflite_path: Quantized model written by quantize
+        :param num_threads: Number of threads of the interpreter, None for its default
+        '''
+        with open(tflite_path + ".json", "r") as f:
+            description = json.load(f)
+        self.input_shape = description["input_shape"]
+        self.output_shape = description["output_shape"]
+
+        if num_threads is None:
+            self.interpreter = tf.lite.Interpreter(model_path=tflite_path)
+        else:
+            self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        output_indices = dict((detail["name"], detail["index"]) for detail in self.interpreter.get_output_details())
+        self.output_indices = [output_indices[name] for name in description["output_names"]]
+
+    def __call__(self, mix_part):
+        self.interpreter.set_tensor(self.input_index, mix_part.astype(np.float32))
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(index) for index in self.output_indices]
@@ -0,0 +1,131 @@
+'''
+Polyphase resampling with Kaiser-windowed sinc filters. The sampling rate ratio is reduced to a fraction up/down (e.g.
+44100 -> 22050 is 1/2) and the anti-aliasing filter for each fraction and quality is designed only once per process.
+All channels and sources of a signal are resampled in one call. The quality settings follow the "kaiser_fast" and
+"kaiser_best" filters of resampy, which librosa uses, so resampling results stay comparable to librosa.resample.
+'''
+
+from fractions import Fraction
+import numpy as np
+import scipy.signal
+
+# Quality: (zero crossings of the sinc on each side, cutoff relative to the Nyquist frequency, Kaiser beta)
+QUALITIES = {"kaiser_fast": (16, 0.85, 8.555),
+             "kaiser_best": (64, 0.9475937, 14.769656459379492)}
+
+# Filters designed in this process, by (up, down, quality)
+_filters = dict()
+
+def get_ratio(orig_sr, target_sr):
+    '''
+    :return: Up- and down-sampling factors of the reduced sampling rate ratio
+    '''
+    ratio = Fraction(int(target_sr), int(orig_sr))
+    return ratio.numerator, ratio.denominator
+
+def get_filter(up, down, quality="kaiser_best"):
+    '''
+    Returns the anti-aliasing low-pass filter for resampling by up/down, designing it on the first call.
+    :param up: Up-sampling factor
+    :param down: Down-sampling factor
+    :param quality: Key of QUALITIES
+    :return: Linear-phase FIR filter of odd length, at the up-sampled rate
+    '''
+    key = (up, down, quality)
+    if key not in _filters:
+        if quality not in QUALITIES:
+            raise ValueError("Unknown resampling quality " + str(quality))
+        num_zeros, rolloff, beta = QUALITIES[quality]
+        max_rate = max(up, down)
+        _filters[key] = scipy.signal.firwin(2 * num_zeros * max_rate + 1, rolloff / max_rate, window=("kaiser", beta))
+    return _filters[key]
+
+def resample(audio, orig_sr, target_sr, quality="kaiser_best", axis=0):
+    '''
+    Changes the sampling rate of a signal.
+    :param audio: Signal of any shape, e.g. [n_frames, n_channels] or all sources of a track [n_sources, n_frames, n_channels]
+    :param orig_sr: Sampling rate of audio
+    :param target_sr: Desired sampling rate
+    :param quality: Key of QUALITIES
+    :param axis: Time axis of audio
+    :return: Resampled signal with ceil(n_frames * target_sr / orig_sr) frames along axis, in the dtype of audio
+    '''
+    up, down = get_ratio(orig_sr, target_sr)
+    if up == down:
+        return audio
+    resampled = scipy.signal.resample_poly(audio, up, down, axis=axis, window=get_filter(up, down, quality))
+    return resampled.astype(audio.dtype)
+
+class BlockResampler:
+    '''
+    Resamples a signal arriving in blocks of frames, with constant memory. The concatenated output of process and
+    flush equals resample applied to the whole signal.
+    '''
+
+    def __init__(self, orig_sr, target_sr, num_channels, quality="kaiser_best"):
+        '''
+        :param orig_sr: Sampling rate of the input blocks
+        :param target_sr: Desired sampling rate
+        :param num_channels: Number of channels of the input blocks [n_frames, n_channels]
+        :param quality: Key of QUALITIES
+        '''
+        self.up, self.down = get_ratio(orig_sr, target_sr)
+        self.num_channels = num_channels
+        # Equal rates are passed through unfiltered, like in resample
+        self.passthrough = self.up == self.down
+        h = get_filter(self.up, self.down, quality) * self.up
+        self.half_len = (len(h) - 1) // 2
+        # Polyphase decomposition: output frame m uses phase (m * down + half_len) % up and the taps of that phase
+        # are applied to the input frames ending at (m * down + half_len) // up, newest first
+        self.num_taps = (len(h) + self.up - 1) // self.up
+        h = np.pad(h, [(0, self.num_taps * self.up - len(h))], mode="constant")
+        self.phases = h.reshape([self.num_taps, self.up]).T # [up, num_taps]
+
+        # Input frames from absolute frame buffer_start on, preceded by zeros before the signal start
+        self.buffer = np.zeros((self.num_taps - 1, num_channels), np.float32)
+        self.buffer_start = -(self.num_taps - 1)
+        self.num_input = 0 # Number of input frames received so far
+        self.num_output = 0 # Number of output frames returned so far
+
+    def _compute(self, end):
+        # Output frames num_output to end (exclusive), assuming all input frames they need are in the buffer
+        m = np.arange(self.num_output, end)
+        pos = m * self.down + self.half_len
+        last = pos // self.up
+        indices = last[:, np.newaxis] - np.arange(self.num_taps)[np.newaxis, :] - self.buffer_start
+        output = np.einsum("mt,mtc->mc", self.phases[pos % self.up], self.buffer[indices])
+        self.num_output = end
+
+        # Drop input frames that no later output frame needs
+        first_needed = (end * self.down + self.half_len) // self.up - (self.num_taps - 1)
+        drop = max(0, min(first_needed - self.buffer_start, self.buffer.shape[0]))
+        self.buffer = self.buffer[drop:]
+        self.buffer_start += drop
+        return output.astype(np.float32)
+
+    def process(self, block):
+        '''
+        :param block: Next input frames [n_frames, n_channels]
+        :return: All output frames [n_out, n_channels] that can be computed from the input received so far
+        '''
+        if self.passthrough:
+            return block.astype(np.float32)
+        self.buffer = np.concatenate([self.buffer, block.astype(np.float32)], axis=0)
+        self.num_input += block.shape[0]
+        # Output frame m is complete once its newest input frame (m * down + half_len) // up has arrived
+        end = max(self.num_output, ((self.num_input - 1) * self.up - self.half_len) // self.down + 1)
+        return self._compute(end)
+
+    def flush(self):
+        '''
+        Ends the signal, frames after its end are zero.
+        :return: Remaining output frames [n_out, n_channels]
+        '''
+        if self.passthrough:
+            return np.zeros((0, self.num_channels), np.float32)
+        total = (self.num_input * self.up + self.down - 1) // self.down
+        needed = (total * self.down + self.half_len) // self.up + 1
+        missing = needed - (self.buffer_start + self.buffer.shape[0])
+        if missing > 0:
+            self.buffer = np.pad(self.buffer, [(0, missing), (0, 0)], mode="constant")
+        return self._compute(total)
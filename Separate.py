@@ -0,0 +1,231 @@
+'''
+Separation of arbitrarily long recordings with constant memory. The mixture is read block by block from an audio file
+or as raw PCM from a pipe, resampled to the model rate incrementally, and separated as soon as enough input for the
+next windows has arrived. Source estimates are resampled back and appended to their output files by a background
+thread. Only the current block, one batch of inference windows and the resampling filter histories are held in
+memory, independent of the length of the recording. The estimates equal those of Evaluate.predict_track_fn followed
+by Evaluate.make_estimates.
+'''
+
+import os
+import numpy as np
+import soundfile
+
+import Resample
+import Pipeline
+
+# Raw PCM sample formats read from pipes: numpy dtype and scale to [-1, 1]
+PCM_DTYPES = {"int16": ("<i2", 1.0 / 32768.0),
+              "int32": ("<i4", 1.0 / 2147483648.0),
+              "float32": ("<f4", 1.0)}
+
+class BlockSeparator:
+    '''
+    Separates a mixture arriving in blocks of frames. The concatenated outputs of process and flush are the source
+    estimates at the sampling rate and with the channels of the mixture.
+    '''
+
+    def __init__(self, model_config, run_fn, mix_sr, mix_channels, input_time_frames, output_time_frames, batch_size=1):
+        '''
+        :param model_config: Model configuration dictionary
+        :param run_fn: Function mapping mixture windows [n_windows, input_time_frames, n_channels] with n_windows <= batch_size to the list of source estimates [n_windows, output_time_frames, n_channels], see Evaluate.predict_track_fn
+        :param mix_sr: Sampling rate of the mixture blocks
+        :param mix_channels: Number of channels of the mixture blocks
+        :param input_time_frames: Input length of the separator
+        :param output_time_frames: Output length of the separator
+        :param batch_size: Maximum number of windows passed to run_fn at once. Before the end of the mixture, windows are
+        held back until a whole batch is complete. None: all complete windows are passed to run_fn in one call as soon
+        as they are complete, e.g. for Server.BatchScheduler, which forms the batches itself
+        '''
+        self.model_config = model_config
+        self.run_fn = run_fn
+        self.mix_channels = mix_channels
+        self.input_time_frames = input_time_frames
+        self.output_time_frames = output_time_frames
+        self.batch_size = batch_size
+        model_channels = 1 if model_config["mono_downmix"] else 2
+        # Same filters as Evaluate.prepare_mix and Evaluate.make_estimates
+        self.mix_resampler = Resample.BlockResampler(mix_sr, model_config["expected_sr"], model_channels, "kaiser_fast")
+        self.source_resamplers = [Resample.BlockResampler(model_config["expected_sr"], mix_sr, model_channels)
+                                  for _ in range(model_config["num_sources"])]
+
+        # Mixture at the model rate from frame -pad_time_frames on, the front padding is silence
+        pad_time_frames = (input_time_frames - output_time_frames) // 2
+        self.buffer = np.zeros((pad_time_frames, model_channels), np.float32)
+        self.num_mix = 0 # Number of mixture frames at the model rate received so far
+        self.num_separated = 0 # Number of source frames at the model rate computed so far
+
+    @property
+    def num_channels(self):
+        '''
+        :return: Number of channels of the source estimates
+        '''
+        if self.model_config["mono_downmix"]:
+            return self.mix_channels
+        return 2
+
+    def _prepare(self, block):
+        # Channels of the model, like Evaluate.prepare_mix
+        if self.model_config["mono_downmix"]:
+            return np.mean(block, axis=1, keepdims=True)
+        if block.shape[1] == 1:
+            return np.tile(block, [1, 2])
+        return block
+
+    def _add_mix(self, mix_block):
+        self.buffer = np.concatenate([self.buffer, mix_block], axis=0)
+        self.num_mix += mix_block.shape[0]
+
+    def _separate(self, final):
+        # Runs all complete windows of the buffer. Before the end of the mixture, only whole batches are run
+        num_windows = 0
+        if self.buffer.shape[0] >= self.input_time_frames:
+            num_windows = (self.buffer.shape[0] - self.input_time_frames) // self.output_time_frames + 1
+        batch_size = self.batch_size or max(num_windows, 1)
+        if not final:
+            num_windows -= num_windows % batch_size
+
+        source_parts = [list() for _ in range(self.model_config["num_sources"])]
+        for window_pos in range(0, num_windows, batch_size):
+            batch_windows = min(batch_size, num_windows - window_pos)
+            start = window_pos * self.output_time_frames
+            windows = np.stack([self.buffer[start + i * self.output_time_frames:start + i * self.output_time_frames + self.input_time_frames]
+                                for i in range(batch_windows)])
+            for i, parts in enumerate(self.run_fn(windows)):
+                source_parts[i].append(parts.reshape([-1, parts.shape[2]]))
+
+        num_frames = num_windows * self.output_time_frames
+        self.buffer = self.buffer[num_frames:]
+        # Estimates after the end of the mixture are dropped
+        num_valid = min(num_frames, self.num_mix - self.num_separated)
+        self.num_separated += num_valid
+
+        sources = list()
+        for resampler, parts in zip(self.source_resamplers, source_parts):
+            if len(parts) > 0:
+                source = resampler.process(np.concatenate(parts, axis=0)[:num_valid])
+            else:
+                source = np.zeros((0, self.buffer.shape[1]), np.float32)
+            if final:
+                source = np.concatenate([source, resampler.flush()], axis=0)
+            sources.append(self._to_output(source))
+        return sources
+
+    def _to_output(self, source):
+        # Duplicate mono estimates for multichannel mixtures, like Evaluate.make_estimates
+        if self.model_config["mono_downmix"] and self.mix_channels > 1:
+            return np.tile(source, [1, self.mix_channels])
+        return source
+
+    def process(self, block):
+        '''
+        :param block: Next mixture frames [n_frames, mix_channels]
+        :return: List of the source estimates [n_out, n_channels] that can be computed from the mixture received so far
+        '''
+        self._add_mix(self.mix_resampler.process(self._prepare(np.asarray(block, np.float32))))
+        return self._separate(False)
+
+    def flush(self):
+        '''
+        Ends the mixture and separates its remaining frames, padded with silence up to the last output window.
+        :return: List of the remaining source estimates [n_out, n_channels]
+        '''
+        self._add_mix(self.mix_resampler.flush())
+        missing = self.num_mix - self.num_separated
+        num_windows = (missing + self.output_time_frames - 1) // self.output_time_frames
+        needed = 0 if num_windows == 0 else (num_windows - 1) * self.output_time_frames + self.input_time_frames
+        if needed > self.buffer.shape[0]:
+            self.buffer = np.pad(self.buffer, [(0, needed - self.buffer.shape[0]), (0, 0)], mode="constant")
+        return self._separate(True)
+
+def read_pcm_blocks(stream, num_channels, dtype="int16", block_frames=44100):
+    '''
+    Reads interleaved raw PCM from a binary stream, e.g. sys.stdin.buffer fed by "ffmpeg -f s16le -".
+    :param stream: Binary file object
+    :param num_channels: Number of interleaved channels
+    :param dtype: Key of PCM_DTYPES
+    :param block_frames: Number of frames per block
+    :return: Generator of blocks [n_frames, num_channels] in float32, until the end of the stream
+    '''
+    if dtype not in PCM_DTYPES:
+        raise ValueError("Unknown PCM sample format " + str(dtype))
+    np_dtype, scale = PCM_DTYPES[dtype]
+    frame_bytes = np.dtype(np_dtype).itemsize * num_channels
+    remainder = b""
+    while True:
+        data = stream.read(block_frames * frame_bytes)
+        if not data:
+            break
+        # Pipes may return partial frames, which are completed by the next read
+        data = remainder + data
+        num_bytes = len(data) - len(data) % frame_bytes
+        remainder = data[num_bytes:]
+        if num_bytes > 0:
+            yield np.frombuffer(data[:num_bytes], np_dtype).reshape([-1, num_channels]).astype(np.float32) * scale
+    if len(remainder) > 0:
+        print("WARNING: Ignoring " + str(len(remainder)) + " bytes of an incomplete frame at the end of the PCM stream")
+
+def separate_blocks(model_config, run_fn, blocks, mix_sr, mix_channels, input_time_frames, output_time_frames, batch_size, output_dir, max_pending=4):
+    '''
+    Separates a mixture given as blocks and writes each source to output_dir/source_<i>.wav while separating.
+    :param blocks: Iterable of mixture blocks [n_frames, mix_channels] at sampling rate mix_sr
+    :param output_dir: Output folder
+    :param max_pending: Maximum number of estimate blocks waiting to be written
+    :return: List of the written file paths
+    See BlockSeparator for the other parameters.
+    '''
+    separator = BlockSeparator(model_config, run_fn, mix_sr, mix_channels, input_time_frames, output_time_frames, batch_size)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    paths = [os.path.join(output_dir, "source_" + str(i) + ".wav") for i in range(model_config["num_sources"])]
+    files = [soundfile.SoundFile(path, "w", samplerate=mix_sr, channels=separator.num_channels, format="WAV", subtype="FLOAT") for path in paths]
+
+    def write(sources):
+        for f, source in zip(files, sources):
+            f.write(source)
+
+    writer = Pipeline.BackgroundWorker(write, max_pending)
+    try:
+        for block in blocks:
+            writer.put(separator.process(block))
+        writer.put(separator.flush())
+    finally:
+        writer.close()
+        for f in files:
+            f.close()
+    return paths
+
+def separate_file(model_config, run_fn, input_path, input_time_frames, output_time_frames, batch_size, output_dir, block_seconds=10.0, offset=0.0, duration=None):
+    '''
+    Separates (a section of) an audio file, reading it block by block.
+    :param input_path: Audio file readable by soundfile
+    :param block_seconds: Length of the blocks read at once
+    :param offset: Start of the separated section in seconds
+    :param duration: Length of the separated section in seconds, None for the rest of the file
+    :return: List of the written file paths
+    See separate_blocks for the other parameters.
+    '''
+    with soundfile.SoundFile(input_path, "r") as f:
+        start = int(offset * f.samplerate)
+        num_frames = f.frames - start if duration is None else min(int(duration * f.samplerate), f.frames - start)
+        f.seek(start)
+        blocks = f.blocks(blocksize=int(block_seconds * f.samplerate), frames=num_frames, dtype="float32", always_2d=True)
+        return separate_blocks(model_config, run_fn, blocks, f.samplerate, f.channels, input_time_frames, output_time_frames, batch_size, output_dir)
+
+def write_sources(model_config, separator_preds, mix_sr, mix_channels, output_dir):
+    '''
+    Writes source estimates at the model sampling rate to output_dir/source_<i>.wav, at the sampling rate and with the
+    channels of the mixture like Evaluate.make_estimates.
+    :param separator_preds: List of source estimates [n_frames, n_channels] at the model sampling rate
+    :return: List of the written file paths
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pred_audio = Resample.resample(np.stack(separator_preds), model_config["expected_sr"], mix_sr, axis=1)
+    paths = list()
+    for i, pred in enumerate(pred_audio):
+        if model_config["mono_downmix"] and mix_channels > 1:
+            pred = np.tile(pred, [1, mix_channels])
+        paths.append(os.path.join(output_dir, "source_" + str(i) + ".wav"))
+        soundfile.write(paths[-1], pred, mix_sr, subtype="FLOAT")
+    return paths
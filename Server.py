@@ -0,0 +1,322 @@
+'''
+Resident separation service on a local TCP socket. Models are loaded once when the server starts. Each request streams
+a mixture in blocks and receives the source estimates in blocks while it is separated (see Separate.BlockSeparator),
+so the separation of long recordings starts before they are fully sent. Inference windows of concurrent requests are
+packed into shared batches by one scheduler thread per model: a batch runs as soon as it is full, or once the oldest
+waiting window has waited max_delay seconds.
+
+Messages are length-prefixed: a 4 byte big-endian length followed by the payload, an empty payload ends a stream.
+A request is a JSON header {"sample_rate", "channels", "model"}, followed by blocks of interleaved little-endian
+float32 frames. The response is a JSON header {"num_sources", "channels", "sample_rate"} or {"error"}, followed by
+blocks of float32 frames [n_frames, num_sources, channels].
+'''
+
+import json
+import socket
+import struct
+import threading
+import time
+try:
+    import socketserver
+except ImportError: # Python 2
+    import SocketServer as socketserver
+import numpy as np
+
+import Separate
+
+def send_message(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+def _receive_exactly(sock, num_bytes):
+    chunks = list()
+    while num_bytes > 0:
+        chunk = sock.recv(min(num_bytes, 1 << 20))
+        if not chunk:
+            raise IOError("Connection closed in the middle of a message")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b"".join(chunks)
+
+def receive_message(sock):
+    '''
+    :return: Payload of the next message
+    '''
+    num_bytes = struct.unpack(">I", _receive_exactly(sock, 4))[0]
+    return _receive_exactly(sock, num_bytes)
+
+class _Call:
+    # Windows of one run_fn call waiting for the scheduler
+    def __init__(self, windows):
+        self.windows = windows
+        self.next = 0 # Index of the first window not assigned to a batch yet
+        self.remaining = windows.shape[0] # Number of windows without estimates yet
+        self.results = list() # Source estimates of consecutive window ranges
+        self.arrival = time.time()
+        self.failure = None
+        self.done = threading.Event()
+
+class BatchScheduler:
+    '''
+    Shares a separator between threads. Calling it with mixture windows blocks until their source estimates are
+    computed, so it can be used as run_fn of Evaluate.predict_track_fn or Separate.BlockSeparator in each thread,
+    while the windows of all threads are separated together in batches.
+    '''
+
+    def __init__(self, run_fn, batch_size, max_delay=0.05):
+        '''
+        :param run_fn: Separator function as returned by Evaluate.load_separator, only called by the scheduler thread
+        :param batch_size: Maximum number of windows run_fn separates at once
+        :param max_delay: Seconds the oldest waiting window waits for more windows to fill a batch
+        '''
+        self.run_fn = run_fn
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = list()
+        self.condition = threading.Condition()
+        self.running = True
+        self.num_batches = 0
+        self.num_windows = 0
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, windows):
+        call = _Call(windows)
+        with self.condition:
+            self.pending.append(call)
+            self.condition.notify_all()
+        call.done.wait()
+        if call.failure is not None:
+            raise call.failure
+        return [np.concatenate([result[i] for result in call.results]) for i in range(len(call.results[0]))]
+
+    def _num_waiting(self):
+        return sum(call.windows.shape[0] - call.next for call in self.pending)
+
+    def _next_batch(self):
+        # Waits for a full batch or the deadline of the oldest window, then assigns windows in arrival order
+        with self.condition:
+            while True:
+                if not self.running:
+                    return None
+                num_waiting = self._num_waiting()
+                if num_waiting >= self.batch_size:
+                    break
+                if num_waiting > 0:
+                    wait_time = self.pending[0].arrival + self.max_delay - time.time()
+                    if wait_time <= 0:
+                        break
+                    self.condition.wait(wait_time)
+                else:
+                    self.condition.wait()
+
+            pieces = list()
+            num_windows = 0
+            while num_windows < self.batch_size and len(self.pending) > 0:
+                call = self.pending[0]
+                count = min(self.batch_size - num_windows, call.windows.shape[0] - call.next)
+                pieces.append((call, call.next, count))
+                call.next += count
+                num_windows += count
+                if call.next == call.windows.shape[0]:
+                    self.pending.pop(0)
+            return pieces
+
+    def _work(self):
+        while True:
+            pieces = self._next_batch()
+            if pieces is None:
+                return
+            windows = np.concatenate([call.windows[start:start + count] for call, start, count in pieces])
+            try:
+                source_parts = self.run_fn(windows)
+            except Exception as e:
+                for call, _, _ in pieces:
+                    call.failure = e
+                    call.done.set()
+                continue
+            self.num_batches += 1
+            self.num_windows += windows.shape[0]
+
+            position = 0
+            for call, start, count in pieces:
+                call.results.append([parts[position:position + count] for parts in source_parts])
+                position += count
+                call.remaining -= count
+                if call.remaining == 0:
+                    call.done.set()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class SeparationServer:
+    '''
+    Threaded TCP server separating streamed mixtures with resident models, see the module description.
+    '''
+
+    def __init__(self, models, address=("127.0.0.1", 0), max_delay=0.05):
+        '''
+        :param models: Dictionary from model name to (model_config, run_fn, input shape, output shape), e.g. from Evaluate.load_separator.
+        Requests without model name use the model "default", or the first name in sorted order if there is none
+        :param address: Host and port to listen on, port 0 chooses a free port
+        :param max_delay: Seconds a window may wait for a shared batch, see BatchScheduler
+        '''
+        self.models = models
+        self.default_model = "default" if "default" in models else sorted(models.keys())[0]
+        self.schedulers = dict((name, BatchScheduler(run_fn, int(sep_input_shape[0]), max_delay))
+                               for name, (_, run_fn, sep_input_shape, _) in models.items())
+
+        server = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server._handle(self.request)
+
+        self.server = _ThreadingServer(address, Handler)
+        self.address = self.server.server_address
+        self.thread = None
+
+    def _handle(self, sock):
+        header = json.loads(receive_message(sock).decode("utf-8"))
+        name = header.get("model") or self.default_model
+        if name not in self.models:
+            send_message(sock, json.dumps({"error": "Unknown model " + str(name)}).encode("utf-8"))
+            return
+        model_config, _, sep_input_shape, sep_output_shape = self.models[name]
+        # All complete windows of a block are passed to the scheduler at once, which fills batches across requests
+        separator = Separate.BlockSeparator(model_config, self.schedulers[name], header["sample_rate"], header["channels"],
+                                            sep_input_shape[1], sep_output_shape[1], None)
+        send_message(sock, json.dumps({"num_sources": model_config["num_sources"], "channels": separator.num_channels,
+                                       "sample_rate": header["sample_rate"]}).encode("utf-8"))
+
+        def send_sources(sources):
+            if sources[0].shape[0] > 0:
+                send_message(sock, np.stack(sources, axis=1).astype("<f4").tobytes())
+
+        while True:
+            payload = receive_message(sock)
+            if len(payload) == 0:
+                send_sources(separator.flush())
+                send_message(sock, b"")
+                return
+            send_sources(separator.process(np.frombuffer(payload, "<f4").reshape([-1, header["channels"]])))
+
+    def start(self):
+        '''
+        Serves requests in a background thread
+        '''
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stats(self):
+        '''
+        :return: Dictionary from model name to number of batches and mean number of windows per batch so far
+        '''
+        return dict((name, {"batches": scheduler.num_batches,
+                            "mean_batch_windows": float(scheduler.num_windows) / max(scheduler.num_batches, 1)})
+                    for name, scheduler in self.schedulers.items())
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+
+def separate(address, mix_audio, sample_rate, model=None, block_frames=44100):
+    '''
+    Local client: sends a mixture to a SeparationServer and receives its source estimates.
+    :param address: Host and port of the server
+    :param mix_audio: Mixture [n_frames, n_channels]
+    :param sample_rate: Sampling rate of mix_audio
+    :param model: Model name, None for the default model of the server
+    :param block_frames: Number of frames sent per message
+    :return: List of source estimates [n_frames, n_channels] at sample_rate
+    '''
+    sock = socket.create_connection(address)
+    try:
+        send_message(sock, json.dumps({"sample_rate": sample_rate, "channels": mix_audio.shape[1], "model": model}).encode("utf-8"))
+        header = json.loads(receive_message(sock).decode("utf-8"))
+        if "error" in header:
+            raise ValueError(header["error"])
+
+        # Send in a separate thread, so that estimates are received while the mixture is still being sent
+        def send():
+            for start in range(0, mix_audio.shape[0], block_frames):
+                send_message(sock, np.ascontiguousarray(mix_audio[start:start + block_frames], "<f4").tobytes())
+            send_message(sock, b"")
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+
+        blocks = list()
+        while True:
+            payload = receive_message(sock)
+            if len(payload) == 0:
+                break
+            blocks.append(np.frombuffer(payload, "<f4").reshape([-1, header["num_sources"], header["channels"]]))
+        sender.join()
+    finally:
+        sock.close()
+    sources = np.concatenate(blocks) if len(blocks) > 0 else np.zeros([0, header["num_sources"], header["channels"]], np.float32)
+    return [sources[:, i] for i in range(header["num_sources"])]
+
+def load_test(address, num_clients=4, requests_per_client=5, seconds=10.0, sample_rate=44100, channels=2, model=None):
+    '''
+    Sends random mixtures from concurrent clients and measures the latency of each request, from sending its first
+    block to receiving its last estimates.
+    :param num_clients: Number of concurrent client threads
+    :param requests_per_client: Number of consecutive requests of each client
+    :param seconds: Duration of each mixture
+    :return: Dictionary with number of requests, wall-clock seconds, throughput (seconds of audio per second) and latencies
+    '''
+    latencies = list()
+    lock = threading.Lock()
+    failures = list()
+
+    def client(seed):
+        rng = np.random.RandomState(seed)
+        try:
+            for _ in range(requests_per_client):
+                mix_audio = rng.uniform(-0.5, 0.5, [int(seconds * sample_rate), channels]).astype(np.float32)
+                start = time.time()
+                separate(address, mix_audio, sample_rate, model)
+                with lock:
+                    latencies.append(time.time() - start)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(num_clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.time() - start
+    if len(failures) > 0:
+        raise failures[0]
+
+    return {"clients": num_clients,
+            "requests": len(latencies),
+            "wall_seconds": wall_seconds,
+            "throughput": len(latencies) * seconds / wall_seconds,
+            "latency_mean": float(np.mean(latencies)),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p99": float(np.percentile(latencies, 99))}
+
+def print_load_report(report, stats=None):
+    print("Clients: " + str(report["clients"]) + ", requests: " + str(report["requests"]) + ", wall-clock seconds: " + str(report["wall_seconds"]))
+    print("Throughput: " + str(report["throughput"]) + " seconds of audio per second")
+    print("Latency: mean " + str(report["latency_mean"]) + ", p50 " + str(report["latency_p50"]) + ", p99 " + str(report["latency_p99"]) + " seconds")
+    for name, model_stats in sorted((stats or dict()).items()):
+        print("Model " + name + ": " + str(model_stats["batches"]) + " batches, " + str(model_stats["mean_batch_windows"]) + " windows per batch")
@@ -3,8 +3,12 @@ import numpy as np
 import os
 
 from Input import Input as Input
-import Models.UnetAudioSeparator
+import Models.Separators
 import Evaluate
+import Export
+import Planner
+import Pipeline
+import Metrics
 import Utils
 import functools
 from tensorflow.python.ops.signal import window_ops
@@ -12,48 +16,56 @@ from tensorflow.python.ops.signal import window_ops
 import librosa
 
 def test(model_config, audio_list, model_folder, load_model):
-    # Determine input and output shapes
-    disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]  # Shape of discriminator input
-    separator_class = Models.UnetAudioSeparator.UnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
-                                                                   output_type=model_config["output_type"],
-                                                                   context=model_config["context"],
-                                                                   mono=model_config["mono_downmix"],
-                                                                   upsampling=model_config["upsampling"],
-                                                                   num_sources=model_config["num_sources"],
-                                                                   filter_size=model_config["filter_size"],
-                                                                   merge_filter_size=model_config["merge_filter_size"])
-
+    # Determine input and output shapes. The model is fully convolutional, so the inference window can be larger than in training
+    separator_class = Models.Separators.get_separator(model_config)
+    num_frames = Planner.get_inference_frames(model_config, separator_class)
+    disc_input_shape = [model_config["batch_size"], num_frames, 0]  # Shape of discriminator input
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
     separator_func = separator_class.get_output
 
     # Creating the batch generators
     assert ((sep_input_shape[1] - sep_output_shape[1]) % 2 == 0)
 
-    # Batch size of 1
-    sep_input_shape[0] = 1
-    sep_output_shape[0] = 1
-
-    mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+    # Number of windows separated together
+    sep_input_shape[0] = Planner.get_inference_batch_size(model_config, separator_class, num_frames)
+    sep_output_shape[0] = sep_input_shape[0]
 
     print("Testing...")
 
-    # BUILD MODELS
-    # Separator
-    separator_sources = separator_func(mix_context, False, False, reuse=False)
-
-    global_step = tf.get_variable('global_step', [], initializer=tf.constant_initializer(0), trainable=False, dtype=tf.int64)
-
-    # Start session and queue input threads
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    writer = tf.summary.FileWriter(model_config["log_dir"] + os.path.sep +  model_folder, graph=sess.graph)
-
-    # CHECKPOINTING
-    # Load pretrained model to test
-    restorer = tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2)
-    print("Num of variables" + str(len(tf.global_variables())))
-    restorer.restore(sess, load_model)
-    print('Pre-trained model restored for testing')
+    if model_config.get("export_dir") is not None:
+        # Frozen separator written by Export.export, loaded once per process
+        inference_separator = Export.load(model_config["export_dir"], model_config.get("xla", False))
+        sep_input_shape, sep_output_shape = inference_separator.input_shape, inference_separator.output_shape
+
+        sess = tf.Session()
+        writer = tf.summary.FileWriter(model_config["log_dir"] + os.path.sep + model_folder)
+        _global_step = inference_separator.global_step
+        run_fn = inference_separator
+    else:
+        mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+
+        # BUILD MODELS
+        # Separator
+        separator_sources = separator_func(mix_context, False, False, reuse=False)
+
+        global_step = tf.get_variable('global_step', [], initializer=tf.constant_initializer(0), trainable=False, dtype=tf.int64)
+
+        # Start session and queue input threads
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        writer = tf.summary.FileWriter(model_config["log_dir"] + os.path.sep +  model_folder, graph=sess.graph)
+
+        # CHECKPOINTING
+        # Load pretrained model to test
+        restorer = tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2)
+        print("Num of variables" + str(len(tf.global_variables())))
+        restorer.restore(sess, load_model)
+        print('Pre-trained model restored for testing')
+        _global_step = sess.run(global_step)
+        run_fn = Evaluate.get_session_run_fn(sess, separator_sources, mix_context)
+
+    # Quiet windows are not separated if model_config["inference_silence_threshold"] is set
+    run_fn = Evaluate.get_silence_skipping_run_fn(model_config, run_fn, sep_output_shape[1])
 
     input_audio = tf.placeholder(tf.float32, shape=[None, 1])
     window = functools.partial(window_ops.hann_window, periodic=True)
@@ -61,44 +73,59 @@ def test(model_config, audio_list, model_folder, load_model):
                                         fft_length=1024, window_fn=window)
     mag = tf.abs(stft)
 
-    # Start training loop
-    _global_step = sess.run(global_step)
     print("Starting!")
 
-    total_loss = 0.0
-    total_samples = 0
-    for sample in audio_list: # Go through all tracks
-        # Load mixture and fetch prediction for mixture
+    def load(sample):
+        # Mixture and original sources at the model sampling rate, decoded by the prefetching threads
         mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
-        sources_pred = Evaluate.predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context)
-
-        # Load original sources
+        mix_audio = Evaluate.prepare_mix(model_config, mix_audio, mix_sr)
         sources_gt = list()
         for s in sample[1:]:
             s_audio, _ = Utils.load(s.path, sr=model_config["expected_sr"], mono=model_config["mono_downmix"], res_type="kaiser_fast")
             sources_gt.append(s_audio)
+        return mix_audio, sources_gt
 
+    def compute_loss(path, sources_gt, sources_pred):
         # Determine mean squared error
+        loss, samples = 0.0, 0
         for (source_gt, source_pred) in zip(sources_gt, sources_pred):
             if model_config["network"] == "unet_spectrogram" and not model_config["raw_audio_loss"]:
                 real_mag = sess.run(mag, feed_dict={input_audio : source_gt})
                 pred_mag = sess.run(mag, feed_dict={input_audio: source_pred})
-                total_loss += np.sum(np.abs(real_mag - pred_mag))
-                total_samples += np.prod(real_mag.shape)  # Number of entries is product of number of sources and number of outputs per source
+                loss += np.sum(np.abs(real_mag - pred_mag))
+                samples += np.prod(real_mag.shape)  # Number of entries is product of number of sources and number of outputs per source
             else:
-                total_loss += np.sum(np.square(source_gt - source_pred))
-                total_samples += np.prod(source_gt.shape)  # Number of entries is product of number of sources and number of outputs per source
-
-        print("MSE for track " + sample[0].path + ": " + str(total_loss / float(total_samples)))
+                loss += np.sum(np.square(source_gt - source_pred))
+                samples += np.prod(source_gt.shape)  # Number of entries is product of number of sources and number of outputs per source
+        print("MSE for track " + path + ": " + str(loss / float(samples)))
+
+        # Framewise metrics on one second frames, without BSS Eval
+        metrics = Metrics.framewise_metrics(np.stack(sources_gt), np.stack(sources_pred), model_config["expected_sr"], model_config["expected_sr"])
+        print("Median metrics for track " + path + ": " + ", ".join(name + " " + str(np.nanmedian(metrics[name])) for name in Metrics.METRICS))
+        return loss, samples, metrics
+
+    # Upcoming tracks are loaded and losses computed in background threads while the current track is separated
+    metrics = Pipeline.BackgroundWorker(compute_loss, model_config.get("test_max_pending", 2))
+    for sample, (mix_audio, sources_gt) in Pipeline.prefetch(audio_list, load, model_config.get("test_num_workers", 2), model_config.get("test_max_pending", 2)):
+        sources_pred = Evaluate.predict_track_fn(model_config, run_fn, mix_audio, model_config["expected_sr"], sep_input_shape[1], sep_output_shape[1], sep_input_shape[0])
+        metrics.put(sample[0].path, sources_gt, sources_pred)
+    losses = metrics.close()
+    if isinstance(run_fn, Evaluate.SilenceSkipper):
+        print(run_fn.summary())
+    total_loss = sum(loss for loss, _, _ in losses)
+    total_samples = sum(samples for _, samples, _ in losses)
     mean_mse_loss = total_loss / float(total_samples)
+    # Median over all sources and frames of all tracks, like the SDR statistics of museval results
+    median_metrics = dict((name, float(np.nanmedian(np.concatenate([metrics[name].flatten() for _, _, metrics in losses])))) for name in Metrics.METRICS)
 
-    summary = tf.Summary(value=[tf.Summary.Value(tag="test_loss", simple_value=mean_mse_loss)])
+    summary = tf.Summary(value=[tf.Summary.Value(tag="test_loss", simple_value=mean_mse_loss)] +
+                               [tf.Summary.Value(tag="test_" + name, simple_value=value) for name, value in median_metrics.items()])
     writer.add_summary(summary, global_step=_global_step)
 
     writer.flush()
     writer.close()
 
-    print("Finished testing - Mean MSE: " + str(mean_mse_loss))
+    print("Finished testing - Mean MSE: " + str(mean_mse_loss) + ", median " + ", ".join(name + " " + str(median_metrics[name]) for name in Metrics.METRICS))
 
     # Close session, clear computational graph
     sess.close()
@@ -2,20 +2,32 @@ from sacred import Experiment
 import tensorflow as tf
 import numpy as np
 import os
+import sys
 import json
+import soundfile
 
 from Input import urmp_input
 import Utils
 import Test
-import Models.UnetAudioSeparator
-import Models.ConditionalUnetAudioSeparator
+import Models.Separators
+import Planner
+import Benchmark
+import Prune
+import Quantize
+import Export
+import Evaluate
+import EstimateWriter
+import Separate
+import Server
+import Checks
+
+import musdb
 
 from tensorflow.contrib.cluster_resolver import TPUClusterResolver
 from tensorflow.contrib import summary
 from tensorflow.contrib import tpu
 from tensorflow.contrib.tpu.python.tpu import tpu_estimator
 from tensorflow.contrib.tpu.python.tpu import tpu_optimizer
-from tensorflow.contrib.tpu.python.tpu import bfloat16
 from tensorflow.python.estimator import estimator
 from google.colab import auth
 
@@ -34,7 +46,11 @@ def cfg():
                     "training_steps": 2000*100, # Number of training steps per training
                     "evaluation_steps": 1000,
                     "use_tpu": True,
-                    "use_bfloat16": True,
+                    "precision": "bfloat16", # Compute precision of separator and input pipeline: "float32", "bfloat16" or "float16". Weights are kept in float32
+                    "loss_scale": 1.0, # Static loss scaling factor, use e.g. 128 for float16 training to avoid underflowing gradients
+                    "recompute": "none", # Recompute activations in the backward pass instead of storing them: "none", "encoder", "decoder" or "all". Encoder level outputs are kept as skip connections anyway, so "encoder" saves little, "decoder" or "all" save most. Check with the check_recompute command
+                    "recompute_levels": 1, # Number of consecutive U-Net levels recomputed as one block
+                    "log_step_stats_every_n_steps": 100, # Log step time and peak memory when not training on TPU
                     "load_model": True,
                     "predict_only": False,
                     "write_audio_summaries": False,
@@ -45,12 +61,32 @@ def cfg():
                     'filter_size': 15, # For Wave-U-Net: Filter size of conv in downsampling block
                     'merge_filter_size': 5, # For Wave-U-Net: Filter size of conv in upsampling block
                     'num_initial_filters': 24, # Number of filters for convolution in first layer of network
+                    'bottleneck_dilations': [], # Dilations of residual convolutions after the bottleneck, e.g. [1, 2, 4, 8, 16] to enlarge the receptive field with fewer layers
+                    'bottleneck_filter_size': 3, # Filter size of the dilated bottleneck convolutions
+                    'num_filters': None, # Number of filters of each convolution (down-sampling levels, bottleneck, up-sampling levels), as written by the prune command. None: num_initial_filters more per level
+                    'init_checkpoint': None, # Checkpoint to initialise the separator variables from when the model directory has no checkpoint yet, e.g. for fine-tuning a pruned separator
+                    'teacher_checkpoint': None, # Checkpoint of a trained separator. If set, the configured separator is trained as student of this teacher (knowledge distillation)
+                    'teacher_config': {}, # Entries of model_config that differ for the teacher, e.g. {"num_layers": 12, "num_initial_filters": 24, "network": "unet"}. The input pipeline has to fit the teacher
+                    'distillation_alpha': 0.5, # Weight of the teacher estimates in the distillation loss, the ground truth sources get 1 - alpha
                     "num_frames": 16384, # DESIRED number of time frames in the output waveform per samples (could be changed when using valid padding)
+                    "inference_num_frames": None, # Fixed number of output frames per window during prediction, overrides inference_memory_budget
+                    "inference_memory_budget": 512 * 1024 * 1024, # Activation memory (bytes) the prediction window may use, the largest fitting window is chosen. None: use num_frames
+                    "inference_batch_size": 4, # Number of windows separated per forward pass during prediction, the window is sized so that the whole batch fits into inference_memory_budget. Larger batches use more cores and amortise per-call overhead, larger windows waste less input context per output sample. None: grow a single window to the budget
+                    "inference_processes": None, # Number of processes separating the windows of each track in parallel during evaluation and separate, each with its share of the cores. None: one process
+                    "inference_silence_threshold": None, # Windows whose mixture input has a mean power below this many dB relative to full scale are not separated, their estimates are silent. Check with the silence_report command. None: separate all windows
+                    "test_num_workers": 2, # Threads decoding and resampling upcoming tracks during testing and evaluation
+                    "test_max_pending": 2, # Decoded tracks and unevaluated estimates held in memory during testing and evaluation
+                    "estimates_stem": False, # Write all predicted sources of a track into one multichannel file instead of one file per source
+                    "estimates_max_buffered": 64, # Out-of-order segments buffered per track when writing predictions, missing segments beyond that are written as silence
+                    "export_dir": None, # Frozen separator written by the export_separator command, used instead of the checkpoint for prediction and testing
+                    "xla": False, # JIT-compile the exported separator with XLA for prediction and testing. Its ops are marked for compilation explicitly, so this also compiles on CPU without TF_XLA_FLAGS=--tf_xla_cpu_global_jit, but needs a Tensorflow build with XLA
+                    "tflite_model": None, # Quantized separator written by the quantize_separator command, used instead of the checkpoint for prediction
+                    "streaming_hop": None, # Predict tracks in streaming mode with this many new samples per step (multiple of 2^num_layers, requires input_context). None: separate windows
                     'expected_sr': 22050,  # Downsample all audio input to this sampling rate
                     'mono_downmix': True,  # Whether to downsample the audio input
                     'output_type': 'direct', # Type of output layer, either "direct" or "difference". Direct output: Each source is result of tanh activation and independent. DIfference: Last source output is equal to mixture input - sum(all other sources)
                     'input_context': False, # Type of padding for convolutions in separator. If False, feature maps double or half in dimensions after each convolution, and convolutions are padded with zeros ("same" padding). If True, convolution is only performed on the available mixture input, thus the output is smaller than the input
-                    'network': 'unet', # Type of network architecture, either unet (our model) or unet_spectrogram (Jansson et al 2017 model)
+                    'network': 'unet', # Type of network architecture, either unet (our model) or unet_separable (depthwise-separable convolutions for fast CPU inference)
                     'upsampling': 'linear', # Type of technique used for upsampling the feature maps in a unet architecture, either 'linear' interpolation or 'learned' filling in of extra samples
                     'task': 'voice', # Type of separation task. 'voice' : Separate music into voice and accompaniment. 'multi_instrument': Separate music into guitar, bass, vocals, drums and other (Sisec)
                     'augmentation': True, # Random attenuation of source signals to improve generalisation performance (data augmentation)
@@ -133,6 +169,21 @@ def baseline_comparison():
         "num_initial_filters" : 34
     }
 
+def get_teacher_config(model_config):
+    '''
+    Model configuration of the distillation teacher: the student configuration updated by model_config["teacher_config"]
+    '''
+    teacher_config = dict(model_config)
+    teacher_config.update(model_config["teacher_config"])
+    return teacher_config
+
+def crop_sources(sources, num_frames):
+    '''
+    Centre crop of a stacked source tensor [batch_size, num_sources, num_samples, num_channels] along time
+    '''
+    crop_start = (sources.shape[2].value - num_frames) // 2
+    return sources[:, :, crop_start:crop_start + num_frames, :]
+
 @ex.capture
 def unet_separator(features, labels, mode, params):
 
@@ -180,22 +231,22 @@ def unet_separator(features, labels, mode, params):
     model_config = params
     disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]
     print("##########################################", model_config.keys())
-    with bfloat16.bfloat16_scope():
-        separator_class = Models.ConditionalUnetAudioSeparator.UnetAudioSeparator(
-            model_config["num_layers"], model_config["num_initial_filters"],
-            output_type=model_config["output_type"],
-            context=model_config["input_context"],
-            mono=model_config["mono_downmix"],
-            upsampling=model_config["upsampling"],
-            num_sources=model_config["num_sources"],
-            filter_size=model_config["filter_size"],
-            merge_filter_size=model_config["merge_filter_size"])
+    separator_class = Models.Separators.get_separator(model_config, conditional=True)
 
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
 
     # Input context that the input audio has to be padded ON EACH SIDE
     # TODO move this to dataset function
-    assert mix.shape[1].value == sep_input_shape[1]
+    distillation = model_config.get("teacher_checkpoint") is not None
+    if distillation:
+        # The input pipeline delivers the input of the teacher, whose valid convolutions may need more context than the student
+        teacher_class = Models.Separators.get_separator(get_teacher_config(model_config), conditional=True)
+        teacher_input_shape, teacher_output_shape = teacher_class.get_padding(np.array(disc_input_shape))
+        assert mix.shape[1].value == teacher_input_shape[1] and teacher_input_shape[1] >= sep_input_shape[1]
+        student_mix = Utils.crop(mix, sep_input_shape, match_feature_dim=False)
+    else:
+        assert mix.shape[1].value == sep_input_shape[1]
+        student_mix = mix
     if mode != tf.estimator.ModeKeys.PREDICT:
         pad_tensor = tf.constant([[0, 0], [0, 0], [2, 3], [0, 0]])
         sources = tf.pad(sources, pad_tensor, "CONSTANT")
@@ -203,7 +254,7 @@ def unet_separator(features, labels, mode, params):
     separator_func = separator_class.get_output
 
     # Compute loss.
-    separator_sources = tf.stack(separator_func(mix, conditioning,
+    separator_sources = tf.stack(separator_func(student_mix, conditioning,
                                                 True, not model_config["raw_audio_loss"],
                                                 reuse=False), axis=1)
 
@@ -216,7 +267,39 @@ def unet_separator(features, labels, mode, params):
         }
         return tpu_estimator.TPUEstimatorSpec(mode, predictions=predictions)
 
-    separator_loss = 0.01+ tf.cast(tf.reduce_sum(tf.squared_difference(sources, separator_sources)), tf.float32)
+    # Loss is always computed in float32, separator outputs are float32 already
+    sources = tf.cast(sources, tf.float32)
+    # Variables initialised from other checkpoints than the one in the model directory: (checkpoint, assignment map)
+    warm_starts = list()
+    if model_config.get("init_checkpoint") is not None:
+        warm_starts.append((model_config["init_checkpoint"], {"separator/": "separator/"}))
+    if distillation:
+        # Frozen teacher with its own copy of the separator variables, initialised from the teacher checkpoint
+        with tf.variable_scope("teacher"):
+            teacher_sources = tf.stop_gradient(tf.stack(teacher_class.get_output(mix, conditioning, False, reuse=False), axis=1))
+        warm_starts.append((model_config["teacher_checkpoint"], {"separator/": "teacher/separator/"}))
+
+    def init_from_checkpoints():
+        for checkpoint, assignment_map in warm_starts:
+            tf.train.init_from_checkpoint(checkpoint, assignment_map)
+
+    scaffold_fn = None
+    if warm_starts and model_config["use_tpu"]:
+        def scaffold_fn():
+            init_from_checkpoints()
+            return tf.train.Scaffold()
+    else:
+        init_from_checkpoints()
+
+    if distillation:
+        # Compare teacher, student and ground truth on the time interval all of them cover
+        num_frames = min(sources.shape[2].value, separator_sources.shape[2].value, teacher_sources.shape[2].value)
+        sources, separator_sources, teacher_sources = [crop_sources(s, num_frames) for s in [sources, separator_sources, teacher_sources]]
+        alpha = model_config["distillation_alpha"]
+        separator_loss = 0.01 + alpha * tf.reduce_sum(tf.squared_difference(teacher_sources, separator_sources)) \
+                         + (1.0 - alpha) * tf.reduce_sum(tf.squared_difference(sources, separator_sources))
+    else:
+        separator_loss = 0.01+ tf.reduce_sum(tf.squared_difference(sources, separator_sources))
 
     if mode != tf.estimator.ModeKeys.PREDICT:
         global_step = tf.train.get_global_step()
@@ -240,25 +323,32 @@ def unet_separator(features, labels, mode, params):
 
     # Creating evaluation estimator
     if mode == tf.estimator.ModeKeys.EVAL:
-        def metric_fn(labels, predictions):
+        def metric_fn(labels, predictions, teacher_predictions=None):
             mean_mse_loss = tf.metrics.mean_squared_error(labels, predictions)
-            return {'mse': mean_mse_loss}
+            if teacher_predictions is None:
+                return {'mse': mean_mse_loss}
+            return {'mse': mean_mse_loss,
+                    'teacher_mse': tf.metrics.mean_squared_error(labels, teacher_predictions),
+                    'student_teacher_mse': tf.metrics.mean_squared_error(teacher_predictions, predictions)}
 
         eval_params = {'labels': sources,
                        'predictions': separator_sources}
+        if distillation:
+            eval_params['teacher_predictions'] = teacher_sources
 
         return tpu_estimator.TPUEstimatorSpec(
             mode=mode,
             loss=separator_loss,
             host_call=host_call,
-            eval_metrics=(metric_fn, eval_params))
+            eval_metrics=(metric_fn, eval_params),
+            scaffold_fn=scaffold_fn)
 
 
     # Create training op.
     # TODO add learning rate schedule
     # TODO add early stopping
     if mode == tf.estimator.ModeKeys.TRAIN:
-        separator_vars = Utils.getTrainableVariables("separator")
+        separator_vars = [v for v in Utils.getTrainableVariables("separator") if not v.name.startswith("teacher/")]
         print("Sep_Vars: " + str(Utils.getNumParams(separator_vars)))
         print("Num of variables: " + str(len(tf.global_variables())))
 
@@ -266,13 +356,287 @@ def unet_separator(features, labels, mode, params):
         if model_config["use_tpu"]:
             separator_solver = tpu_optimizer.CrossShardOptimizer(separator_solver)
 
-        train_op = separator_solver.minimize(separator_loss,
-                                             var_list=separator_vars,
-                                             global_step=global_step)
+        # Scale the loss up before differentiation so that small reduced precision gradients do not underflow,
+        # then scale the float32 gradients back down before they are applied to the float32 master weights
+        loss_scale = model_config["loss_scale"]
+        grads_and_vars = separator_solver.compute_gradients(separator_loss * loss_scale, var_list=separator_vars)
+        grads_and_vars = [(grad / loss_scale, var) for grad, var in grads_and_vars if grad is not None]
+        train_op = separator_solver.apply_gradients(grads_and_vars, global_step=global_step)
         return tpu_estimator.TPUEstimatorSpec(mode=mode,
                                               loss=separator_loss,
                                               host_call=host_call,
-                                              train_op=train_op)
+                                              train_op=train_op,
+                                              scaffold_fn=scaffold_fn)
+
+
+@ex.command
+def plan_windows(model_config, candidates=(16384, 65536, 262144, 1048576)):
+    '''
+    Prints context efficiency, FLOPs and activation memory of the conditional separator for several output lengths,
+    as well as the inference window chosen for the configured memory budget.
+    '''
+    separator_class = Models.Separators.get_separator(model_config, conditional=True)
+    rows = Planner.plan_windows(separator_class, [model_config["num_frames"]] + list(candidates))
+    Planner.print_plan(rows)
+    print("Inference window: " + str(Planner.get_inference_frames(model_config, separator_class)) + " output frames")
+    return rows
+
+
+@ex.command
+def layer_report(model_config, report_path="layer_report.json"):
+    '''
+    Builds the conditional separator graph for the configured batch_size and num_frames and prints per-layer output
+    shapes, FLOPs, parameter counts and activation memory. The report is also written to report_path as JSON.
+    '''
+    separator_class = Models.Separators.get_separator(model_config, conditional=True)
+    report = Planner.get_report(separator_class, model_config["num_frames"], model_config["batch_size"])
+
+    with tf.Graph().as_default() as graph:
+        mix = tf.placeholder(tf.float32, report["input_shape"], name="mix_input")
+        conditioning = tf.placeholder(tf.float32, [model_config["batch_size"], model_config["num_sources"]], name="conditioning_input")
+        separator_class.get_output(mix, conditioning, False, reuse=False)
+        Planner.check_graph(report, graph)
+
+    Planner.print_report(report)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+@ex.command
+def benchmark(model_config, networks=("unet", "unet_separable"), num_runs=10):
+    '''
+    Compares FLOPs and CPU real-time factor of network types on the inference window, relative to the first one.
+    Runs in float32, since bfloat16 is only fast on TPU.
+    '''
+    config = dict(model_config)
+    config["precision"] = "float32"
+    separator_class = Models.Separators.get_separator(config)
+    rows = Benchmark.compare_networks(config, networks, Planner.get_inference_frames(config, separator_class), num_runs)
+    Benchmark.print_comparison(rows)
+    return rows
+
+
+@ex.command
+def distillation_report(model_config, num_runs=10):
+    '''
+    Compares parameters, FLOPs and CPU real-time factor of the distillation teacher and the student on the training
+    window. Their separation quality is reported by the evaluation metrics mse (student) and teacher_mse.
+    '''
+    rows = list()
+    for name, config in [("teacher", get_teacher_config(model_config)), ("student", model_config)]:
+        config = dict(config)
+        config["precision"] = "float32"
+        row = Benchmark.time_separator(config, model_config["num_frames"], num_runs)
+        row["network"] = name
+        rows.append(row)
+    Benchmark.print_comparison(rows)
+    return rows
+
+
+@ex.command
+def prune_checkpoint(model_config, checkpoint, output_dir="pruned", method="magnitude", ratio=0.5, num_filters=None, audio_list=(), num_runs=10):
+    '''
+    Removes the lowest scoring filters from each convolution of the conditional separator in checkpoint, see Prune.prune.
+    Writes the pruned checkpoint and pruned_config.json, which is used for fine-tuning with "with <output_dir>/pruned_config.json".
+    Activation scoring runs the separator on the audio files in audio_list. Afterwards the CPU real-time factor of the
+    original and the pruned separator are compared.
+    '''
+    mixtures = [Utils.load(path, sr=model_config["expected_sr"], mono=model_config["mono_downmix"])[0] for path in audio_list]
+    pruned_config = Prune.prune(model_config, checkpoint, output_dir, method, ratio, num_filters, mixtures)
+    print("Pruned filters per convolution: " + str(pruned_config["num_filters"]))
+
+    rows = list()
+    for name, config in [("original", model_config), ("pruned", dict(model_config, **pruned_config))]:
+        config = dict(config)
+        config["precision"] = "float32"
+        row = Benchmark.time_separator(config, model_config["num_frames"], num_runs)
+        row["network"] = name
+        rows.append(row)
+    Benchmark.print_comparison(rows)
+    return pruned_config
+
+
+@ex.command
+def quantize_separator(model_config, checkpoint, musdb_path, tflite_path="separator_int8.tflite", num_calibration_tracks=3, num_report_tracks=3):
+    '''
+    Converts the separator of checkpoint to int8 with activation ranges calibrated on MUSDB training tracks, then
+    reports SDR drop and speed-up against the float32 separator on MUSDB test tracks. Setting model_config["tflite_model"]
+    to tflite_path makes Evaluate.predict use the quantized separator.
+    '''
+    mus = musdb.DB(root_dir=musdb_path)
+    calibration_tracks = mus.load_mus_tracks(subsets=["train"])[:num_calibration_tracks]
+    mixtures = [Evaluate.prepare_mix(model_config, track.audio, track.rate) for track in calibration_tracks]
+    Quantize.quantize(model_config, checkpoint, mixtures, tflite_path)
+
+    rows = Evaluate.quantization_report(model_config, checkpoint, tflite_path, mus.load_mus_tracks(subsets=["test"])[:num_report_tracks])
+    Evaluate.print_quantization_report(rows)
+    return rows
+
+
+@ex.command
+def silence_report(model_config, checkpoint, musdb_path, thresholds=(-90.0, -80.0, -70.0, -60.0), num_tracks=5, tolerance=0.05, subset="test"):
+    '''
+    Separates MUSDB tracks of subset with all windows and with windows below each threshold skipped, and prints the
+    fraction of skipped windows, the change of median SDR and the speed-up per threshold, see Evaluate.silence_report.
+    The highest threshold that changes no track's SDR by more than tolerance dB is a safe inference_silence_threshold.
+    '''
+    tracks = musdb.DB(root_dir=musdb_path).load_mus_tracks(subsets=[subset])[:num_tracks]
+    rows = Evaluate.silence_report(model_config, checkpoint, tracks, thresholds)
+    Evaluate.print_silence_report(rows, tolerance)
+    return rows
+
+
+@ex.command
+def evaluate(model_config, checkpoint, musdb_path, output_dir="eval", subset="test"):
+    '''
+    Separates and evaluates the MUSDB tracks of subset with the separator of checkpoint (or model_config["export_dir"]),
+    decoding upcoming tracks and evaluating finished ones in parallel to the separation, see Evaluate.evaluate_tracks.
+    '''
+    tracks = musdb.DB(root_dir=musdb_path).load_mus_tracks(subsets=[subset])
+    return Evaluate.evaluate_tracks(model_config, checkpoint, tracks, output_dir, model_config["test_num_workers"], model_config["test_max_pending"])
+
+
+@ex.command
+def evaluate_cached(model_config, checkpoint, musdb_path, cache_dir="eval_cache", subset="test", num_processes=4, win=1.0, hop=1.0, reference_cache=True):
+    '''
+    Evaluates the MUSDB tracks of subset in parallel processes, reusing cached results of earlier evaluations of the
+    same separator and evaluation parameters, see Evaluate.evaluate_parallel. Prints the SDR statistics per source.
+    With reference_cache, BSS Eval stores the reference-side statistics of each track in cache_dir/references, so
+    that evaluating further checkpoints on the same tracks is cheaper.
+    '''
+    reference_cache_dir = os.path.join(cache_dir, "references") if reference_cache else None
+    json_folder = Evaluate.evaluate_parallel(model_config, checkpoint, musdb_path, subset, cache_dir, num_processes, win, hop, reference_cache_dir=reference_cache_dir)
+    averages = Evaluate.compute_mean_metrics(json_folder)
+    for i, (median, mad, mean, std) in enumerate(averages):
+        print("Source " + str(i) + " SDR: median " + str(median) + ", MAD " + str(mad) + ", mean " + str(mean) + ", std " + str(std))
+    return averages
+
+
+@ex.command
+def separate(model_config, checkpoint, input_path, output_dir="separated", block_seconds=10.0, offset=0.0, duration=None, pcm_sr=44100, pcm_channels=2, pcm_dtype="int16"):
+    '''
+    Separates a recording of any length with constant memory and writes each source to output_dir/source_<i>.wav,
+    see Separate.BlockSeparator. The input is read block by block from input_path, or as raw interleaved PCM of
+    pcm_channels channels at pcm_sr from stdin if input_path is "-", e.g. "ffmpeg -i concert.mp3 -f s16le - | python Training.py separate with input_path=-".
+    With model_config["inference_processes"], a file is instead read at once and its windows are separated by several
+    processes, see Evaluate.ParallelPredictor.
+    '''
+    if model_config["inference_processes"] is not None and input_path != "-":
+        # Whole recording in memory, its windows are separated by several processes
+        with soundfile.SoundFile(input_path, "r") as f:
+            f.seek(int(offset * f.samplerate))
+            mix_audio, mix_sr = f.read(-1 if duration is None else int(duration * f.samplerate), dtype="float32", always_2d=True), f.samplerate
+        predictor = Evaluate.ParallelPredictor(model_config, checkpoint, model_config["inference_processes"])
+        try:
+            separator_preds = predictor(mix_audio, mix_sr)
+            if model_config["inference_silence_threshold"] is not None:
+                print(predictor.summary())
+        finally:
+            predictor.close()
+        paths = Separate.write_sources(model_config, separator_preds, mix_sr, mix_audio.shape[1], output_dir)
+        print("Wrote source estimates to " + ", ".join(paths))
+        return paths
+
+    run_fn, sep_input_shape, sep_output_shape, close_fn = Evaluate.load_separator(model_config, checkpoint)
+    try:
+        if input_path == "-":
+            stream = sys.stdin.buffer if hasattr(sys.stdin, "buffer") else sys.stdin
+            blocks = Separate.read_pcm_blocks(stream, pcm_channels, pcm_dtype, int(block_seconds * pcm_sr))
+            paths = Separate.separate_blocks(model_config, run_fn, blocks, pcm_sr, pcm_channels, sep_input_shape[1], sep_output_shape[1], sep_input_shape[0], output_dir)
+        else:
+            paths = Separate.separate_file(model_config, run_fn, input_path, sep_input_shape[1], sep_output_shape[1], sep_input_shape[0], output_dir, block_seconds, offset, duration)
+    finally:
+        close_fn()
+    if isinstance(run_fn, Evaluate.SilenceSkipper):
+        print(run_fn.summary())
+    print("Wrote source estimates to " + ", ".join(paths))
+    return paths
+
+
+def load_server_models(model_config, checkpoint, checkpoints):
+    # Models of a separation server: the separator of checkpoint (or model_config["export_dir"]) as "default", and
+    # separators of further checkpoints of the same configuration by name
+    models = dict()
+    close_fns = list()
+    for name, path in [("default", checkpoint)] + sorted(checkpoints.items()):
+        run_fn, sep_input_shape, sep_output_shape, close_fn = Evaluate.load_separator(model_config, path)
+        models[name] = (model_config, run_fn, sep_input_shape, sep_output_shape)
+        close_fns.append(close_fn)
+    return models, close_fns
+
+
+@ex.command
+def serve(model_config, checkpoint, host="127.0.0.1", port=5050, max_delay=0.05, checkpoints={}):
+    '''
+    Runs a separation server on host:port that keeps the separator of checkpoint loaded, and the ones of checkpoints
+    (dictionary from model name to checkpoint path). Windows of concurrent requests are separated in shared batches
+    of the inference batch size, waiting at most max_delay seconds for a batch to fill, see Server.SeparationServer.
+    Server.separate is a client.
+    '''
+    models, close_fns = load_server_models(model_config, checkpoint, checkpoints)
+    server = Server.SeparationServer(models, (host, port), max_delay)
+    print("Serving models " + ", ".join(sorted(models.keys())) + " on " + str(server.address))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+        for close_fn in close_fns:
+            close_fn()
+
+
+@ex.command
+def serve_load_test(model_config, checkpoint, num_clients=4, requests_per_client=5, seconds=10.0, max_delay=0.05):
+    '''
+    Starts a separation server for checkpoint on a free local port and sends random stereo mixtures of the given
+    duration from concurrent clients. Prints throughput, p50 and p99 request latency and the mean batch occupancy.
+    '''
+    models, close_fns = load_server_models(model_config, checkpoint, {})
+    server = Server.SeparationServer(models, ("127.0.0.1", 0), max_delay)
+    server.start()
+    try:
+        report = Server.load_test(server.address, num_clients, requests_per_client, seconds)
+        Server.print_load_report(report, server.stats())
+    finally:
+        server.close()
+        for close_fn in close_fns:
+            close_fn()
+    return report
+
+
+@ex.command
+def export_separator(model_config, checkpoint, export_dir="export", batch_size=1, num_runs=10):
+    '''
+    Writes the frozen separator of checkpoint for the configured inference window and batch size to export_dir. Setting
+    model_config["export_dir"] makes Evaluate.predict and Test.test load it once instead of rebuilding the graph.
+    Afterwards latency and throughput of the plain session and of XLA compilation (model_config["xla"]) are compared.
+    '''
+    description = Export.export(model_config, checkpoint, export_dir, batch_size)
+    print("Exported separator with input shape " + str(description["input_shape"]) + " and output shape " + str(description["output_shape"]) + " to " + export_dir)
+    Benchmark.print_inference_comparison(Benchmark.compare_inference(export_dir, num_runs))
+    return description
+
+
+@ex.command
+def check_multi_query(model_config, batch_size=2, num_queries=3):
+    '''
+    Checks on the CPU with random weights that separating each mixture with several conditioning queries at once
+    (get_multi_query_output) gives the same estimates as one get_output call per query, see Checks.check_multi_query_output.
+    '''
+    max_diff = Checks.check_multi_query_output(model_config, batch_size, num_queries)
+    print("Multi-query output matches separate queries, maximum difference " + str(max_diff))
+    return max_diff
+
+
+@ex.command
+def check_recompute(model_config, recompute="all"):
+    '''
+    Builds the training graph of the separator with recomputed activations on the CPU and checks that estimates and
+    gradients equal those without recomputation, see Checks.check_recompute_gradients.
+    '''
+    max_diff = Checks.check_recompute_gradients(model_config, recompute)
+    print("Gradients with recompute=" + recompute + " match, maximum relative difference " + str(max_diff))
+    return max_diff
 
 
 @ex.automain
@@ -333,7 +697,7 @@ def experiment(model_config):
         mode=mode,
         data_dir=model_config['data_path'],
         transpose_input=False,
-        use_bfloat16=model_config['use_bfloat16']) for mode in ['train', 'eval', 'test']]
+        precision=model_config['precision']) for mode in ['train', 'eval', 'test']]
 
     tf.logging.info("Assigning TPUEstimator")
     # Optimize in a +supervised fashion until validation loss worsens
@@ -355,9 +719,11 @@ def experiment(model_config):
     if model_config['mode'] == 'train_and_eval':
         tf.logging.info("Train the model")
         # Should be an early stopping here, but it will come with tf 1.10
+        hooks = [] if model_config["use_tpu"] else [Utils.StepStatsHook(model_config["log_step_stats_every_n_steps"])]
         separator.train(
             input_fn=urmp_train.input_fn,
-            steps=model_config['training_steps'])
+            steps=model_config['training_steps'],
+            hooks=hooks)
         # ...zzz...
         tf.logging.info("Supervised training finished!")
         tf.logging.info("Evaluate model")
@@ -372,9 +738,10 @@ def experiment(model_config):
         predictions = separator.predict(
             input_fn=urmp_test.input_fn)
 
+        writer = EstimateWriter.EstimateWriter(model_config["estimates_path"], model_config["expected_sr"],
+                                               stem=model_config["estimates_stem"],
+                                               max_buffered=model_config["estimates_max_buffered"])
         for prediction in predictions:
-            Test.save_prediction(prediction,
-                                 estimates_path=model_config["estimates_path"],
-                                 sample_rate=model_config["expected_sr"])
-        Utils.concat_and_upload(model_config["estimates_path"],
-                                model_config['model_base_dir'] + os.path.sep + str(model_config["experiment_id"]))
+            writer.write(prediction)
+        paths = writer.close()
+        tf.logging.info("Wrote " + str(len(paths)) + " estimate files to " + model_config["estimates_path"])
@@ -1,9 +1,13 @@
 import os
+import time
+import resource
 import tensorflow as tf
 import numpy as np
 import librosa
 from google.cloud import storage
 
+import Resample
+
 
 # Slice up matrices into squares so the neural net gets a consistent size for training (doesnd't matter for inference)
 def chop(matrix, scale):
@@ -15,6 +19,29 @@ def chop(matrix, scale):
             slices.append(s)
     return slices
 
+PRECISION_DTYPES = {"float32": tf.float32, "bfloat16": tf.bfloat16, "float16": tf.float16}
+
+def get_compute_dtype(precision):
+    '''
+    Maps a precision setting of the model configuration to the Tensorflow dtype used for computations.
+    :param precision: One of "float32", "bfloat16" or "float16"
+    :return: Tensorflow dtype
+    '''
+    if precision not in PRECISION_DTYPES:
+        raise ValueError("Unknown precision " + str(precision) + ", expected one of " + str(sorted(PRECISION_DTYPES.keys())))
+    return PRECISION_DTYPES[precision]
+
+def float32_variable_getter(getter, *args, **kwargs):
+    '''
+    Custom variable getter that stores reduced precision (float16/bfloat16) variables as float32 master weights and
+    hands out a copy cast to the requested compute dtype. Optimizer updates are therefore applied in float32.
+    '''
+    dtype = kwargs.get("dtype")
+    if dtype in (tf.float16, tf.bfloat16):
+        kwargs["dtype"] = tf.float32
+        return tf.cast(getter(*args, **kwargs), dtype)
+    return getter(*args, **kwargs)
+
 def getTrainableVariables(tag=""):
     return [v for v in tf.trainable_variables() if tag in v.name]
 
@@ -33,6 +60,49 @@ def crop_and_concat(x1,x2, match_feature_dim=True):
     x1 = crop(x1,x2.get_shape().as_list(), match_feature_dim)
     return tf.concat([x1, x2], axis=2)
 
+def repeat_batch(tensor, repeats):
+    '''
+    Repeats every example of a batch a number of times, keeping the copies of an example next to each other.
+    :param tensor: Tensor of shape [batch_size, ...]
+    :param repeats: Number of copies of each example
+    :return: Tensor of shape [batch_size * repeats, ...]
+    '''
+    shape = tensor.get_shape().as_list()
+    tensor = tf.tile(tf.expand_dims(tensor, axis=1), [1, repeats] + [1] * (len(shape) - 1))
+    return tf.reshape(tensor, [shape[0] * repeats] + shape[1:])
+
+def conv_layer_name(index):
+    '''
+    Name that tf.layers.conv1d assigns automatically to the index-th convolution created in a variable scope.
+    Naming convolutions explicitly with it keeps checkpoints compatible with graphs built from unnamed layers.
+    '''
+    return "conv1d" + ("_" + str(index) if index > 0 else "")
+
+def get_recompute_segments(num_levels, levels_per_segment):
+    '''
+    Splits the levels of the U-Net into consecutive groups that are computed (and possibly recomputed) together
+    :param num_levels: Number of levels
+    :param levels_per_segment: Maximum number of levels per group
+    :return: List of lists of level indices
+    '''
+    levels_per_segment = max(1, levels_per_segment)
+    return [list(range(start, min(start + levels_per_segment, num_levels))) for start in range(0, num_levels, levels_per_segment)]
+
+def recompute_grad(fn, enabled):
+    '''
+    Wraps a function of tensors so that its intermediate activations are not kept for the backward pass, but recomputed
+    from its inputs when the gradients are computed. Trades compute for activation memory during training.
+    Layers inside fn have to be named explicitly and created with reuse=tf.AUTO_REUSE, so that the recomputation finds the same variables.
+    Their variables have to be resource variables (use_resource=True in the enclosing variable scope), which
+    tf.contrib.layers.recompute_grad requires to compute their gradients.
+    :param fn: Function taking and returning tensors
+    :param enabled: Whether to recompute, otherwise fn is returned unchanged
+    :return: Wrapped function
+    '''
+    if not enabled:
+        return fn
+    return tf.contrib.layers.recompute_grad(fn)
+
 def sdr_loss(reference_signals, estimates):
     loss = 0
     for i in range(len(reference_signals)):
@@ -93,7 +163,7 @@ def learned_interpolation_layer(input, padding, level):
 
     # Construct 2FxF weight matrix, where F is the number of feature channels in the feature map.
     # Matrix is constrained, made up out of two diagonal FxF matrices with diagonal weights w and 1-w. w is constrained to be in [0,1] # mioid
-    weights = tf.get_variable("interp_" + str(level), shape=[features], dtype=tf.float32)
+    weights = tf.get_variable("interp_" + str(level), shape=[features], dtype=input.dtype)
     weights_scaled = tf.nn.sigmoid(weights) # Constrain weights to [0,1]
     counter_weights = 1.0 - weights_scaled # Mirrored weights for the features from the other time step
     conv_weights = tf.expand_dims(tf.concat([tf.expand_dims(tf.diag(weights_scaled), axis=0), tf.expand_dims(tf.diag(counter_weights), axis=0)], axis=0), axis=0)
@@ -172,10 +242,12 @@ def dilated_conv(value, filter_, dilation, name='dilated_conv'):
 
 def load(path, sr=22050, mono=True, offset=0.0, duration=None, dtype=np.float32, res_type='kaiser_best'):
     # ALWAYS output (n_frames, n_channels) audio
-    y, sr = librosa.load(path, sr, mono, offset, duration, dtype, res_type)
+    y, orig_sr = librosa.load(path, None, mono, offset, duration, dtype)
     if len(y.shape) == 1:
         y = np.expand_dims(y, axis=0)
-    return (y.T, sr)
+    if sr is None:
+        return (y.T, orig_sr)
+    return (Resample.resample(y.T, orig_sr, sr, res_type), sr)
 
 def crop(tensor, target_shape, match_feature_dim=True):
     '''
@@ -199,6 +271,32 @@ def crop(tensor, target_shape, match_feature_dim=True):
     return tensor[:,crop_start[1]:-crop_end[1],:]
 
 
+class StepStatsHook(tf.train.SessionRunHook):
+    '''
+    Logs the average duration of a training step and the peak resident memory of the process every few steps,
+    to compare memory savings and compute overhead of activation recomputation.
+    '''
+
+    def __init__(self, every_n_steps=100):
+        self.every_n_steps = every_n_steps
+
+    def begin(self):
+        self._steps = 0
+        self._start_time = None
+
+    def before_run(self, run_context):
+        if self._start_time is None:
+            self._start_time = time.time()
+
+    def after_run(self, run_context, run_values):
+        self._steps += 1
+        if self._steps % self.every_n_steps == 0:
+            step_time = (time.time() - self._start_time) / self.every_n_steps
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # Linux reports kilobytes
+            tf.logging.info("Step time: %.3f s, peak memory: %.1f MiB" % (step_time, peak_memory))
+            self._start_time = time.time()
+
+
 def upload_to_gcs(filenames, gcs_bucket_path):
     """Upload wave file to GCS, at provided path."""
 
@@ -231,7 +329,7 @@ def concat_and_upload(estimates_path, gsc_estimates_path, sr=22050):
         if not files:
             continue
         files.sort()
-        audio_data = np.concatenate([librosa.core.load(os.path.join(root, name))[0] for name in files])
+        audio_data = np.concatenate([load(os.path.join(root, name), sr=sr)[0][:, 0] for name in files])
         librosa.output.write_wav(root+'.wav', audio_data, sr)
         for name in files:
             os.remove(os.path.join(root, name))